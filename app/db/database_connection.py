@@ -1,11 +1,27 @@
 # for database connection and initialization
 import psycopg2
 import logging
+import threading
 import streamlit as st
+from contextlib import contextmanager
 from functools import lru_cache
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+
+_pool = None
+_pool_lock = threading.Lock()
+_thread_state = threading.local()
 
 def get_connection():
     """Get database connection - uses session state for reuse within same session"""
+    if getattr(_thread_state, 'private', False):
+        # Background work must never share (or close) the session's connection
+        try:
+            return psycopg2.connect(st.secrets["DB_CONNECTION"])
+        except Exception as e:
+            logging.error(f"Failed to connect to the database: {e}")
+            return None
+
     if 'db_connection' not in st.session_state or st.session_state.db_connection is None:
         try:
             conn = psycopg2.connect(st.secrets["DB_CONNECTION"])
@@ -37,6 +53,18 @@ def get_connection():
                 st.session_state.db_connection = None
                 return None
 
+@contextmanager
+def private_connections():
+    """
+    Within the block, get_connection() on this thread opens a connection of its own
+    For background threads, which can outlive the script run whose session connection they would share
+    """
+    _thread_state.private = True
+    try:
+        yield
+    finally:
+        _thread_state.private = False
+
 def connect_to_db():
     """Legacy function - returns raw psycopg2 connection for backwards compatibility"""
     try:
@@ -47,6 +75,41 @@ def connect_to_db():
         logging.error(f"Failed to connect to the database: {e}")
         return None
 
+def get_pool():
+    """Process-wide connection pool (DB_POOL_SIZE connections at most), created on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.closed:
+            _pool = ThreadedConnectionPool(1, int(st.secrets.get("DB_POOL_SIZE", 10)), st.secrets["DB_CONNECTION"])
+        return _pool
+
+@contextmanager
+def pooled_connection():
+    """
+    Borrow a pooled connection for one transaction; the caller commits
+    Anything left uncommitted is rolled back when the block exits, and dead connections are discarded
+    """
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+    except psycopg2.Error as e:
+        logging.warning(f"Pooled database connection lost, reconnecting: {e}")
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+
+    try:
+        yield conn
+    finally:
+        broken = bool(conn.closed)
+        if not broken:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        pool.putconn(conn, close=broken)
+
 def drop_instructions_table():
     conn = get_connection()
     if conn is None:
@@ -110,6 +173,14 @@ def initialize_db():
                 ON CONFLICT (id) DO NOTHING;
             """)
 
+            # Initialize topic_lexicon table (per-deployment keywords for the RAG topic router)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS topic_lexicon (
+                    id SERIAL PRIMARY KEY,
+                    keywords TEXT
+                );
+            """)
+
             # Initialize ingested_files table
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS ingested_files (
@@ -121,10 +192,121 @@ def initialize_db():
                     chunks_count INTEGER DEFAULT 0,
                     ingested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     status TEXT DEFAULT 'completed' CHECK (status IN ('processing', 'completed', 'failed')),
-                    error_message TEXT
+                    error_message TEXT,
+                    centroid REAL[],
+                    stored_chunks INTEGER DEFAULT 0,
+                    total_chars BIGINT DEFAULT 0,
+                    min_chunk_chars INTEGER,
+                    max_chunk_chars INTEGER,
+                    search_page_start INTEGER,
+                    search_page_end INTEGER
+                );
+            """)
+
+            # Add centroid column if it doesn't exist (for existing databases)
+            cur.execute("""
+                DO $$
+                BEGIN
+                    BEGIN
+                        ALTER TABLE ingested_files ADD COLUMN centroid REAL[];
+                    EXCEPTION
+                        WHEN duplicate_column THEN
+                        -- Column already exists, do nothing
+                    END;
+                END $$;
+            """)
+
+            # Add per-file chunk aggregates if they don't exist (for existing databases)
+            cur.execute("""
+                DO $$
+                BEGIN
+                    BEGIN
+                        ALTER TABLE ingested_files
+                            ADD COLUMN stored_chunks INTEGER DEFAULT 0,
+                            ADD COLUMN total_chars BIGINT DEFAULT 0,
+                            ADD COLUMN min_chunk_chars INTEGER,
+                            ADD COLUMN max_chunk_chars INTEGER;
+                    EXCEPTION
+                        WHEN duplicate_column THEN
+                        -- Columns already exist, do nothing
+                    END;
+                END $$;
+            """)
+
+            # Add admin page-range restriction if it doesn't exist (for existing databases)
+            cur.execute("""
+                DO $$
+                BEGIN
+                    BEGIN
+                        ALTER TABLE ingested_files
+                            ADD COLUMN search_page_start INTEGER,
+                            ADD COLUMN search_page_end INTEGER;
+                    EXCEPTION
+                        WHEN duplicate_column THEN
+                        -- Columns already exist, do nothing
+                    END;
+                END $$;
+            """)
+
+            # Corpus generation counter, bumped on any change to the RAG corpus so process-local
+            # retrieval caches know when to invalidate. A sequence rather than a counter row:
+            # nextval() takes no row lock, so a long ingestion transaction never blocks other writers
+            cur.execute("CREATE SEQUENCE IF NOT EXISTS rag_corpus_generation_seq;")
+            cur.execute("DROP TABLE IF EXISTS rag_corpus_state;")
+
+            cur.execute("""
+                CREATE OR REPLACE FUNCTION bump_rag_corpus_generation() RETURNS trigger AS $$
+                BEGIN
+                    PERFORM nextval('rag_corpus_generation_seq');
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+
+            # Every corpus change goes through ingested_files: ingestion finishes by updating the
+            # file's status, deletes cascade from it, and page ranges are stored on it. nextval() is not
+            # transactional, so the app's own writers bump the generation again after committing
+            # (see _bump_corpus_generation); the trigger catches changes made outside them
+            cur.execute("""
+                DO $$
+                BEGIN
+                    IF NOT EXISTS (
+                        SELECT 1 FROM pg_trigger
+                        WHERE tgname = 'ingested_files_corpus_generation'
+                          AND tgrelid = 'ingested_files'::regclass
+                    ) THEN
+                        CREATE TRIGGER ingested_files_corpus_generation
+                        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON ingested_files
+                        FOR EACH STATEMENT EXECUTE FUNCTION bump_rag_corpus_generation();
+                    END IF;
+                END $$;
+            """)
+
+            # Scores logged by the RAG relevance gate, used to learn its threshold
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS rag_gate_scores (
+                    id SERIAL PRIMARY KEY,
+                    centroid_similarity REAL NOT NULL,
+                    best_similarity REAL,
+                    found_context BOOLEAN NOT NULL,
+                    sample_weight REAL NOT NULL DEFAULT 1,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 );
             """)
 
+            # Add sample_weight column if it doesn't exist (for existing databases)
+            cur.execute("""
+                DO $$
+                BEGIN
+                    BEGIN
+                        ALTER TABLE rag_gate_scores ADD COLUMN sample_weight REAL NOT NULL DEFAULT 1;
+                    EXCEPTION
+                        WHEN duplicate_column THEN
+                        -- Column already exists, do nothing
+                    END;
+                END $$;
+            """)
+
             # Initialize file_selections table for user preferences
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS file_selections (
@@ -234,8 +416,9 @@ def update_app_description(new_description):
         if conn:
             conn.close()
 
-def insert_ingested_file(file_name, file_path, file_size, file_hash, status='processing'):
-    """Insert a new ingested file record"""
+@st.cache_data(ttl=300)  # Cache for 5 minutes
+def get_topic_keywords():
+    """Get the deployment's topic keywords, or None if none have been saved"""
     conn = get_connection()
     if conn is None:
         logging.error("Failed to connect to the database.")
@@ -243,24 +426,20 @@ def insert_ingested_file(file_name, file_path, file_size, file_hash, status='pro
 
     try:
         with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO ingested_files (file_name, file_path, file_size, file_hash, status)
-                VALUES (%s, %s, %s, %s, %s)
-                RETURNING id;
-            """, (file_name, file_path, file_size, file_hash, status))
-            file_id = cur.fetchone()[0]
-            conn.commit()
-            logging.info(f"Ingested file record created with ID: {file_id}")
-            return file_id
+            cur.execute("SELECT keywords FROM topic_lexicon WHERE id = 1;")
+            result = cur.fetchone()
+            if result and result[0] is not None:
+                return [line for line in result[0].splitlines() if line.strip()]
+            return None
     except Exception as e:
-        logging.error(f"Error inserting ingested file: {e}")
+        logging.error(f"Error fetching topic keywords: {e}")
         return None
     finally:
         if conn:
             conn.close()
 
-def update_ingested_file_status(file_id, status, chunks_count=None, error_message=None):
-    """Update the status of an ingested file"""
+def update_topic_keywords(keywords):
+    """Save the deployment's topic keywords (one per line)"""
     conn = get_connection()
     if conn is None:
         logging.error("Failed to connect to the database.")
@@ -268,28 +447,104 @@ def update_ingested_file_status(file_id, status, chunks_count=None, error_messag
 
     try:
         with conn.cursor() as cur:
-            if chunks_count is not None:
-                cur.execute("""
-                    UPDATE ingested_files
-                    SET status = %s, chunks_count = %s, error_message = %s
-                    WHERE id = %s;
-                """, (status, chunks_count, error_message, file_id))
-            else:
-                cur.execute("""
-                    UPDATE ingested_files
-                    SET status = %s, error_message = %s
-                    WHERE id = %s;
-                """, (status, error_message, file_id))
+            cur.execute("""
+                INSERT INTO topic_lexicon (id, keywords)
+                VALUES (1, %s)
+                ON CONFLICT (id)
+                DO UPDATE SET keywords = EXCLUDED.keywords;
+            """, ("\n".join(keywords),))
             conn.commit()
-            logging.info(f"Updated ingested file {file_id} status to {status}")
+            logging.info("Topic keywords updated successfully.")
+            # Clear cache only after successful update
+            get_topic_keywords.clear()
             return True
     except Exception as e:
-        logging.error(f"Error updating ingested file status: {e}")
+        logging.error(f"Error updating topic keywords: {e}")
         return False
     finally:
         if conn:
             conn.close()
 
+def insert_ingested_file(file_name, file_path, file_size, file_hash, status='processing'):
+    """Insert a new ingested file record (pooled, so concurrent ingestion threads can call it)"""
+    try:
+        with pooled_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO ingested_files (file_name, file_path, file_size, file_hash, status)
+                    VALUES (%s, %s, %s, %s, %s)
+                    RETURNING id;
+                """, (file_name, file_path, file_size, file_hash, status))
+                file_id = cur.fetchone()[0]
+            conn.commit()
+        logging.info(f"Ingested file record created with ID: {file_id}")
+        get_completed_file_ids.clear()
+        get_corpus_generation.clear()
+        get_rag_stats.clear()
+        return file_id
+    except Exception as e:
+        logging.error(f"Error inserting ingested file: {e}")
+        return None
+
+def update_ingested_file_status(file_id, status, chunks_count=None, error_message=None):
+    """Update the status of an ingested file (pooled, so concurrent ingestion threads can call it)"""
+    try:
+        with pooled_connection() as conn:
+            with conn.cursor() as cur:
+                if chunks_count is not None:
+                    cur.execute("""
+                        UPDATE ingested_files
+                        SET status = %s, chunks_count = %s, error_message = %s
+                        WHERE id = %s;
+                    """, (status, chunks_count, error_message, file_id))
+                else:
+                    cur.execute("""
+                        UPDATE ingested_files
+                        SET status = %s, error_message = %s
+                        WHERE id = %s;
+                    """, (status, error_message, file_id))
+            conn.commit()
+            _bump_corpus_generation(conn)
+        logging.info(f"Updated ingested file {file_id} status to {status}")
+        get_completed_file_ids.clear()
+        get_rag_stats.clear()
+        return True
+    except Exception as e:
+        logging.error(f"Error updating ingested file status: {e}")
+        return False
+
+def complete_ingested_file(conn, file_id, chunks_count, error_message=None):
+    """
+    Store a file's chunk aggregates and mark it completed, committing the caller's transaction
+    Used by ingestion so a file's chunks and its completed status become visible together
+    """
+    with conn.cursor() as cur:
+        _write_file_aggregates(cur, [file_id])
+        cur.execute("""
+            UPDATE ingested_files
+            SET status = 'completed', chunks_count = %s, error_message = %s
+            WHERE id = %s;
+        """, (chunks_count, error_message, file_id))
+    conn.commit()
+    _bump_corpus_generation(conn)
+    logging.info(f"Updated ingested file {file_id} status to completed")
+    get_completed_file_ids.clear()
+    get_rag_stats.clear()
+
+def _bump_corpus_generation(conn):
+    """
+    Advance the corpus generation after a committed corpus change
+    The trigger's nextval() is visible before its transaction commits, so a reader can cache results
+    from the old corpus under the new generation; a bump after commit retires those entries
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT nextval('rag_corpus_generation_seq');")
+        conn.commit()
+    except Exception as e:
+        logging.warning(f"Error bumping corpus generation: {e}")
+    get_corpus_generation.clear()
+
 def get_ingested_files():
     """Get all ingested files"""
     conn = get_connection()
@@ -301,7 +556,7 @@ def get_ingested_files():
         with conn.cursor() as cur:
             cur.execute("""
                 SELECT id, file_name, file_path, file_size, chunks_count,
-                       ingested_at, status, error_message
+                       ingested_at, status, error_message, search_page_start, search_page_end
                 FROM ingested_files
                 ORDER BY ingested_at DESC;
             """)
@@ -314,7 +569,9 @@ def get_ingested_files():
                 'chunks_count': row[4],
                 'ingested_at': row[5],
                 'status': row[6],
-                'error_message': row[7]
+                'error_message': row[7],
+                'search_page_start': row[8],
+                'search_page_end': row[9]
             } for row in files]
     except Exception as e:
         logging.error(f"Error fetching ingested files: {e}")
@@ -323,6 +580,246 @@ def get_ingested_files():
         if conn:
             conn.close()
 
+def update_file_page_range(file_id, page_start, page_end):
+    """Restrict searches of a file to a page range (None for an open end, both None for all pages)"""
+    conn = get_connection()
+    if conn is None:
+        logging.error("Failed to connect to the database.")
+        return False
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE ingested_files
+                SET search_page_start = %s, search_page_end = %s
+                WHERE id = %s;
+            """, (page_start, page_end, file_id))
+            conn.commit()
+            _bump_corpus_generation(conn)
+            get_file_page_ranges.clear()
+            return True
+    except Exception as e:
+        logging.error(f"Error updating file page range: {e}")
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+@st.cache_data(ttl=60)  # Cache for 1 minute, cleared when a page range changes
+def get_file_page_ranges():
+    """Get {file_id: (page_start, page_end)} for files whose searches are restricted to a page range"""
+    conn = get_connection()
+    if conn is None:
+        logging.error("Failed to connect to the database.")
+        return {}
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT id, search_page_start, search_page_end
+                FROM ingested_files
+                WHERE search_page_start IS NOT NULL OR search_page_end IS NOT NULL;
+            """)
+            return {row[0]: (row[1], row[2]) for row in cur.fetchall()}
+    except Exception as e:
+        logging.error(f"Error fetching file page ranges: {e}")
+        return {}
+    finally:
+        if conn:
+            conn.close()
+
+@st.cache_data(ttl=60)  # Cache for 1 minute, cleared when ingested files change
+def get_completed_file_ids():
+    """Get IDs of all successfully ingested files (the default search scope)"""
+    conn = get_connection()
+    if conn is None:
+        logging.error("Failed to connect to the database.")
+        return []
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id FROM ingested_files WHERE status = 'completed' ORDER BY id;")
+            return [row[0] for row in cur.fetchall()]
+    except Exception as e:
+        logging.error(f"Error fetching completed file IDs: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+@st.cache_data(ttl=5)  # Short TTL picks up changes made by other processes (e.g. process_pdf.py)
+def get_corpus_generation():
+    """Get the RAG corpus generation counter, or None if it is unavailable"""
+    conn = get_connection()
+    if conn is None:
+        logging.error("Failed to connect to the database.")
+        return None
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT last_value FROM rag_corpus_generation_seq;")
+            result = cur.fetchone()
+            return result[0] if result else None
+    except Exception as e:
+        logging.error(f"Error fetching corpus generation: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+# Per-file chunk aggregates, computed once per file instead of on every read
+FILE_AGGREGATES_SQL = """
+    SELECT file_id,
+           AVG(embedding)::real[] AS centroid,
+           COUNT(*) AS stored_chunks,
+           SUM(LENGTH(content)) AS total_chars,
+           MIN(LENGTH(content)) AS min_chunk_chars,
+           MAX(LENGTH(content)) AS max_chunk_chars
+    FROM rag_chunks
+    WHERE file_id = ANY(%s)
+    GROUP BY file_id
+"""
+
+def _write_file_aggregates(cur, file_ids):
+    """Store chunk aggregates (centroid, counts, lengths) on the given ingested_files records"""
+    cur.execute(f"""
+        UPDATE ingested_files f
+        SET centroid = a.centroid,
+            stored_chunks = a.stored_chunks,
+            total_chars = a.total_chars,
+            min_chunk_chars = a.min_chunk_chars,
+            max_chunk_chars = a.max_chunk_chars
+        FROM ({FILE_AGGREGATES_SQL}) a
+        WHERE f.id = a.file_id;
+    """, (list(file_ids),))
+
+def _backfill_file_aggregates(cur):
+    """Compute aggregates once for completed files ingested before they were stored"""
+    cur.execute("""
+        SELECT f.id FROM ingested_files f
+        WHERE f.status = 'completed' AND f.centroid IS NULL
+          AND EXISTS (SELECT 1 FROM rag_chunks c WHERE c.file_id = f.id);
+    """)
+    missing = [row[0] for row in cur.fetchall()]
+    if missing:
+        logging.info(f"Backfilling chunk aggregates for {len(missing)} files")
+        _write_file_aggregates(cur, missing)
+    return bool(missing)
+
+def get_file_centroids():
+    """Get (file_id, chunk_count, centroid) for every completed file, plus chunks without a file"""
+    conn = get_connection()
+    if conn is None:
+        logging.error("Failed to connect to the database.")
+        return []
+
+    try:
+        with conn.cursor() as cur:
+            if _backfill_file_aggregates(cur):
+                conn.commit()
+
+            cur.execute("""
+                SELECT id, stored_chunks, centroid
+                FROM ingested_files
+                WHERE status = 'completed' AND centroid IS NOT NULL
+                UNION ALL
+                SELECT NULL, COUNT(*), AVG(embedding)::real[]
+                FROM rag_chunks
+                WHERE file_id IS NULL
+                HAVING COUNT(*) > 0;
+            """)
+            return cur.fetchall()
+    except Exception as e:
+        logging.error(f"Error fetching file centroids: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+@st.cache_data(ttl=60)  # Cache for 1 minute, cleared when ingested files change
+def get_rag_stats():
+    """Get RAG corpus statistics from the per-file aggregates of completed files"""
+    conn = get_connection()
+    if conn is None:
+        return {"error": "Cannot connect to database"}
+
+    try:
+        with conn.cursor() as cur:
+            if _backfill_file_aggregates(cur):
+                conn.commit()
+
+            # Chunks stored before files were tracked have no aggregates (uses the file_id index)
+            cur.execute("""
+                SELECT SUM(chunks), SUM(chars), MIN(min_chars), MAX(max_chars)
+                FROM (
+                    SELECT stored_chunks AS chunks, total_chars AS chars,
+                           min_chunk_chars AS min_chars, max_chunk_chars AS max_chars
+                    FROM ingested_files
+                    WHERE status = 'completed'
+                    UNION ALL
+                    SELECT COUNT(*), SUM(LENGTH(content)), MIN(LENGTH(content)), MAX(LENGTH(content))
+                    FROM rag_chunks
+                    WHERE file_id IS NULL
+                ) s;
+            """)
+            chunk_count, total_chars, min_len, max_len = cur.fetchone()
+            chunk_count = int(chunk_count or 0)
+
+            return {
+                "total_chunks": chunk_count,
+                "avg_chunk_length": int(total_chars) // chunk_count if chunk_count else 0,
+                "min_chunk_length": min_len or 0,
+                "max_chunk_length": max_len or 0
+            }
+    except Exception as e:
+        logging.error(f"Error fetching RAG stats: {e}")
+        return {"error": str(e)}
+    finally:
+        if conn:
+            conn.close()
+
+def log_relevance_gate_scores(rows):
+    """
+    Record relevance gate scores alongside the outcome of the searches they preceded, in one statement
+    Rows are (centroid_similarity, best_similarity, found_context, sample_weight); pooled, since the
+    RAG handler writes them from a background thread
+    """
+    if not rows:
+        return
+    try:
+        with pooled_connection() as conn:
+            with conn.cursor() as cur:
+                execute_values(cur, """
+                    INSERT INTO rag_gate_scores (centroid_similarity, best_similarity, found_context, sample_weight)
+                    VALUES %s;
+                """, rows)
+            conn.commit()
+    except Exception as e:
+        logging.error(f"Error logging relevance gate scores: {e}")
+
+def get_relevance_gate_scores(limit=2000):
+    """Get the most recent (centroid_similarity, found_context, sample_weight) rows"""
+    conn = get_connection()
+    if conn is None:
+        logging.error("Failed to connect to the database.")
+        return []
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT centroid_similarity, found_context, sample_weight
+                FROM rag_gate_scores
+                ORDER BY id DESC
+                LIMIT %s;
+            """, (limit,))
+            return cur.fetchall()
+    except Exception as e:
+        logging.error(f"Error fetching relevance gate scores: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
+
 def delete_ingested_file(file_id):
     """Delete an ingested file record and its associated chunks"""
     conn = get_connection()
@@ -345,7 +842,10 @@ def delete_ingested_file(file_id):
             # Delete the file record (CASCADE will handle file_selections)
             cur.execute("DELETE FROM ingested_files WHERE id = %s", (file_id,))
             conn.commit()
+            _bump_corpus_generation(conn)
             logging.info(f"Deleted ingested file record: {result[0]}")
+            get_completed_file_ids.clear()
+            get_rag_stats.clear()
             return True
     except Exception as e:
         logging.error(f"Error deleting ingested file: {e}")
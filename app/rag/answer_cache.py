@@ -0,0 +1,151 @@
+"""
+Semantic Answer Cache
+Serves stored answers to near-duplicate first-turn questions without calling the chat model
+"""
+
+import hashlib
+import logging
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import streamlit as st
+
+logger = logging.getLogger(__name__)
+
+
+def instructions_version(instructions: str) -> str:
+    """Short, stable identifier for a set of custom instructions"""
+    return hashlib.sha256((instructions or "").encode()).hexdigest()[:16]
+
+
+class SemanticAnswerCache:
+    """
+    Process-wide cache of (query embedding, instructions version, selected files) -> answer
+    Entries are bucketed by instructions version and file set, so a lookup only compares
+    the query against answers produced under the same instructions and materials
+    """
+
+    def __init__(self, enabled: bool = False, max_distance: float = 0.05,
+                 ttl_seconds: int = 3600, max_entries_per_bucket: int = 200):
+        self.enabled = enabled
+        self.max_distance = max_distance  # Maximum cosine distance for a hit
+        self.ttl_seconds = ttl_seconds
+        self.max_entries_per_bucket = max_entries_per_bucket
+        self._lock = threading.Lock()
+        self._buckets: Dict[Tuple[str, Tuple[int, ...]], dict] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    @staticmethod
+    def _bucket_key(version: str, file_ids: Iterable[int]) -> Tuple[str, Tuple[int, ...]]:
+        return version, tuple(sorted(set(file_ids)))
+
+    def _expire(self, bucket: dict, now: float):
+        """Drop entries older than the TTL (entries are stored oldest first)"""
+        created = bucket['created']
+        expired = 0
+        while expired < len(created) and now - created[expired] > self.ttl_seconds:
+            expired += 1
+        if expired:
+            bucket['embeddings'] = bucket['embeddings'][expired:]
+            del bucket['answers'][:expired]
+            del created[:expired]
+
+    def lookup(self, embedding: List[float], version: str, file_ids: Iterable[int]) -> Optional[str]:
+        """Return a cached answer for a semantically equivalent question, if any"""
+        query = self._normalize(embedding)
+        key = self._bucket_key(version, file_ids)
+
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                self._expire(bucket, time.time())
+
+            if bucket is None or not bucket['answers']:
+                self.misses += 1
+                return None
+
+            similarities = bucket['embeddings'] @ query
+            best = int(np.argmax(similarities))
+            distance = 1.0 - float(similarities[best])
+
+            if distance > self.max_distance:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            logger.info(f"Semantic cache hit (distance {distance:.4f})")
+            return bucket['answers'][best]
+
+    def store(self, embedding: List[float], version: str, file_ids: Iterable[int], answer: str):
+        """Cache an answer for later near-duplicate questions"""
+        if not answer:
+            return
+
+        vector = self._normalize(embedding)[np.newaxis, :]
+        key = self._bucket_key(version, file_ids)
+
+        with self._lock:
+            bucket = self._buckets.setdefault(key, {
+                'embeddings': np.empty((0, vector.shape[1]), dtype=np.float32),
+                'answers': [],
+                'created': []
+            })
+            bucket['embeddings'] = np.vstack([bucket['embeddings'], vector])
+            bucket['answers'].append(answer)
+            bucket['created'].append(time.time())
+
+            # Bound memory by evicting the oldest entries first
+            overflow = len(bucket['answers']) - self.max_entries_per_bucket
+            if overflow > 0:
+                bucket['embeddings'] = bucket['embeddings'][overflow:]
+                del bucket['answers'][:overflow]
+                del bucket['created'][:overflow]
+
+    def invalidate(self, version: Optional[str] = None) -> int:
+        """Drop cached answers for one instructions version (or all if None), returns entries removed"""
+        with self._lock:
+            keys = [key for key in self._buckets if version is None or key[0] == version]
+            removed = sum(len(self._buckets[key]['answers']) for key in keys)
+            for key in keys:
+                del self._buckets[key]
+
+        if removed:
+            logger.info(f"Invalidated {removed} cached answers")
+        return removed
+
+    def get_stats(self) -> dict:
+        """Hit-rate metrics for the admin panel"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": sum(len(bucket['answers']) for bucket in self._buckets.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+    @staticmethod
+    def stream(answer: str, delay: float = 0.01) -> Iterator[str]:
+        """Yield a cached answer word by word so it renders like a streamed completion"""
+        for i, word in enumerate(answer.split(" ")):
+            yield (" " if i else "") + word
+            if delay:
+                time.sleep(delay)
+
+
+# Global answer cache instance (opt-in via SEMANTIC_CACHE_ENABLED in secrets)
+answer_cache = SemanticAnswerCache(
+    enabled=bool(st.secrets.get("SEMANTIC_CACHE_ENABLED", False)),
+    max_distance=float(st.secrets.get("SEMANTIC_CACHE_MAX_DISTANCE", 0.05)),
+    ttl_seconds=int(st.secrets.get("SEMANTIC_CACHE_TTL_SECONDS", 3600))
+)
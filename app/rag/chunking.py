@@ -0,0 +1,122 @@
+"""
+Token-Offset Chunking
+Splits text into chunks of at most max_tokens by walking the token offsets of a single encoding
+pass, snapping chunk ends back to sentence boundaries and optionally overlapping chunks.
+iter_chunks() does the same over a stream of text pieces (e.g. pages), holding only a few chunks
+of text at a time
+"""
+
+import re
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+# A sentence ends after terminal punctuation (and closing quotes or brackets) followed by
+# whitespace, or at a paragraph break (matched on UTF-8 bytes, the unit of token offsets)
+SENTENCE_END = re.compile(rb"([.!?][\"')\]]*)\s+|\n\s*\n")
+
+# Tokens at the end of a streamed buffer that are not chunked yet, since the next piece can still
+# change how they tokenize or where a sentence ends
+STREAM_MARGIN_TOKENS = 16
+
+
+def sentence_boundaries(data: bytes, offsets: List[int]) -> List[int]:
+    """
+    Token indices at which a new sentence starts, ascending (offsets are token start bytes)
+    A boundary is the first token after the punctuation, not after the whitespace that follows
+    it, since BPE encodings put that space inside the next word's token (" The")
+    """
+    boundaries = []
+    for match in SENTENCE_END.finditer(data):
+        index = bisect_left(offsets, match.end(1) if match.group(1) else match.start())
+        if index < len(offsets) and (not boundaries or boundaries[-1] != index):
+            boundaries.append(index)
+    return boundaries
+
+
+def _split(text: str, encoding, max_tokens: int, overlap_tokens: int, min_fill: float,
+           final: bool) -> Tuple[List[str], str]:
+    """
+    Chunks of text, and the tail left to chunk once more text follows (empty when final)
+    A chunk is only cut from a non-final buffer when its whole max_tokens window is in it
+    """
+    tokens = encoding.encode(text)
+    if not tokens:
+        return [], ""
+    data = text.encode("utf-8")
+    offsets = list(accumulate(map(len, encoding.decode_tokens_bytes(tokens)), initial=0))
+    boundaries = sentence_boundaries(data, offsets[:-1])
+    min_length = max(1, int(max_tokens * min_fill))
+    limit = len(tokens) - STREAM_MARGIN_TOKENS
+
+    chunks = []
+    start = 0
+    while start < len(tokens):
+        if not final and start + max_tokens > limit:
+            break
+        end = min(start + max_tokens, len(tokens))
+        if end < len(tokens):
+            # Last sentence start within (start + min_length, end]
+            i = bisect_right(boundaries, end) - 1
+            if i >= 0 and boundaries[i] >= start + min_length:
+                end = boundaries[i]
+
+        # A cut inside a multi-byte character (only at a hard token cap) drops that character
+        chunk = data[offsets[start]:offsets[end]].decode("utf-8", errors="ignore").strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(tokens):
+            return chunks, ""
+
+        next_start = end
+        if overlap_tokens:
+            next_start = end - overlap_tokens
+            i = bisect_left(boundaries, next_start)
+            if i < len(boundaries) and boundaries[i] < end:
+                next_start = boundaries[i]
+        start = max(next_start, start + 1)
+    return chunks, data[offsets[start]:].decode("utf-8", errors="ignore")
+
+
+def _check_sizes(max_tokens: int, overlap_tokens: int) -> int:
+    """Validate max_tokens and return overlap_tokens clamped to [0, max_tokens // 2]"""
+    if max_tokens <= 0:
+        raise ValueError("max_tokens must be positive")
+    return max(0, min(overlap_tokens, max_tokens // 2))
+
+
+def chunk_text(text: str, encoding, max_tokens: int, overlap_tokens: int = 0,
+               min_fill: float = 0.5) -> List[str]:
+    """
+    Split text into chunks of at most max_tokens tokens (as tokenized in the whole text)
+    The text is encoded once and token byte offsets come from the tokens' own bytes. Each chunk
+    ends at the last sentence boundary that keeps it at least min_fill full, or exactly at the
+    token cap when there is none (so overlong sentences are cut).
+    Consecutive chunks share up to overlap_tokens tokens, starting at a sentence boundary when one
+    falls inside the overlap. Runs in O(n log n) in the text length
+    """
+    overlap_tokens = _check_sizes(max_tokens, overlap_tokens)
+    return _split(text, encoding, max_tokens, overlap_tokens, min_fill, final=True)[0]
+
+
+def iter_chunks(pieces: Iterable[str], encoding, max_tokens: int, overlap_tokens: int = 0,
+                min_fill: float = 0.5, buffer_chars: Optional[int] = None) -> Iterator[str]:
+    """
+    Chunk a stream of text pieces (e.g. pages) as they arrive, with chunk_text()'s rules
+    Pieces are joined into a buffer of about buffer_chars characters (default 8 * max_tokens), the
+    complete chunks in it are yielded, and only the unfinished tail is carried into the next buffer,
+    so memory is bounded by the buffer rather than the whole text. Chunks span piece boundaries
+    """
+    overlap_tokens = _check_sizes(max_tokens, overlap_tokens)
+    buffer_chars = buffer_chars or 8 * max_tokens
+
+    buffer: List[str] = []
+    buffered = 0
+    for piece in pieces:
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= buffer_chars:
+            chunks, tail = _split("".join(buffer), encoding, max_tokens, overlap_tokens, min_fill, final=False)
+            yield from chunks
+            buffer, buffered = [tail], len(tail)
+    yield from _split("".join(buffer), encoding, max_tokens, overlap_tokens, min_fill, final=True)[0]
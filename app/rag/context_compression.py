@@ -0,0 +1,100 @@
+"""
+Context Compression
+Extractive compression of retrieved chunks: sentences are scored against the query and only
+the highest-value ones are packed into the context token budget
+"""
+
+import math
+import re
+from collections import Counter
+from typing import List
+
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+|\n{2,}")
+WORD = re.compile(r"\w+")
+GAP_MARKER = " … "
+
+# Words too common to say anything about relevance
+STOPWORDS = frozenset("""
+a an and are as at be by can do does for from how in is it its of on or that the this to
+was what when where which who why will with you your i me my we our explain describe
+""".split())
+
+
+def split_sentences(text: str) -> List[str]:
+    """Split text into sentences (and paragraph breaks), dropping empty pieces"""
+    return [sentence.strip() for sentence in SENTENCE_BOUNDARY.split(text) if sentence.strip()]
+
+
+def terms(text: str) -> List[str]:
+    """Lowercased content words of a text"""
+    return [word for word in WORD.findall(text.lower()) if word not in STOPWORDS]
+
+
+def compress_chunks(query: str, chunks: List[dict], token_budget: int,
+                    similarity_weight: float = 0.1) -> List[dict]:
+    """
+    Keep the sentences of the chunks that best match the query, within token_budget
+    Sentences are scored by IDF-weighted query term overlap (IDF over all candidate sentences),
+    normalized for length, plus the chunk's similarity as a tie-breaker. Matching sentences are
+    packed first, then their neighbours. Token costs are estimated from each chunk's stored
+    token_count, so nothing is re-tokenized.
+    Returns chunk dicts (same keys) whose content is the kept sentences in their original order,
+    with gaps marked; chunks with no kept sentence are dropped
+    """
+    query_terms = set(terms(query))
+    sentences = []  # (chunk index, sentence index, text, term set, estimated tokens)
+    for chunk_index, chunk in enumerate(chunks):
+        content = chunk['content']
+        token_count = chunk.get('token_count') or max(1, len(content) // 4)
+        for sentence_index, sentence in enumerate(split_sentences(content)):
+            estimate = max(1, math.ceil(token_count * len(sentence) / max(len(content), 1)))
+            sentences.append((chunk_index, sentence_index, sentence, set(terms(sentence)), estimate))
+
+    if not sentences or token_budget <= 0:
+        return []
+
+    document_frequency = Counter(term for sentence in sentences for term in sentence[3] & query_terms)
+    idf = {term: math.log((len(sentences) + 1) / (count + 1)) + 1 for term, count in document_frequency.items()}
+
+    def lexical(sentence: tuple) -> float:
+        sentence_terms = sentence[3]
+        overlap = sum(idf[term] for term in sentence_terms & query_terms)
+        return overlap / (1 + math.log1p(len(sentence_terms)))
+
+    def score(sentence: tuple) -> float:
+        return lexical(sentence) + similarity_weight * chunks[sentence[0]]['similarity']
+
+    kept = set()
+    used = 0
+
+    def pack(candidates: List[tuple]):
+        nonlocal used
+        for sentence in sorted(candidates, key=score, reverse=True):
+            if used + sentence[4] <= token_budget:
+                kept.add((sentence[0], sentence[1]))
+                used += sentence[4]
+
+    # Sentences matching the query first, then their neighbours for context;
+    # if nothing matches lexically, fall back to the chunks' similarity order
+    matched = [sentence for sentence in sentences if lexical(sentence) > 0]
+    pack(matched or sentences)
+    pack([sentence for sentence in sentences
+          if (sentence[0], sentence[1]) not in kept
+          and ((sentence[0], sentence[1] - 1) in kept or (sentence[0], sentence[1] + 1) in kept)])
+
+    compressed = []
+    for chunk_index, chunk in enumerate(chunks):
+        parts, tokens, previous = [], 0, None
+        for index, sentence_index, text, _, estimate in sentences:
+            if index != chunk_index or (index, sentence_index) not in kept:
+                continue
+            if previous is not None and sentence_index != previous + 1:
+                parts.append(GAP_MARKER)
+            elif parts:
+                parts.append(" ")
+            parts.append(text)
+            tokens += estimate
+            previous = sentence_index
+        if parts:
+            compressed.append(dict(chunk, content="".join(parts), token_count=tokens))
+    return compressed
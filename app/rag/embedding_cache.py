@@ -0,0 +1,80 @@
+"""
+Local Embedding Cache
+On-disk SQLite store of embeddings keyed by (embedding model, content hash), consulted before
+any embeddings API call so re-ingesting a corpus (e.g. after a database reset or with --force)
+costs no API calls
+"""
+
+import logging
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingCache:
+    """
+    SQLite table of float32 embedding blobs, shared by the ingestion worker threads
+    Lookups and writes are batched; the hit and miss counts feed the ingestion report
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                PRIMARY KEY (model, content_hash)
+            ) WITHOUT ROWID
+        """)
+        self._conn.commit()
+
+    def get_many(self, model: str, content_hashes: Iterable[str]) -> Dict[str, List[float]]:
+        """Cached embeddings for the given hashes, as {content_hash: embedding}"""
+        content_hashes = list(dict.fromkeys(content_hashes))
+        found = {}
+        with self._lock:
+            # Stay below SQLite's bound-parameter limit
+            for start in range(0, len(content_hashes), 500):
+                batch = content_hashes[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT content_hash, embedding FROM embeddings "
+                    f"WHERE model = ? AND content_hash IN ({','.join('?' * len(batch))})",
+                    [model, *batch]).fetchall()
+                for content_hash, blob in rows:
+                    found[content_hash] = np.frombuffer(blob, dtype=np.float32).tolist()
+            self.hits += len(found)
+            self.misses += len(content_hashes) - len(found)
+        return found
+
+    def put_many(self, model: str, items: Sequence[Tuple[str, Sequence[float]]]):
+        """Store (content_hash, embedding) pairs, replacing existing entries"""
+        rows = [(model, content_hash, np.asarray(embedding, dtype=np.float32).tobytes())
+                for content_hash, embedding in items]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, content_hash, embedding) VALUES (?, ?, ?)", rows)
+            self._conn.commit()
+
+    def count(self, model: Optional[str] = None) -> int:
+        """Number of cached embeddings, for one model or all"""
+        with self._lock:
+            if model is None:
+                return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings WHERE model = ?", (model,)).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,184 @@
+"""
+PDF Text Extraction
+Extracts page text with PyPDF2, splitting large documents on disk into page ranges that are
+extracted in parallel worker processes, and yields it page by page (or joins it once) in page order.
+A ParsedPdf holds one upload's bytes and parser so validation, hashing and extraction share a
+single parse
+"""
+
+import hashlib
+import io
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import islice
+from typing import Iterator, List, Optional, Tuple, Union
+
+import PyPDF2
+
+logger = logging.getLogger(__name__)
+
+PdfSource = Union[str, bytes]  # A file path, or the file's bytes for in-memory uploads
+
+
+def _open_reader(source: PdfSource) -> PyPDF2.PdfReader:
+    return PyPDF2.PdfReader(io.BytesIO(source) if isinstance(source, bytes) else source)
+
+
+class ParsedPdf:
+    """
+    A PDF document parsed at most once, shared by validation, hashing and extraction
+    Parsing is deferred until the reader is first needed, so size checks cost nothing
+    """
+
+    def __init__(self, data: bytes, path: Optional[str] = None):
+        self.data = data
+        self.path = path  # Workers re-open the file from here instead of receiving the bytes
+        self._reader = None
+        self._sha256 = None
+
+    @classmethod
+    def from_path(cls, path: str) -> "ParsedPdf":
+        with open(path, "rb") as f:
+            return cls(f.read(), path)
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+    @property
+    def reader(self) -> PyPDF2.PdfReader:
+        if self._reader is None:
+            # BytesIO shares an immutable bytes buffer rather than copying it
+            self._reader = PyPDF2.PdfReader(io.BytesIO(self.data))
+        return self._reader
+
+    @property
+    def pages(self) -> int:
+        return len(self.reader.pages)
+
+    @property
+    def is_encrypted(self) -> bool:
+        return self.reader.is_encrypted
+
+    @property
+    def sha256(self) -> str:
+        if self._sha256 is None:
+            self._sha256 = hashlib.sha256(self.data).hexdigest()
+        return self._sha256
+
+    @property
+    def source(self) -> PdfSource:
+        """What extraction opens: the path when there is one, otherwise the bytes"""
+        return self.path or self.data
+
+    def close(self):
+        """Drop the bytes and parser so the upload can be freed"""
+        self.data = b""
+        self._reader = None
+
+
+def _read_page_range(reader: PyPDF2.PdfReader, start: int, end: int) -> List[Tuple[Optional[str], Optional[str]]]:
+    results = []
+    for page in reader.pages[start:end]:
+        try:
+            results.append((page.extract_text(), None))
+        except Exception as e:
+            results.append((None, str(e)))
+        finally:
+            # The reader caches every object it resolves, including image streams the text
+            # extractor touches; dropping them per page keeps memory flat in the document size
+            reader.resolved_objects.clear()
+    return results
+
+
+# Each worker process parses the document once, on its first range
+_worker_source: Optional[PdfSource] = None
+_worker_reader: Optional[PyPDF2.PdfReader] = None
+
+
+def _init_worker(source: PdfSource):
+    global _worker_source
+    _worker_source = source
+
+
+def _extract_worker_range(start: int, end: int) -> List[Tuple[Optional[str], Optional[str]]]:
+    global _worker_reader
+    if _worker_reader is None:
+        _worker_reader = _open_reader(_worker_source)
+    return _read_page_range(_worker_reader, start, end)
+
+
+def page_ranges(pages: int, workers: int, ranges_per_worker: int = 4) -> List[Tuple[int, int]]:
+    """Split pages into contiguous (start, end) ranges, a few per worker to even out slow pages"""
+    count = max(1, min(pages, workers * ranges_per_worker))
+    size = -(-pages // count)
+    return [(start, min(start + size, pages)) for start in range(0, pages, size)]
+
+
+def _page_results(reader: PyPDF2.PdfReader, worker_source: PdfSource, workers: int, min_parallel_pages: int,
+                  max_range_pages: int) -> Iterator[Tuple[Optional[str], Optional[str]]]:
+    """(text, error) for every page in order, extracted in worker processes for long documents"""
+    pages = len(reader.pages)
+    done = 0
+    # In-memory documents are extracted serially: every worker would need its own copy of the
+    # bytes, so memory would grow with the number of workers
+    if workers > 1 and pages >= min_parallel_pages and not isinstance(worker_source, bytes):
+        # Ranges of at most max_range_pages, with two per worker in flight, bound the pages held at once
+        ranges = page_ranges(pages, workers, ranges_per_worker=max(4, -(-pages // (workers * max_range_pages))))
+        try:
+            # Spawned workers avoid forking a multi-threaded (e.g. Streamlit) process; each opens the
+            # file once, on its first range
+            with ProcessPoolExecutor(max_workers=min(workers, len(ranges)),
+                                     mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=_init_worker, initargs=(worker_source,)) as executor:
+                queued = iter(ranges)
+                in_flight = deque(executor.submit(_extract_worker_range, *page_range)
+                                  for page_range in islice(queued, 2 * workers))
+                while in_flight:
+                    results = in_flight.popleft().result()
+                    for page_range in islice(queued, 1):
+                        in_flight.append(executor.submit(_extract_worker_range, *page_range))
+                    for result in results:
+                        done += 1
+                        yield result
+        except (OSError, BrokenProcessPool) as e:
+            logger.warning(f"Parallel extraction unavailable, extracting serially from page {done + 1}: {e}")
+    for start in range(done, pages):
+        yield from _read_page_range(reader, start, start + 1)
+
+
+def iter_text(source: Union[PdfSource, ParsedPdf], workers: int = 1, min_parallel_pages: int = 50,
+              max_range_pages: int = 16) -> Iterator[str]:
+    """
+    Yield a PDF's text page by page as it is extracted, each page preceded by its marker
+    ("--- Page N ---"), so only the pages in flight are held in memory. Joined and stripped, the
+    pieces are exactly extract_text()'s text. Pages that fail are logged and skipped.
+    A ParsedPdf's existing parser is reused for serial extraction
+    """
+    reader = source.reader if isinstance(source, ParsedPdf) else _open_reader(source)
+    worker_source = source.source if isinstance(source, ParsedPdf) else source
+    separator = ""  # Blank lines go between pages, not before the first
+    for page_num, (page_text, error) in enumerate(_page_results(reader, worker_source, workers,
+                                                                min_parallel_pages, max_range_pages), 1):
+        if error is not None:
+            logger.warning(f"Failed to extract text from page {page_num}: {error}")
+            continue
+        yield f"{separator}--- Page {page_num} ---\n"
+        yield page_text
+        separator = "\n\n"
+
+
+def extract_text(source: Union[PdfSource, ParsedPdf], workers: int = 1,
+                 min_parallel_pages: int = 50) -> Tuple[str, int]:
+    """
+    Extract a PDF's text with page markers ("--- Page N ---"), returns (text, page count)
+    Files with at least min_parallel_pages pages are extracted across workers processes (in-memory
+    documents always serially); the result is identical to a serial extraction
+    """
+    if not isinstance(source, ParsedPdf):
+        source = ParsedPdf(source) if isinstance(source, bytes) else ParsedPdf.from_path(source)
+    text = "".join(iter_text(source, workers=workers, min_parallel_pages=min_parallel_pages)).strip()
+    return text, source.pages
@@ -3,12 +3,23 @@ RAG (Retrieval Augmented Generation) Handler
 Handles similarity search and context retrieval from embedded PDF chunks
 """
 
+import atexit
+import hashlib
 import logging
-from typing import List, Tuple, Optional
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Dict, List, Optional, Tuple
+import numpy as np
 import tiktoken
 from openai import OpenAI
 import streamlit as st
-from app.db.database_connection import get_connection, get_ingested_files, delete_ingested_file, get_selected_file_ids, get_user_file_selections, update_user_file_selection
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from app.rag.topic_router import DEFAULT_TOPIC_KEYWORDS, get_topic_router, normalize_keywords
+from app.rag.relevance_gate import CentroidRelevanceGate
+from app.rag.context_compression import compress_chunks
+from app.db.database_connection import pooled_connection, private_connections, get_ingested_files, delete_ingested_file, get_selected_file_ids, get_user_file_selections, update_user_file_selection, get_completed_file_ids, get_corpus_generation, get_topic_keywords, get_file_centroids, log_relevance_gate_scores, get_relevance_gate_scores, get_rag_stats, get_file_page_ranges, update_file_page_range
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +29,43 @@ class RAGHandler:
         self.encoding = tiktoken.get_encoding("cl100k_base")
         self.embedding_model = "text-embedding-ada-002"
         self.max_context_tokens = 4000  # Reserve tokens for context
+        # Upper bound for the per-source wrapper added around each chunk in build_context
+        self.source_overhead_tokens = self.count_tokens("**Source 100** (relevance: 100.0%):\n\n\n")
+        self._file_name_tokens = {}  # Token count of each cited file name, computed once per file
+        self.use_hybrid_search = True
+        self.rrf_k = 60  # Reciprocal rank fusion damping constant
+        self.hybrid_candidates = 20  # Candidates taken from each ranking before fusion
+        self.mmr_lambda = 0.7  # Relevance vs. novelty trade-off when diversifying context
+        self.mmr_oversample = 3  # Candidates fetched per context chunk for diversification
+        self.duplicate_similarity = 0.95  # Chunks this similar to an included chunk are dropped
+        self.children_per_parent = 3  # Child matches fetched per parent window returned (small-to-big)
+        # Retrieved chunks larger than this are compressed to their most query-relevant sentences (0 disables);
+        # by default only context that would overflow max_context_tokens is compressed
+        self.compressed_context_tokens = int(st.secrets.get("RAG_COMPRESSED_CONTEXT_TOKENS", self.max_context_tokens))
+        # Bounded LRU cache of final context strings, invalidated by the corpus generation
+        self.context_cache_size = 256
+        self._context_cache = OrderedDict()
+        self._context_cache_lock = threading.Lock()
+        # Embedding-centroid gate that skips searches for off-topic prompts
+        self.relevance_gate = CentroidRelevanceGate()
+        self.gate_refresh_seconds = 600  # How often the gate threshold is re-learned
+        self.route_top_files = 8  # Files searched per query when more are in scope (0 disables routing)
+        self.filtered_ef_search = 200  # HNSW candidate list for searches filtered by file or page (default 40)
+        self._gate_refreshed_at = 0.0
+        # Gate scores are written in batches by one background thread, off the retrieval path
+        self._gate_log = []
+        self._gate_log_pending = False
+        self._gate_log_lock = threading.Lock()
+        self._gate_log_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rag-gate-log")
+        # Background retrieval so search overlaps rendering, with a hard latency budget
+        self.retrieval_deadline_seconds = float(st.secrets.get("RAG_DEADLINE_SECONDS", 2.0))
+        self._retrieval_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="rag-retrieval")
+        self._retrieval_metrics_lock = threading.Lock()
+        self._retrieval_latencies = deque(maxlen=1000)  # Seconds, for completed retrievals
+        self._retrieval_counts = {'started': 0, 'completed': 0, 'timed_out': 0, 'failed': 0}
+        # One upload processor per process, so uploads share its rate limiter and embedding cache
+        self._upload_processor = None
+        self._upload_processor_lock = threading.Lock()
         
     def get_query_embedding(self, query: str) -> List[float]:
         """Get embedding for user query"""
@@ -32,70 +80,305 @@ class RAGHandler:
             logger.error(f"Failed to get query embedding: {e}")
             raise
     
-    def similarity_search(self, query_embedding: List[float], limit: int = 5, user_name: str = None) -> List[Tuple[str, float]]:
+    def get_query_embeddings(self, queries: List[str]) -> List[List[float]]:
+        """Get embeddings for several queries in a single API call"""
+        if not queries:
+            return []
+        try:
+            response = self.client.embeddings.create(
+                model=self.embedding_model,
+                input=list(queries)
+            )
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+        except Exception as e:
+            logger.error(f"Failed to get query embeddings: {e}")
+            raise
+
+    def similarity_search(self, query_embedding: List[float], limit: int = 5, user_name: str = None,
+                          file_ids: Optional[List[int]] = None,
+                          page_ranges: Optional[Dict[int, tuple]] = None) -> List[dict]:
         """
-        Perform similarity search using cosine similarity
-        Returns list of (content, similarity_score) tuples
-        Filters by user's selected files if user_name is provided
+        Perform similarity search using cosine similarity over child chunks
+        Returns list of parent window dicts with content, similarity, token_count and embedding
+        Filters by file_ids, or by user's selected files if user_name is provided,
+        and by {file_id: (page_start, page_end)} page_ranges
         """
-        conn = get_connection()
-        if conn is None:
-            logger.error("Failed to connect to database for similarity search")
-            return []
+        if file_ids is None and user_name:
+            # Get selected file IDs for this user
+            file_ids = get_selected_file_ids(user_name)
+            if not file_ids:
+                logger.info(f"No files selected for user {user_name}")
+                return []
+
+        return self.similarity_search_many([query_embedding], limit=limit, file_ids=file_ids,
+                                           page_ranges=page_ranges)[0]
+
+    def hybrid_search(self, query: str, query_embedding: List[float], limit: int = 5,
+                      user_name: str = None, file_ids: Optional[List[int]] = None,
+                      page_ranges: Optional[Dict[int, tuple]] = None) -> List[dict]:
+        """
+        Combine full-text and vector search in a single query using reciprocal rank fusion
+        Returns list of chunk dicts (see similarity_search) ordered by fused rank
+        Filters by file_ids, or by user's selected files if user_name is provided,
+        and by {file_id: (page_start, page_end)} page_ranges
+        """
+        if file_ids is None and user_name:
+            file_ids = get_selected_file_ids(user_name)
+            if not file_ids:
+                logger.info(f"No files selected for user {user_name}")
+                return []
+
+        return self.hybrid_search_many([query], [query_embedding], limit=limit, file_ids=file_ids,
+                                       page_ranges=page_ranges)[0]
+
+    def hybrid_search_many(self, queries: List[str], query_embeddings: List[List[float]], limit: int = 5,
+                           file_ids: Optional[List[int]] = None,
+                           page_ranges: Optional[Dict[int, tuple]] = None) -> List[List[dict]]:
+        """
+        Hybrid search for several queries in one round trip (unnest + LATERAL)
+        Returns one list of chunk dicts per query, in query order
+        """
+        if not queries or (file_ids is not None and not file_ids):
+            return [[] for _ in queries]
+
+        file_filter, params = self._chunk_filter(file_ids, page_ranges)
+        params.update({
+            'embeddings': [self._vector_literal(embedding) for embedding in query_embeddings],
+            'queries': list(queries),
+            'candidates': max(self.hybrid_candidates, limit * self.children_per_parent),
+            'rrf_k': self.rrf_k,
+            'limit': limit * self.children_per_parent,
+        })
 
         try:
-            with conn.cursor() as cur:
-                if user_name:
-                    # Get selected file IDs for this user
-                    selected_file_ids = get_selected_file_ids(user_name)
-
-                    if not selected_file_ids:
-                        logger.info(f"No files selected for user {user_name}")
-                        return []
-
-                    # Use pgvector's cosine similarity operator with file filtering
-                    placeholders = ','.join(['%s'] * len(selected_file_ids))
-                    query = f"""
-                        SELECT content, (1 - (embedding <=> %s::vector)) as similarity
-                        FROM rag_chunks
-                        WHERE file_id IN ({placeholders})
-                        ORDER BY embedding <=> %s::vector
-                        LIMIT %s
-                    """
-                    params = [query_embedding] + selected_file_ids + [query_embedding, limit]
-                    cur.execute(query, params)
-                else:
-                    # Original query without filtering
-                    cur.execute("""
-                        SELECT content, (1 - (embedding <=> %s::vector)) as similarity
+            with pooled_connection() as conn, conn.cursor() as cur:
+                if file_filter != "TRUE":
+                    self._widen_filtered_scan(cur, params['candidates'])
+                cur.execute(f"""
+                    SELECT q.idx, r.content, r.similarity, r.token_count, r.embedding, r.id, r.parent_id,
+                           r.file_name, r.page_start, r.page_end, r.score
+                    FROM unnest(%(embeddings)s::vector[], %(queries)s::text[])
+                         WITH ORDINALITY AS q(query_embedding, query_text, idx)
+                    CROSS JOIN LATERAL (
+                        SELECT c.content, (1 - (c.embedding <=> q.query_embedding)) AS similarity,
+                               c.token_count, c.embedding::real[] AS embedding, c.id, c.parent_id,
+                               c.file_name, c.page_start, c.page_end, f.score
+                        FROM (
+                            -- Reciprocal rank fusion of the vector and full-text rankings
+                            SELECT COALESCE(v.id, t.id) AS id,
+                                   COALESCE(1.0 / (%(rrf_k)s + v.rank), 0)
+                                   + COALESCE(1.0 / (%(rrf_k)s + t.rank), 0) AS score
+                            FROM (
+                                SELECT id, ROW_NUMBER() OVER (ORDER BY distance) AS rank
+                                FROM (
+                                    SELECT id, embedding <=> q.query_embedding AS distance
+                                    FROM rag_chunks
+                                    WHERE {file_filter}
+                                    ORDER BY embedding <=> q.query_embedding
+                                    LIMIT %(candidates)s
+                                ) vc
+                            ) v
+                            FULL OUTER JOIN (
+                                SELECT id, ROW_NUMBER() OVER (ORDER BY score DESC) AS rank
+                                FROM (
+                                    SELECT id, ts_rank_cd(content_tsv, tsq) AS score
+                                    FROM rag_chunks, websearch_to_tsquery('english', q.query_text) tsq
+                                    WHERE content_tsv @@ tsq AND {file_filter}
+                                    ORDER BY score DESC
+                                    LIMIT %(candidates)s
+                                ) tc
+                            ) t ON v.id = t.id
+                        ) f
+                        JOIN rag_chunks c ON c.id = f.id
+                        ORDER BY f.score DESC
+                        LIMIT %(limit)s
+                    ) r
+                    ORDER BY q.idx, r.score DESC
+                """, params)
+
+                return self._expand_to_parents(cur, cur.fetchall(), len(queries), limit, file_filter, params)
+
+        except Exception as e:
+            # Older databases may not have the content_tsv column yet
+            logger.warning(f"Hybrid search failed, falling back to vector search: {e}")
+            return self.similarity_search_many(query_embeddings, limit=limit, file_ids=file_ids,
+                                               page_ranges=page_ranges)
+
+    def similarity_search_many(self, query_embeddings: List[List[float]], limit: int = 5,
+                               file_ids: Optional[List[int]] = None,
+                               page_ranges: Optional[Dict[int, tuple]] = None) -> List[List[dict]]:
+        """
+        Vector similarity search for several queries in one round trip (unnest + LATERAL)
+        Returns one list of chunk dicts per query, in query order
+        """
+        if not query_embeddings or (file_ids is not None and not file_ids):
+            return [[] for _ in query_embeddings]
+
+        file_filter, params = self._chunk_filter(file_ids, page_ranges)
+        params.update({
+            'embeddings': [self._vector_literal(embedding) for embedding in query_embeddings],
+            'limit': limit * self.children_per_parent,
+        })
+
+        try:
+            with pooled_connection() as conn, conn.cursor() as cur:
+                if file_filter != "TRUE":
+                    self._widen_filtered_scan(cur, params['limit'])
+                cur.execute(f"""
+                    SELECT q.idx, r.content, r.similarity, r.token_count, r.embedding, r.id, r.parent_id,
+                           r.file_name, r.page_start, r.page_end, NULL AS score
+                    FROM unnest(%(embeddings)s::vector[]) WITH ORDINALITY AS q(query_embedding, idx)
+                    CROSS JOIN LATERAL (
+                        SELECT content, (1 - (embedding <=> q.query_embedding)) AS similarity, token_count,
+                               embedding::real[] AS embedding, id, parent_id, file_name, page_start, page_end
                         FROM rag_chunks
-                        ORDER BY embedding <=> %s::vector
-                        LIMIT %s
-                    """, (query_embedding, query_embedding, limit))
+                        WHERE {file_filter}
+                        ORDER BY embedding <=> q.query_embedding
+                        LIMIT %(limit)s
+                    ) r
+                    ORDER BY q.idx, r.similarity DESC
+                """, params)
 
-                results = cur.fetchall()
-                return [(content, float(similarity)) for content, similarity in results]
+                return self._expand_to_parents(cur, cur.fetchall(), len(query_embeddings), limit,
+                                               file_filter, params)
 
         except Exception as e:
             logger.error(f"Similarity search failed: {e}")
-            return []
-        finally:
-            conn.close()
-    
+            return [[] for _ in query_embeddings]
+
+    @staticmethod
+    def _chunk_filter(file_ids: Optional[List[int]],
+                      page_ranges: Optional[Dict[int, tuple]]) -> Tuple[str, dict]:
+        """
+        WHERE clause (and its parameters) restricting chunks to file_ids and to each file's page range
+        Page ranges are plain comparisons on (file_id, page_start, page_end) so they can use its index;
+        an open end (None) is unbounded, and chunks without page numbers are excluded from ranged files
+        """
+        conditions, params = [], {}
+        if file_ids:
+            conditions.append("file_id = ANY(%(file_ids)s)")
+            params['file_ids'] = list(file_ids)
+
+        ranged = {file_id: pages for file_id, pages in (page_ranges or {}).items()
+                  if not file_ids or file_id in file_ids}
+        if ranged:
+            params['ranged_file_ids'] = list(ranged)
+            alternatives = ["file_id IS NULL", "NOT file_id = ANY(%(ranged_file_ids)s)"]
+            for i, (file_id, (page_start, page_end)) in enumerate(ranged.items()):
+                predicate = [f"file_id = %(range_file_{i})s"]
+                params[f'range_file_{i}'] = file_id
+                if page_start is not None:
+                    predicate.append(f"page_end >= %(range_start_{i})s")
+                    params[f'range_start_{i}'] = page_start
+                if page_end is not None:
+                    predicate.append(f"page_start <= %(range_end_{i})s")
+                    params[f'range_end_{i}'] = page_end
+                alternatives.append("(" + " AND ".join(predicate) + ")")
+            conditions.append("(" + " OR ".join(alternatives) + ")")
+
+        return " AND ".join(conditions) or "TRUE", params
+
+    def _widen_filtered_scan(self, cur, rows: int):
+        """
+        Let HNSW scans in this transaction find enough rows that pass a file or page filter
+        The index yields at most hnsw.ef_search candidates before the filter applies, so a filter
+        keeping a small share of chunks (such as routing) could return fewer than rows results.
+        ef_search is raised, and on pgvector 0.8+ the scan continues until enough rows pass
+        """
+        cur.execute("SELECT set_config('hnsw.ef_search', %s, true)",
+                    (str(min(max(self.filtered_ef_search, rows), 1000)),))
+        cur.execute("SAVEPOINT iterative_scan")
+        try:
+            cur.execute("SET LOCAL hnsw.iterative_scan = strict_order")
+            cur.execute("RELEASE SAVEPOINT iterative_scan")
+        except Exception:
+            # Iterative scans were added in pgvector 0.8.0
+            cur.execute("ROLLBACK TO SAVEPOINT iterative_scan")
+
+    @staticmethod
+    def _vector_literal(embedding: List[float]) -> str:
+        """pgvector text representation, so several vectors can be passed as one vector[]"""
+        return "[" + ",".join(str(float(x)) for x in embedding) + "]"
+
+    def _expand_to_parents(self, cur, rows: List[tuple], query_count: int, limit: int,
+                           file_filter: str = "TRUE", filter_params: Optional[dict] = None) -> List[List[dict]]:
+        """
+        Small-to-big: turn ranked child matches into up to limit parent windows per query
+        Rows are (query_index, content, similarity, token_count, embedding, chunk_id, parent_id,
+        file_name, page_start, page_end, score) in rank order, score being the fused hybrid score (NULL
+        for pure vector search); each parent takes the rank and score of its first child but the
+        similarity and embedding of its most similar one (hybrid rows are ranked by fused score, not
+        similarity), and its text and pages are assembled from its children that pass file_filter
+        (so page-range restrictions also apply to the window). Chunks without a parent (ingested
+        before parents existed) are used as-is
+        """
+        grouped = [[] for _ in range(query_count)]
+        kept = [{} for _ in range(query_count)]
+        for (query_index, content, similarity, token_count, embedding, chunk_id, parent_id,
+             file_name, page_start, page_end, score) in rows:
+            chunks = grouped[query_index - 1]
+            key = ('parent', parent_id) if parent_id is not None else ('chunk', chunk_id)
+            chunk = kept[query_index - 1].get(key)
+            if chunk is not None:
+                if similarity > chunk['similarity']:
+                    chunk['similarity'], chunk['embedding'] = float(similarity), embedding
+                continue
+            if len(chunks) >= limit:
+                continue
+            chunk = self._chunk_from_row((content, similarity, token_count, embedding))
+            chunk.update(parent_id=parent_id, file_name=file_name, page_start=page_start, page_end=page_end,
+                         score=float(score) if score is not None else None)
+            kept[query_index - 1][key] = chunk
+            chunks.append(chunk)
+
+        parent_ids = {chunk['parent_id'] for chunks in grouped for chunk in chunks if chunk['parent_id'] is not None}
+        if parent_ids:
+            cur.execute(f"""
+                SELECT parent_id, string_agg(content, '' ORDER BY child_index), SUM(token_count)::integer,
+                       MIN(page_start), MAX(page_end)
+                FROM rag_chunks
+                WHERE parent_id = ANY(%(parent_ids)s) AND {file_filter}
+                GROUP BY parent_id
+            """, dict(filter_params or {}, parent_ids=list(parent_ids)))
+            parents = {row[0]: row[1:] for row in cur.fetchall()}
+            for chunks in grouped:
+                for chunk in chunks:
+                    if chunk['parent_id'] in parents:
+                        (chunk['content'], chunk['token_count'],
+                         chunk['page_start'], chunk['page_end']) = parents[chunk['parent_id']]
+
+        return grouped
+
+    def _chunk_from_row(self, row: tuple) -> dict:
+        """Convert a (content, similarity, token_count, embedding) row into a chunk dict"""
+        content, similarity, token_count, embedding = row
+        return {
+            'content': content,
+            'similarity': float(similarity),
+            'token_count': token_count,
+            'embedding': embedding
+        }
+
     def count_tokens(self, text: str) -> int:
         """Count tokens in text"""
         return len(self.encoding.encode(text))
     
-    def build_context(self, relevant_chunks: List[Tuple[str, float]], 
-                     similarity_threshold: float = 0.7) -> str:
+    def build_context(self, relevant_chunks: List[dict],
+                     similarity_threshold: float = 0.7, max_chunks: Optional[int] = None,
+                     query: Optional[str] = None) -> str:
         """
         Build context from relevant chunks, respecting token limits
+        Candidates are diversified with maximal marginal relevance (MMR) and near-duplicates dropped,
+        keeping at most max_chunks; when a query is given, oversized selections are compressed to
+        their most relevant sentences. Each source is cited by file and pages from the chunk's own
+        metadata. Uses the token counts stored at ingest
         """
         context_parts = []
         total_tokens = 0
         
         # Add header
-        header = "# Relevant Context from Economics Materials:\n\n"
+        header = "# Relevant Context from Course Materials:\n\n"
         header_tokens = self.count_tokens(header)
         
         if header_tokens > self.max_context_tokens:
@@ -104,14 +387,29 @@ class RAGHandler:
         total_tokens += header_tokens
         context_parts.append(header)
         
-        # Add chunks within token limit and above similarity threshold
-        for i, (chunk, similarity) in enumerate(relevant_chunks):
-            if similarity < similarity_threshold:
-                logger.debug(f"Skipping chunk {i} with low similarity: {similarity:.3f}")
-                continue
-                
-            chunk_text = f"**Source {i+1}** (relevance: {similarity:.1%}):\n{chunk}\n\n"
-            chunk_tokens = self.count_tokens(chunk_text)
+        # Only chunks above the similarity threshold are candidates
+        candidates = [chunk for chunk in relevant_chunks if chunk['similarity'] >= similarity_threshold]
+        skipped = len(relevant_chunks) - len(candidates)
+        if skipped:
+            logger.debug(f"Skipped {skipped} chunks below similarity threshold {similarity_threshold:.3f}")
+
+        selected = self.select_diverse_chunks(candidates, max_chunks)
+        if query:
+            selected = self.compress_context_chunks(query, selected, self.max_context_tokens - header_tokens)
+
+        # Add chunks within token limit
+        for i, chunk in enumerate(selected):
+            similarity = chunk['similarity']
+            citation = self.format_citation(chunk)
+            citation = f"{citation}; " if citation else ""
+            chunk_text = f"**Source {i+1}** ({citation}relevance: {similarity:.1%}):\n{chunk['content']}\n\n"
+            content_tokens = chunk['token_count']
+            if content_tokens is None:
+                # Chunks ingested before token counts were stored
+                content_tokens = self.count_tokens(chunk['content'])
+            chunk_tokens = content_tokens + self.source_overhead_tokens
+            if citation:
+                chunk_tokens += self.citation_tokens(chunk, citation)
             
             if total_tokens + chunk_tokens > self.max_context_tokens:
                 logger.info(f"Token limit reached. Added {i} chunks to context.")
@@ -124,88 +422,431 @@ class RAGHandler:
             return ""
             
         context = "".join(context_parts)
-        context += "---\n\nPlease answer the question using the above context when relevant. If the context doesn't contain relevant information, you may use your general knowledge but indicate this clearly.\n\n"
+        context += "---\n\nPlease answer the question using the above context when relevant, citing the sources you use by file name and page. If the context doesn't contain relevant information, you may use your general knowledge but indicate this clearly.\n\n"
         
         logger.info(f"Built context with {len(context_parts)-1} chunks, {total_tokens} tokens")
         return context
+
+    def citation_tokens(self, chunk: dict, citation: str) -> int:
+        """
+        Upper bound on a citation's tokens without tokenizing it for every chunk: the file name is
+        counted once per file, the rest ("pp. 12–13; ") as one token per byte, which no token is shorter than
+        """
+        file_name = chunk.get('file_name') or ""
+        name_tokens = self._file_name_tokens.get(file_name)
+        if name_tokens is None:
+            name_tokens = self._file_name_tokens[file_name] = self.count_tokens(file_name)
+        return name_tokens + len(citation.encode()) - len(file_name.encode())
+
+    @staticmethod
+    def format_citation(chunk: dict) -> str:
+        """Short source citation such as "econ.pdf, pp. 12–13" (empty for chunks without metadata)"""
+        parts = []
+        if chunk.get('file_name'):
+            parts.append(chunk['file_name'])
+        page_start, page_end = chunk.get('page_start'), chunk.get('page_end')
+        if page_start is not None and page_end is not None and page_end != page_start:
+            parts.append(f"pp. {page_start}–{page_end}")
+        elif page_start is not None or page_end is not None:
+            parts.append(f"p. {page_start if page_start is not None else page_end}")
+        return ", ".join(parts)
+
+    def compress_context_chunks(self, query: str, chunks: List[dict], available_tokens: int) -> List[dict]:
+        """Pack the most query-relevant sentences into the compression budget if the chunks exceed it"""
+        budget = min(self.compressed_context_tokens, available_tokens) - self.source_overhead_tokens * len(chunks)
+        if self.compressed_context_tokens <= 0 or budget <= 0:
+            return chunks
+
+        content_tokens = sum(chunk['token_count'] if chunk['token_count'] is not None
+                             else self.count_tokens(chunk['content']) for chunk in chunks)
+        if content_tokens <= budget:
+            return chunks
+
+        compressed = compress_chunks(query, chunks, budget)
+        logger.info(f"Compressed context from {content_tokens} to "
+                    f"{sum(chunk['token_count'] for chunk in compressed)} tokens")
+        return compressed
+
+    def select_diverse_chunks(self, chunks: List[dict], max_chunks: Optional[int] = None) -> List[dict]:
+        """
+        Order chunks by maximal marginal relevance and drop near-duplicates
+        Relevance is the chunk's fused hybrid score when it has one (relative to the best candidate's,
+        to put it on the same scale as similarity), otherwise its query similarity; novelty is its
+        distance to already selected chunks. Chunks without embeddings are returned in their original order
+        """
+        limit = len(chunks) if max_chunks is None else min(max_chunks, len(chunks))
+        if limit <= 0:
+            return []
+        if len(chunks) < 2 or any(chunk.get('embedding') is None for chunk in chunks):
+            return chunks[:limit]
+
+        embeddings = np.asarray([chunk['embedding'] for chunk in chunks], dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        embeddings /= norms
+        pairwise = embeddings @ embeddings.T
+        if all(chunk.get('score') is not None for chunk in chunks):
+            relevance = np.asarray([chunk['score'] for chunk in chunks], dtype=np.float32)
+            relevance /= max(float(relevance.max()), 1e-12)
+        else:
+            relevance = np.asarray([chunk['similarity'] for chunk in chunks], dtype=np.float32)
+
+        selected = [int(np.argmax(relevance))]
+        # Highest similarity of each candidate to anything selected so far
+        redundancy = pairwise[selected[0]].copy()
+        available = np.ones(len(chunks), dtype=bool)
+        available[selected[0]] = False
+        available &= redundancy < self.duplicate_similarity
+
+        while len(selected) < limit and available.any():
+            scores = self.mmr_lambda * relevance - (1 - self.mmr_lambda) * redundancy
+            scores[~available] = -np.inf
+            best = int(np.argmax(scores))
+            selected.append(best)
+            available[best] = False
+            np.maximum(redundancy, pairwise[best], out=redundancy)
+            available &= redundancy < self.duplicate_similarity
+
+        dropped = len(chunks) - len(selected) - int(available.sum())
+        if dropped:
+            logger.info(f"Dropped {dropped} near-duplicate chunks")
+        return [chunks[i] for i in selected]
     
     def retrieve_context(self, query: str, top_k: int = 5,
-                        similarity_threshold: float = 0.7, user_name: str = None) -> Optional[str]:
+                        similarity_threshold: float = 0.7, user_name: str = None,
+                        query_embedding: Optional[List[float]] = None) -> Optional[str]:
         """
         Main retrieval function - get relevant context for a query
+        Pass query_embedding to reuse an embedding the caller already has
         """
         try:
             # Get query embedding
-            query_embedding = self.get_query_embedding(query)
-
-            # Perform similarity search with user filtering
-            relevant_chunks = self.similarity_search(query_embedding, limit=top_k, user_name=user_name)
+            if query_embedding is None:
+                query_embedding = self.get_query_embedding(query)
+
+            file_ids = None
+            if user_name:
+                file_ids = get_selected_file_ids(user_name)
+                if not file_ids:
+                    logger.info(f"No files selected for user {user_name}")
+                    return None
+
+            # Identical inputs against an unchanged corpus give the same context
+            cache_key = self._context_cache_key(query_embedding, file_ids, top_k, similarity_threshold)
+            hit, context = self._get_cached_context(cache_key)
+            if hit:
+                logger.info("Retrieval cache hit")
+                return context
+
+            # Perform hybrid (lexical + vector) or pure similarity search with user filtering
+            self._refresh_relevance_gate()
+            gate_score = self.relevance_gate.best_similarity(query_embedding, file_ids)
+            search_file_ids = self._route_files([query_embedding], file_ids)
+            page_ranges = get_file_page_ranges()
+
+            # Oversample so the context can be diversified down to top_k chunks
+            candidate_count = top_k * self.mmr_oversample
+            if self.use_hybrid_search:
+                relevant_chunks = self.hybrid_search(query, query_embedding, limit=candidate_count,
+                                                     file_ids=search_file_ids, page_ranges=page_ranges)
+            else:
+                relevant_chunks = self.similarity_search(query_embedding, limit=candidate_count,
+                                                         file_ids=search_file_ids, page_ranges=page_ranges)
 
             if not relevant_chunks:
                 logger.info("No relevant chunks found")
-                return None
+                context = None
+            else:
+                # Log similarity scores
+                logger.info(f"Found {len(relevant_chunks)} chunks with similarities: " +
+                           ", ".join([f"{chunk['similarity']:.3f}" for chunk in relevant_chunks]))
 
-            # Log similarity scores
-            logger.info(f"Found {len(relevant_chunks)} chunks with similarities: " +
-                       ", ".join([f"{sim:.3f}" for _, sim in relevant_chunks]))
+                # Build context
+                context = self.build_context(relevant_chunks, similarity_threshold, max_chunks=top_k, query=query)
+                context = context if context.strip() else None
 
-            # Build context
-            context = self.build_context(relevant_chunks, similarity_threshold)
+            # Log the gate score with the search outcome so the gate threshold can be learned
+            if gate_score is not None:
+                best_similarity = max((chunk['similarity'] for chunk in relevant_chunks), default=None)
+                self._log_gate_score(gate_score, best_similarity, context is not None,
+                                     self.relevance_gate.sample_weight(gate_score))
 
-            return context if context.strip() else None
+            self._store_cached_context(cache_key, context)
+            return context
 
         except Exception as e:
             logger.error(f"Context retrieval failed: {e}")
             return None
-    
-    def is_economics_related(self, query: str) -> bool:
+
+    def retrieve_context_many(self, queries: List[str], top_k: int = 5,
+                              similarity_threshold: float = 0.7, user_name: str = None) -> List[Optional[str]]:
         """
-        Simple heuristic to determine if query is economics-related
-        You can make this more sophisticated later
-        """
-        economics_keywords = [
-            'market', 'supply', 'demand', 'price', 'cost', 'revenue', 'profit',
-            'competition', 'monopoly', 'oligopoly', 'consumer', 'producer',
-            'economics', 'economic', 'economy', 'gdp', 'inflation', 'government',
-            'intervention', 'regulation', 'externality', 'externalities', 'public goods',
-            'market failure', 'efficiency', 'equity', 'welfare', 'subsidy',
-            'tax', 'taxation', 'elasticity', 'surplus', 'deadweight loss',
-            'fiscal', 'monetary', 'policy', 'trade', 'international'
-        ]
-        
-        query_lower = query.lower()
-        return any(keyword in query_lower for keyword in economics_keywords)
+        Batched retrieval for evaluation runs, cache warming and multi-query expansion
+        Embeds all queries in one API call and searches them in one SQL statement
+        Returns one context (or None) per query, in query order
+        """
+        if not queries:
+            return []
+
+        try:
+            query_embeddings = self.get_query_embeddings(queries)
+
+            file_ids = None
+            if user_name:
+                file_ids = get_selected_file_ids(user_name)
+                if not file_ids:
+                    logger.info(f"No files selected for user {user_name}")
+                    return [None] * len(queries)
+
+            contexts = [None] * len(queries)
+            cache_keys = [self._context_cache_key(embedding, file_ids, top_k, similarity_threshold)
+                          for embedding in query_embeddings]
+            misses = []
+            for i, cache_key in enumerate(cache_keys):
+                hit, context = self._get_cached_context(cache_key)
+                if hit:
+                    contexts[i] = context
+                else:
+                    misses.append(i)
+
+            if not misses:
+                return contexts
+
+            miss_queries = [queries[i] for i in misses]
+            miss_embeddings = [query_embeddings[i] for i in misses]
+            # One statement serves every query, so it searches the union of their routed files
+            self._refresh_relevance_gate()
+            search_file_ids = self._route_files(miss_embeddings, file_ids)
+            page_ranges = get_file_page_ranges()
+
+            candidate_count = top_k * self.mmr_oversample
+            if self.use_hybrid_search:
+                results = self.hybrid_search_many(miss_queries, miss_embeddings, limit=candidate_count,
+                                                  file_ids=search_file_ids, page_ranges=page_ranges)
+            else:
+                results = self.similarity_search_many(miss_embeddings, limit=candidate_count,
+                                                      file_ids=search_file_ids, page_ranges=page_ranges)
+
+            for i, relevant_chunks in zip(misses, results):
+                context = (self.build_context(relevant_chunks, similarity_threshold, max_chunks=top_k,
+                                              query=queries[i])
+                           if relevant_chunks else "")
+                contexts[i] = context if context.strip() else None
+                self._store_cached_context(cache_keys[i], contexts[i])
+
+            logger.info(f"Retrieved context for {len(queries)} queries ({len(queries) - len(misses)} cached)")
+            return contexts
+
+        except Exception as e:
+            logger.error(f"Batched context retrieval failed: {e}")
+            return [None] * len(queries)
+
+    def _get_cached_context(self, cache_key: Optional[tuple]) -> Tuple[bool, Optional[str]]:
+        """Look up a retrieval cache entry, returns (hit, context)"""
+        if cache_key is None:
+            return False, None
+        with self._context_cache_lock:
+            if cache_key not in self._context_cache:
+                return False, None
+            self._context_cache.move_to_end(cache_key)
+            return True, self._context_cache[cache_key]
+
+    def _store_cached_context(self, cache_key: Optional[tuple], context: Optional[str]):
+        """Store a retrieval cache entry, evicting the least recently used"""
+        if cache_key is None:
+            return
+        with self._context_cache_lock:
+            self._context_cache[cache_key] = context
+            self._context_cache.move_to_end(cache_key)
+            while len(self._context_cache) > self.context_cache_size:
+                self._context_cache.popitem(last=False)
     
-    @st.cache_data(ttl=120)  # Cache for 2 minutes
-    def get_rag_stats(self) -> dict:
-        """Get statistics about the RAG database"""
-        conn = get_connection()
-        if conn is None:
-            return {"error": "Cannot connect to database"}
-        
+    def _refresh_relevance_gate(self):
+        """Reload centroids when the corpus changes and periodically re-learn the threshold"""
+        generation = get_corpus_generation()
+        if generation is not None and generation != self.relevance_gate.generation:
+            self.relevance_gate.load_centroids(generation, get_file_centroids())
+
+        now = time.time()
+        if now - self._gate_refreshed_at > self.gate_refresh_seconds:
+            self._gate_refreshed_at = now
+            self.relevance_gate.learn_threshold(get_relevance_gate_scores())
+
+    def _log_gate_score(self, centroid_similarity: float, best_similarity: Optional[float],
+                        found_context: bool, sample_weight: float):
+        """Queue a gate score for the background writer, so logging adds no database round trip to retrieval"""
+        with self._gate_log_lock:
+            self._gate_log.append((centroid_similarity, best_similarity, found_context, sample_weight))
+            if self._gate_log_pending:
+                return
+            self._gate_log_pending = True
+        self._gate_log_executor.submit(self._write_gate_scores)
+
+    def _write_gate_scores(self):
+        """Write every queued gate score in one statement; scores queued meanwhile go in the next write"""
+        with self._gate_log_lock:
+            rows, self._gate_log = self._gate_log, []
+            self._gate_log_pending = False
+        log_relevance_gate_scores(rows)
+
+    def _route_files(self, query_embeddings: List[List[float]],
+                     file_ids: Optional[List[int]]) -> Optional[List[int]]:
+        """
+        Coarse stage of retrieval: narrow the in-scope files to those whose centroids are
+        closest to the queries, so the chunk search only ranks chunks from those files
+        """
+        if self.route_top_files <= 0:
+            return file_ids
+
+        routed = set()
+        for query_embedding in query_embeddings:
+            top_files = self.relevance_gate.top_files(query_embedding, self.route_top_files, file_ids)
+            if top_files is None:
+                return file_ids
+            routed.update(top_files)
+
+        logger.info(f"Routed search to {len(routed)} files")
+        return sorted(routed)
+
+    def check_relevance(self, query: str, query_embedding: Optional[List[float]] = None,
+                        user_name: str = None) -> Tuple[bool, Optional[List[float]]]:
+        """
+        Decide whether a prompt should trigger a course material search
+        Once the centroid gate is calibrated it decides from the query embedding, otherwise
+        the keyword router is used. Returns (should_search, query_embedding)
+        """
         try:
-            with conn.cursor() as cur:
-                cur.execute("SELECT COUNT(*) FROM rag_chunks")
-                chunk_count = cur.fetchone()[0]
-                
-                cur.execute("""
-                    SELECT AVG(LENGTH(content)), MIN(LENGTH(content)), MAX(LENGTH(content))
-                    FROM rag_chunks
-                """)
-                avg_len, min_len, max_len = cur.fetchone()
-                
-                return {
-                    "total_chunks": chunk_count,
-                    "avg_chunk_length": int(avg_len) if avg_len else 0,
-                    "min_chunk_length": min_len or 0,
-                    "max_chunk_length": max_len or 0
-                }
-                
+            self._refresh_relevance_gate()
+            if not self.relevance_gate.is_calibrated():
+                return self.is_topic_related(query), query_embedding
+
+            if query_embedding is None:
+                query_embedding = self.get_query_embedding(query)
+            file_ids = get_selected_file_ids(user_name) if user_name else None
+            score = self.relevance_gate.best_similarity(query_embedding, file_ids)
+            allowed = self.relevance_gate.allows(score)
+            if not allowed:
+                if self.relevance_gate.explore():
+                    logger.info(f"Relevance gate sampled a gated-out search (centroid similarity {score:.3f})")
+                    return True, query_embedding
+                logger.info(f"Relevance gate skipped search (centroid similarity {score:.3f})")
+            return allowed, query_embedding
+
+        except Exception as e:
+            logger.error(f"Relevance check failed, falling back to keywords: {e}")
+            return self.is_topic_related(query), query_embedding
+
+    def start_retrieval(self, query: str, top_k: int = 5, similarity_threshold: float = 0.7,
+                        user_name: str = None, query_embedding: Optional[List[float]] = None) -> Future:
+        """
+        Start the relevance check and retrieval in the background
+        Returns a Future of (searched, context) to pass to wait_for_retrieval
+        """
+        ctx = get_script_run_ctx()
+        started_at = time.perf_counter()
+
+        def run() -> Tuple[bool, Optional[str]]:
+            # Give the worker the session's script context so st.* calls behave as on the main thread
+            if ctx is not None:
+                add_script_run_ctx(threading.current_thread(), ctx)
+            # The worker can outlive a timed-out wait, so it must not share the session's connection
+            with private_connections():
+                should_search, embedding = self.check_relevance(query, query_embedding, user_name)
+                if not should_search:
+                    return False, None
+                return True, self.retrieve_context(query, top_k=top_k, similarity_threshold=similarity_threshold,
+                                                   user_name=user_name, query_embedding=embedding)
+
+        with self._retrieval_metrics_lock:
+            self._retrieval_counts['started'] += 1
+        future = self._retrieval_executor.submit(run)
+        future.started_at = started_at
+        return future
+
+    def wait_for_retrieval(self, future: Future, deadline_seconds: Optional[float] = None) -> Tuple[bool, Optional[str], bool]:
+        """
+        Wait for a retrieval started with start_retrieval, up to the latency budget
+        Returns (searched, context, timed_out); on timeout the answer proceeds without context
+        """
+        if deadline_seconds is None:
+            deadline_seconds = self.retrieval_deadline_seconds
+        remaining = max(0.0, deadline_seconds - (time.perf_counter() - future.started_at))
+
+        try:
+            searched, context = future.result(timeout=remaining)
+        except FutureTimeoutError:
+            # The search keeps running and still warms the retrieval cache
+            logger.warning(f"Retrieval exceeded its {deadline_seconds:.1f}s budget, proceeding without context")
+            with self._retrieval_metrics_lock:
+                self._retrieval_counts['timed_out'] += 1
+            return True, None, True
         except Exception as e:
-            logger.error(f"Failed to get RAG stats: {e}")
-            return {"error": str(e)}
-        finally:
-            conn.close()
+            logger.error(f"Background retrieval failed: {e}")
+            with self._retrieval_metrics_lock:
+                self._retrieval_counts['failed'] += 1
+            raise
+
+        with self._retrieval_metrics_lock:
+            self._retrieval_counts['completed'] += 1
+            self._retrieval_latencies.append(time.perf_counter() - future.started_at)
+        return searched, context, False
+
+    def get_retrieval_metrics(self) -> dict:
+        """Latency budget metrics for the admin panel"""
+        with self._retrieval_metrics_lock:
+            counts = dict(self._retrieval_counts)
+            latencies = np.asarray(self._retrieval_latencies, dtype=np.float64)
+
+        finished = counts['completed'] + counts['timed_out']
+        metrics = {
+            **counts,
+            'deadline_seconds': self.retrieval_deadline_seconds,
+            'timeout_rate': counts['timed_out'] / finished if finished else 0.0,
+            'p50_ms': None,
+            'p95_ms': None
+        }
+        if len(latencies):
+            metrics['p50_ms'] = float(np.percentile(latencies, 50) * 1000)
+            metrics['p95_ms'] = float(np.percentile(latencies, 95) * 1000)
+        return metrics
+
+    def _context_cache_key(self, query_embedding: List[float], file_ids: Optional[List[int]],
+                           top_k: int, similarity_threshold: float) -> Optional[tuple]:
+        """Build the retrieval cache key, or None when the corpus generation is unknown"""
+        generation = get_corpus_generation()
+        if generation is None:
+            return None
+
+        embedding_hash = hashlib.sha1(np.asarray(query_embedding, dtype=np.float32).tobytes()).hexdigest()
+        file_key = tuple(sorted(file_ids)) if file_ids is not None else None
+        return (generation, embedding_hash, file_key, top_k, similarity_threshold)
+
+    def get_topic_keywords(self) -> List[str]:
+        """Get the deployment's topic keywords (defaults to the economics lexicon)"""
+        keywords = get_topic_keywords()
+        return keywords if keywords is not None else list(DEFAULT_TOPIC_KEYWORDS)
+
+    def is_topic_related(self, query: str) -> bool:
+        """
+        Determine if query is related to the course materials using the
+        deployment's keyword lexicon, compiled once into a single regex
+        """
+        router = get_topic_router(normalize_keywords(self.get_topic_keywords()))
+        return router.is_related(query)
+
+    def is_economics_related(self, query: str) -> bool:
+        """Backwards-compatible alias for is_topic_related"""
+        return self.is_topic_related(query)
+    
+    def get_rag_stats(self) -> dict:
+        """Get statistics about the RAG database (maintained per file at ingest, cached process-wide)"""
+        return get_rag_stats()
+
+    def get_active_file_ids(self, user_name: str = None) -> List[int]:
+        """IDs of the files a search would cover (user's selection, or all completed files)"""
+        if user_name:
+            return get_selected_file_ids(user_name)
+        return get_completed_file_ids()
 
     def get_ingested_files_list(self) -> List[dict]:
         """Get list of all ingested files for admin interface"""
@@ -215,6 +856,30 @@ class RAGHandler:
         """Remove an ingested file record"""
         return delete_ingested_file(file_id)
 
+    @staticmethod
+    def parse_page_range(text: str) -> Tuple[Optional[int], Optional[int]]:
+        """
+        Parse an admin page range such as "45-120", "45-", "-120" or "7" (blank means all pages)
+        Raises ValueError for anything else
+        """
+        text = text.strip().replace("–", "-")
+        if not text:
+            return None, None
+        start, separator, end = (part.strip() for part in text.partition("-"))
+        if not separator:
+            end = start
+        page_start = int(start) if start else None
+        page_end = int(end) if end else None
+        if (page_start is not None and page_start < 1) or (page_end is not None and page_end < 1):
+            raise ValueError("Page numbers start at 1")
+        if page_start is not None and page_end is not None and page_start > page_end:
+            raise ValueError("Range start is after its end")
+        return page_start, page_end
+
+    def set_file_page_range(self, file_id: int, page_start: Optional[int], page_end: Optional[int]) -> bool:
+        """Restrict searches of a file to a page range (both None searches every page)"""
+        return update_file_page_range(file_id, page_start, page_end)
+
     def format_file_size(self, size_bytes: int) -> str:
         """Format file size in human readable format"""
         if size_bytes == 0:
@@ -234,12 +899,27 @@ class RAGHandler:
         """Update user's file selection"""
         return update_user_file_selection(user_name, file_id, is_selected)
 
+    def get_upload_processor(self):
+        """The PDF processor for uploads, created on first use and reused by every session"""
+        with self._upload_processor_lock:
+            if self._upload_processor is None:
+                from process_pdf import PDFEmbeddingProcessor
+                self._upload_processor = PDFEmbeddingProcessor()
+            return self._upload_processor
+
+    def close(self):
+        """Close the upload processor's embedding cache"""
+        with self._upload_processor_lock:
+            if self._upload_processor is not None:
+                self._upload_processor.close()
+                self._upload_processor = None
+
     def process_uploaded_files(self, uploaded_files: list) -> dict:
         """
         Process uploaded files securely from Streamlit file uploader
         Returns processing results with security measures
         """
-        from process_pdf import PDFEmbeddingProcessor
+        from app.rag.pdf_extraction import ParsedPdf
 
         results = {
             'total_files': len(uploaded_files),
@@ -251,7 +931,7 @@ class RAGHandler:
             'details': []
         }
 
-        processor = PDFEmbeddingProcessor()
+        processor = self.get_upload_processor()
 
         for uploaded_file in uploaded_files:
             file_result = {
@@ -262,12 +942,14 @@ class RAGHandler:
                 'warnings': []
             }
 
+            document = None
             try:
-                # Read file content from Streamlit's UploadedFile object
-                file_content = uploaded_file.read()
+                # Streamlit's UploadedFile is a BytesIO over the upload, getvalue() shares its buffer;
+                # the document is parsed once for validation, hashing and extraction
+                document = ParsedPdf(uploaded_file.getvalue())
 
                 # Security validation first
-                validation = processor.validate_uploaded_file(file_content, uploaded_file.name)
+                validation = processor.validate_uploaded_file(document, uploaded_file.name)
 
                 if not validation['valid']:
                     file_result['status'] = 'failed'
@@ -280,7 +962,8 @@ class RAGHandler:
                     results['warnings'].extend([f"{uploaded_file.name}: {w}" for w in validation['warnings']])
 
                     # Process the file
-                    successful_chunks, failed_chunks = processor.process_uploaded_file(file_content, uploaded_file.name)
+                    successful_chunks, failed_chunks = processor.process_uploaded_file(
+                        document, uploaded_file.name, validation=validation)
 
                     file_result['chunks'] = successful_chunks
                     file_result['status'] = 'completed' if failed_chunks == 0 else 'partial'
@@ -299,7 +982,8 @@ class RAGHandler:
 
             finally:
                 # Security cleanup - ensure file content is cleared
-                file_content = None
+                if document is not None:
+                    document.close()
                 uploaded_file.seek(0)  # Reset file pointer for Streamlit
 
             results['details'].append(file_result)
@@ -308,4 +992,5 @@ class RAGHandler:
 
 
 # Global RAG handler instance
-rag_handler = RAGHandler()
\ No newline at end of file
+rag_handler = RAGHandler()
+atexit.register(rag_handler.close)
\ No newline at end of file
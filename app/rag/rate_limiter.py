@@ -0,0 +1,122 @@
+"""
+Embedding Rate Limiter
+Shared token bucket for requests per minute (RPM) and tokens per minute (TPM), so concurrent
+embedding workers use the whole API quota without tripping 429s, and back off together when
+the API asks them to (Retry-After)
+"""
+
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Seconds to wait from a rate-limit error's Retry-After headers, if it has any"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        value = headers.get(header)
+        if value is None:
+            continue
+        try:
+            return max(0.0, float(value) * scale)
+        except ValueError:
+            continue  # HTTP-date form, not sent by the OpenAI API
+    return None
+
+
+class RateLimiter:
+    """
+    Two token buckets (requests and tokens) refilled continuously at their per-minute limits
+    acquire() blocks until a request of the given size fits both; a limit of 0 disables that bucket
+    """
+
+    def __init__(self, requests_per_minute: int = 3000, tokens_per_minute: int = 1000000,
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        now = clock()
+        self._updated = now
+        self._available_requests = float(requests_per_minute)
+        self._available_tokens = float(tokens_per_minute)
+        self._paused_until = now
+        # Throughput report
+        self._started = None
+        self.requests = 0
+        self.tokens = 0
+        self.rate_limited = 0  # 429 responses reported through pause()
+        self.throttled_seconds = 0.0  # Total time callers spent waiting in acquire()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.requests_per_minute > 0:
+            self._available_requests = min(float(self.requests_per_minute),
+                                           self._available_requests + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute > 0:
+            self._available_tokens = min(float(self.tokens_per_minute),
+                                         self._available_tokens + elapsed * self.tokens_per_minute / 60)
+
+    def _wait_time(self, tokens: int, now: float) -> float:
+        """Seconds until a request of this size fits (0 when it fits now)"""
+        wait = max(0.0, self._paused_until - now)
+        if self.requests_per_minute > 0 and self._available_requests < 1:
+            wait = max(wait, (1 - self._available_requests) * 60 / self.requests_per_minute)
+        if self.tokens_per_minute > 0:
+            # Requests larger than the whole bucket wait for a full bucket instead of forever
+            needed = min(tokens, self.tokens_per_minute)
+            if self._available_tokens < needed:
+                wait = max(wait, (needed - self._available_tokens) * 60 / self.tokens_per_minute)
+        return wait
+
+    def acquire(self, tokens: int) -> float:
+        """Block until a request of the given token size may be sent; returns the seconds waited"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = self._clock()
+                if self._started is None:
+                    self._started = now
+                self._refill(now)
+                wait = self._wait_time(tokens, now)
+                if wait <= 0:
+                    if self.requests_per_minute > 0:
+                        self._available_requests -= 1
+                    if self.tokens_per_minute > 0:
+                        self._available_tokens -= min(tokens, self.tokens_per_minute)
+                    self.requests += 1
+                    self.tokens += tokens
+                    self.throttled_seconds += waited
+                    return waited
+            self._sleep(wait)
+            waited += wait
+
+    def pause(self, seconds: float):
+        """Hold every caller for the given time, e.g. after a 429 with Retry-After"""
+        with self._lock:
+            self.rate_limited += 1
+            self._paused_until = max(self._paused_until, self._clock() + seconds)
+        logger.warning(f"Embedding rate limit hit, pausing requests for {seconds:.1f}s")
+
+    def report(self) -> dict:
+        """Throughput since the first request: totals, per-minute rates and time spent throttled"""
+        with self._lock:
+            elapsed = self._clock() - self._started if self._started is not None else 0.0
+            minutes = elapsed / 60
+            return {
+                'requests': self.requests,
+                'tokens': self.tokens,
+                'elapsed_seconds': elapsed,
+                'requests_per_minute': self.requests / minutes if minutes else 0.0,
+                'tokens_per_minute': self.tokens / minutes if minutes else 0.0,
+                'rate_limited': self.rate_limited,
+                'throttled_seconds': self.throttled_seconds,
+            }
@@ -0,0 +1,166 @@
+"""
+Centroid Relevance Gate
+Decides whether a query embedding is close enough to the course materials to be worth a
+vector search, by comparing it against per-file and whole-corpus centroids held in memory.
+The same centroids route a search to the files closest to the query
+"""
+
+import logging
+import random
+import threading
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class CentroidRelevanceGate:
+    """
+    Holds normalized centroids for the corpus and a threshold learned from logged scores
+    The gate stays open (uncalibrated) until enough searches that produced context are logged.
+    A small share of gated-out prompts is searched anyway and logged with a matching weight,
+    so the threshold can move down as well as up
+    """
+
+    def __init__(self, min_samples: int = 50, percentile: float = 5.0, margin: float = 0.01,
+                 explore_rate: float = 0.05):
+        self.min_samples = min_samples  # Logged positive searches needed before gating
+        self.percentile = percentile  # Percentile of positive scores used as the threshold
+        self.margin = margin  # Safety margin subtracted from the learned threshold
+        self.explore_rate = explore_rate  # Share of gated-out prompts searched anyway (0 disables)
+        self._lock = threading.Lock()
+        self.generation = None
+        self.file_ids: List[Optional[int]] = []
+        self._centroids: Optional[np.ndarray] = None
+        self._corpus_centroid: Optional[np.ndarray] = None
+        self.threshold: Optional[float] = None
+
+    def load_centroids(self, generation, rows: Sequence[Tuple[Optional[int], int, Sequence[float]]]):
+        """Load (file_id, chunk_count, centroid) rows for a corpus generation"""
+        rows = [row for row in rows if row[2] is not None]
+        with self._lock:
+            self.generation = generation
+            if not rows:
+                self.file_ids = []
+                self._centroids = None
+                self._corpus_centroid = None
+                return
+
+            centroids = np.asarray([row[2] for row in rows], dtype=np.float32)
+            counts = np.asarray([row[1] for row in rows], dtype=np.float32)
+
+            self.file_ids = [row[0] for row in rows]
+            self._centroids = _normalize_rows(centroids)
+            # Whole-corpus centroid is the chunk-weighted mean of the file centroids
+            corpus = (centroids * counts[:, np.newaxis]).sum(axis=0) / max(counts.sum(), 1.0)
+            self._corpus_centroid = _normalize_rows(corpus[np.newaxis, :])[0]
+
+        logger.info(f"Loaded {len(rows)} file centroids for corpus generation {generation}")
+
+    def _scope(self, file_ids: Optional[Sequence[int]]) -> Tuple[List[Optional[int]], Optional[np.ndarray]]:
+        """File ids and normalized centroids restricted to file_ids (all files when None)"""
+        with self._lock:
+            if self._centroids is None:
+                return [], None
+            if file_ids is None:
+                return list(self.file_ids), self._centroids
+            allowed = set(file_ids)
+            mask = np.asarray([file_id in allowed for file_id in self.file_ids])
+            if not mask.any():
+                return [], None
+            return [file_id for file_id, keep in zip(self.file_ids, mask) if keep], self._centroids[mask]
+
+    @staticmethod
+    def _normalize_query(query_embedding: Sequence[float]) -> Optional[np.ndarray]:
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return None
+        return query / norm
+
+    def best_similarity(self, query_embedding: Sequence[float],
+                        file_ids: Optional[Sequence[int]] = None) -> Optional[float]:
+        """Highest cosine similarity between the query and any in-scope centroid"""
+        _, centroids = self._scope(file_ids)
+        corpus_centroid = self._corpus_centroid
+        query = self._normalize_query(query_embedding)
+        if centroids is None or query is None:
+            return None
+
+        scores = centroids @ query
+        best = float(scores.max())
+        if file_ids is None and corpus_centroid is not None:
+            best = max(best, float(corpus_centroid @ query))
+        return best
+
+    def top_files(self, query_embedding: Sequence[float], count: int,
+                  file_ids: Optional[Sequence[int]] = None) -> Optional[List[int]]:
+        """
+        The count in-scope files whose centroids are closest to the query
+        Returns None when routing cannot narrow the search (too few files, no centroids,
+        or legacy chunks without a file among the top files)
+        """
+        scope_ids, centroids = self._scope(file_ids)
+        query = self._normalize_query(query_embedding)
+        if centroids is None or query is None or len(scope_ids) <= count:
+            return None
+
+        scores = centroids @ query
+        top = np.argpartition(-scores, count - 1)[:count]
+        top = top[np.argsort(-scores[top])]
+        selected = [scope_ids[i] for i in top]
+        if None in selected:
+            return None
+        return selected
+
+    def learn_threshold(self, scores: Sequence[Tuple]) -> Optional[float]:
+        """
+        Learn the threshold from logged (centroid_similarity, found_context[, sample_weight]) rows
+        Uses a low weighted percentile of the scores of searches that produced context
+        """
+        positives = [(row[0], row[2] if len(row) > 2 else 1.0) for row in scores
+                     if row[1] and row[0] is not None]
+        with self._lock:
+            if len(positives) < self.min_samples:
+                self.threshold = None
+            else:
+                values, weights = np.asarray(positives, dtype=np.float64).T
+                order = np.argsort(values)
+                cumulative = np.cumsum(weights[order])
+                index = np.searchsorted(cumulative, cumulative[-1] * self.percentile / 100)
+                self.threshold = float(values[order][index]) - self.margin
+            threshold = self.threshold
+
+        if threshold is not None:
+            logger.info(f"Relevance gate threshold {threshold:.3f} learned from {len(positives)} searches")
+        return threshold
+
+    def is_calibrated(self) -> bool:
+        """True once a threshold has been learned and centroids are loaded"""
+        return self.threshold is not None and self._centroids is not None
+
+    def allows(self, score: Optional[float]) -> bool:
+        """Whether a best-centroid score should proceed to the vector search"""
+        if score is None or self.threshold is None:
+            return True
+        return score >= self.threshold
+
+    def explore(self) -> bool:
+        """Whether to search a gated-out prompt anyway, to keep logging scores below the threshold"""
+        return random.random() < self.explore_rate
+
+    def sample_weight(self, score: Optional[float]) -> float:
+        """
+        Weight to log a searched prompt's score with: a search below the threshold was an
+        exploration sample and stands for the 1 / explore_rate gated-out prompts it was drawn from
+        """
+        if self.allows(score) or self.explore_rate <= 0:
+            return 1.0
+        return 1.0 / self.explore_rate
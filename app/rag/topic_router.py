@@ -0,0 +1,89 @@
+"""
+Topic Router
+Decides whether a prompt is on-topic for the course materials using a keyword lexicon
+compiled once into a single regular expression
+"""
+
+import re
+from functools import lru_cache
+from typing import Iterable, List, Optional, Tuple
+
+# Default lexicon, used until an admin saves a deployment-specific one.
+# Keywords match whole words (plus a trailing "s"/"es"); a trailing "*" matches any word
+# starting with the keyword, and multi-word phrases match across any whitespace.
+DEFAULT_TOPIC_KEYWORDS = [
+    'market', 'supply', 'demand', 'price', 'cost', 'revenue', 'profit',
+    'competition', 'monopol*', 'oligopol*', 'consumer', 'producer',
+    'econom*', 'gdp', 'inflation', 'government',
+    'intervention', 'regulation', 'externalit*', 'public goods',
+    'market failure', 'efficiency', 'equity', 'welfare', 'subsid*',
+    'tax', 'taxation', 'elasticity', 'surplus', 'deadweight loss',
+    'fiscal', 'monetary', 'policy', 'trade', 'international'
+]
+
+
+def normalize_keywords(keywords: Iterable[str]) -> Tuple[str, ...]:
+    """Lowercase, strip and de-duplicate keywords, keeping their order"""
+    seen = {}
+    for keyword in keywords:
+        keyword = " ".join(keyword.lower().split())
+        if keyword and keyword != "*":
+            seen.setdefault(keyword, None)
+    return tuple(seen)
+
+
+def _trie_pattern(node: dict) -> str:
+    """Regex fragment for a keyword trie node, sharing common prefixes between keywords"""
+    branches = [(r"\s+" if char == " " else re.escape(char)) + _trie_pattern(child)
+                for char, child in sorted(node.items()) if char]
+    # Keyword endings come last so longer keywords and phrases win
+    if node.get("") == "prefix":
+        branches.append(r"\w*")
+    elif node.get("") == "word":
+        branches.append(r"(?:e?s)?")
+    if len(branches) == 1:
+        return branches[0]
+    return "(?:" + "|".join(branches) + ")"
+
+
+def compile_lexicon(keywords: Iterable[str]) -> Optional[re.Pattern]:
+    """
+    Compile keywords into one case-insensitive, word-bounded regex
+    The alternation is built as a trie, so matching cost stays flat as the lexicon grows
+    """
+    keywords = normalize_keywords(keywords)
+    if not keywords:
+        return None
+
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword.rstrip("*"):
+            node = node.setdefault(char, {})
+        node[""] = "prefix" if keyword.endswith("*") else "word"
+
+    return re.compile(rf"(?<!\w){_trie_pattern(trie)}(?!\w)", re.IGNORECASE)
+
+
+class TopicRouter:
+    """Matches prompts against a compiled keyword lexicon"""
+
+    def __init__(self, keywords: Iterable[str]):
+        self.keywords = normalize_keywords(keywords)
+        self.pattern = compile_lexicon(self.keywords)
+
+    def is_related(self, text: str) -> bool:
+        """True if the text mentions any keyword"""
+        return self.pattern is not None and self.pattern.search(text) is not None
+
+    def matched_keywords(self, text: str) -> List[str]:
+        """Keyword occurrences found in the text (for debugging the lexicon)"""
+        if self.pattern is None:
+            return []
+        return [match.group(0) for match in self.pattern.finditer(text)]
+
+
+@lru_cache(maxsize=8)
+def get_topic_router(keywords: Tuple[str, ...]) -> TopicRouter:
+    """Get a compiled router, compiling each distinct lexicon only once per process"""
+    return TopicRouter(keywords)
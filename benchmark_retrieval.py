@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""
+Retrieval quality and latency benchmark
+Loads a labelled question -> expected passage set into a local Postgres + pgvector database,
+sweeps retrieval configurations (parent and child chunk size, index type, search mode, file
+routing, top_k, similarity threshold) and writes recall@k, MRR and p50/p95/p99 search latency as
+a JSON report. Routed cases narrow each search to the files whose centroids are closest to the
+question, as the app does, which shows whether the index still finds enough rows in those files.
+
+Embeddings come from a deterministic hashed bag-of-words embedder by default, so the benchmark
+runs offline and repeatably; use --embedder openai to calibrate thresholds with real embeddings.
+Everything is written to a dedicated schema (--schema), which is dropped and recreated.
+
+Example:
+    python benchmark_retrieval.py --dsn postgresql://localhost/rag_benchmark --output report.json
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import sys
+import time
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Callable, List, Tuple
+from unittest.mock import patch
+
+import numpy as np
+import psycopg2
+from psycopg2.extensions import make_dsn
+
+EMBEDDING_DIMENSIONS = 1536
+
+# Vocabulary for the built-in synthetic course material
+TERMS = [
+    'market', 'supply', 'demand', 'price', 'cost', 'revenue', 'profit', 'competition',
+    'monopoly', 'oligopoly', 'consumer', 'producer', 'inflation', 'government', 'regulation',
+    'externality', 'subsidy', 'tax', 'elasticity', 'surplus', 'welfare', 'efficiency', 'equity',
+    'tariff', 'quota', 'wage', 'labour', 'capital', 'interest', 'exchange', 'output', 'investment',
+    'saving', 'unemployment', 'productivity', 'barrier', 'incentive', 'allocation', 'scarcity',
+    'opportunity', 'margin', 'utility', 'household', 'firm', 'industry', 'sector', 'budget',
+]
+
+
+def synthetic_dataset(documents: int = 6, facts_per_document: int = 20, filler_sentences: int = 4,
+                      topic_terms: int = 0, facts_per_page: int = 2, seed: int = 0) -> dict:
+    """
+    Generate course documents made of filler sentences and labelled facts
+    Each question shares most of its fact's terms, and the fact sentence is the expected passage.
+    With topic_terms, each document only uses that many terms, so documents have distinct topics.
+    Text is split into pages with the extractor's "--- Page N ---" markers, so chunks get page ranges
+    """
+    rng = random.Random(seed)
+
+    def sentence(terms: List[str], words: int) -> str:
+        return " ".join(rng.choice(terms) for _ in range(words)).capitalize()
+
+    docs, questions = [], []
+    for d in range(documents):
+        terms = rng.sample(TERMS, topic_terms) if topic_terms else TERMS
+        sentences = []
+        for f in range(facts_per_document):
+            unit = d * facts_per_document + f
+            cause, effect, agent, outcome = rng.sample(terms, 4)
+            fact = f"In unit {unit} a change in {cause} affects {effect} for each {agent} through {outcome}"
+            sentences.extend(sentence(terms, rng.randint(8, 16)) for _ in range(filler_sentences))
+            sentences.append(fact)
+            questions.append({
+                'question': f"How does {cause} affect {effect} for a {agent} in unit {unit}?",
+                'expected': fact,
+            })
+        page_sentences = facts_per_page * (filler_sentences + 1)
+        pages = [". ".join(sentences[start:start + page_sentences]) + "."
+                 for start in range(0, len(sentences), page_sentences)]
+        text = "\n\n".join(f"--- Page {number} ---\n{page}" for number, page in enumerate(pages, 1))
+        docs.append({'name': f"synthetic_{d + 1}.pdf", 'text': text})
+
+    return {'documents': docs, 'questions': questions}
+
+
+def load_dataset(path: str) -> dict:
+    """
+    Load a labelled dataset from JSON:
+    {"documents": [{"name": ..., "text": ... or "path": "file.pdf"}],
+     "questions": [{"question": ..., "expected": "passage the answer chunk must contain"}]}
+    """
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+@lru_cache(maxsize=65536)
+def _word_vector(word: str) -> np.ndarray:
+    seed = int.from_bytes(hashlib.sha256(word.encode('utf-8')).digest()[:8], 'little')
+    return np.random.default_rng(seed).standard_normal(EMBEDDING_DIMENSIONS).astype(np.float32)
+
+
+def fake_embedding(text: str) -> List[float]:
+    """Deterministic hashed bag-of-words embedding (unit length), stable across processes"""
+    vector = np.zeros(EMBEDDING_DIMENSIONS, dtype=np.float32)
+    for word in text.lower().split():
+        word = word.strip(".,;:!?()\"'")
+        if word:
+            vector += _word_vector(word)
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+
+def openai_embedder(client, model: str) -> Callable[[List[str]], List[List[float]]]:
+    """Batch embedder using the OpenAI API"""
+    def embed(texts: List[str]) -> List[List[float]]:
+        embeddings = []
+        for start in range(0, len(texts), 100):
+            response = client.embeddings.create(model=model, input=texts[start:start + 100])
+            embeddings.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+        return embeddings
+    return embed
+
+
+def reset_schema(base_dsn: str, schema: str):
+    """Drop and recreate the benchmark schema, with pgvector available in public"""
+    conn = psycopg2.connect(base_dsn)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("CREATE EXTENSION IF NOT EXISTS vector SCHEMA public;")
+            cur.execute(f'DROP SCHEMA IF EXISTS "{schema}" CASCADE;')
+            cur.execute(f'CREATE SCHEMA "{schema}";')
+    finally:
+        conn.close()
+
+
+def load_corpus(processor, documents: List[dict], embed) -> Tuple[int, int]:
+    """
+    Store the documents through the app's ingestion path, returns (parents, children)
+    PDFs are streamed with stream_chunks() and text documents chunked the same way, and both go
+    through ingest_chunks(), so chunks carry page metadata and files are completed with their
+    aggregates. Embeddings come from embed instead of the processor's API client
+    """
+    from app.db.database_connection import insert_ingested_file, pooled_connection
+    from app.rag.chunking import iter_chunks
+
+    processor.get_embeddings_batch = lambda texts, max_retries=3, token_counts=None: embed(texts)
+    parents = 0
+    for document in documents:
+        text = document.get('text')
+        if text is None:
+            file_size, file_hash = os.path.getsize(document['path']), processor.create_file_hash(document['path'])
+            chunks = processor.stream_chunks(document['path'])
+        else:
+            file_size, file_hash = len(text), hashlib.sha256(text.encode('utf-8')).hexdigest()
+            chunks = iter_chunks([text], processor.encoding, processor.max_tokens,
+                                 overlap_tokens=processor.chunk_overlap_tokens)
+
+        file_id = insert_ingested_file(document['name'], f"benchmark://{document['name']}",
+                                       file_size, file_hash, 'processing')
+        parents += processor.ingest_chunks(chunks, file_id, document['name'])[0]
+
+    with pooled_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM rag_chunks;")
+        children = cur.fetchone()[0]
+    return parents, children
+
+
+def build_index(dsn: str, index_type: str, chunk_count: int):
+    """Replace the embedding index with the requested type, built after the data is loaded"""
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DROP INDEX IF EXISTS rag_chunks_embedding_idx;")
+            if index_type == 'ivfflat':
+                # pgvector's guidance: rows / 1000 lists for up to 1M rows
+                lists = max(1, chunk_count // 1000)
+                cur.execute(f"""
+                    CREATE INDEX rag_chunks_embedding_idx ON rag_chunks
+                    USING ivfflat (embedding vector_cosine_ops) WITH (lists = {lists});
+                """)
+            elif index_type == 'hnsw':
+                cur.execute("""
+                    CREATE INDEX rag_chunks_embedding_idx ON rag_chunks
+                    USING hnsw (embedding vector_cosine_ops);
+                """)
+            cur.execute("ANALYZE rag_chunks;")
+    finally:
+        conn.close()
+
+
+def percentiles_ms(latencies: List[float]) -> dict:
+    values = np.asarray(latencies) * 1000
+    return {
+        'p50': round(float(np.percentile(values, 50)), 3),
+        'p95': round(float(np.percentile(values, 95)), 3),
+        'p99': round(float(np.percentile(values, 99)), 3),
+        'mean': round(float(values.mean()), 3),
+    }
+
+
+def evaluate(handler, questions: List[dict], question_embeddings: List[List[float]], mode: str,
+             top_k: int, thresholds: List[float], repeat: int, route_top_files: int = 0) -> List[dict]:
+    """
+    Run every question through the app's search and context selection pipeline
+    With route_top_files, each search only covers that many files closest to the question
+    Returns one result per threshold (the threshold only filters results, so searches are shared)
+    """
+    candidate_count = top_k * handler.mmr_oversample
+    handler.route_top_files = route_top_files
+    file_count = max(len(handler.relevance_gate.file_ids), 1)
+    latencies = []
+    searches = []
+    searched_fractions = []
+    fill_rates = []
+    for run in range(repeat):
+        for item, embedding in zip(questions, question_embeddings):
+            start = time.perf_counter()
+            file_ids = handler._route_files([embedding], None)
+            if mode == 'hybrid':
+                chunks = handler.hybrid_search(item['question'], embedding, limit=candidate_count,
+                                               file_ids=file_ids)
+            else:
+                chunks = handler.similarity_search(embedding, limit=candidate_count, file_ids=file_ids)
+            latencies.append(time.perf_counter() - start)
+            if run == 0:
+                searches.append(chunks)
+                searched_fractions.append(1.0 if file_ids is None else len(file_ids) / file_count)
+                fill_rates.append(len(chunks) / candidate_count)
+
+    latency = percentiles_ms(latencies)
+    results = []
+    for threshold in thresholds:
+        hits, reciprocal_ranks, with_context = 0, [], 0
+        for item, chunks in zip(questions, searches):
+            candidates = [chunk for chunk in chunks if chunk['similarity'] >= threshold]
+            selected = handler.select_diverse_chunks(candidates, top_k)
+            with_context += bool(selected)
+            rank = next((i + 1 for i, chunk in enumerate(selected) if item['expected'] in chunk['content']), None)
+            hits += rank is not None
+            reciprocal_ranks.append(1.0 / rank if rank else 0.0)
+
+        results.append({
+            'top_k': top_k,
+            'route_top_files': route_top_files,
+            'searched_file_fraction': round(float(np.mean(searched_fractions)), 4),
+            # Share of the requested candidates returned; below 1 when a filtered index scan runs short
+            'fill_rate': round(float(np.mean(fill_rates)), 4),
+            'similarity_threshold': threshold,
+            'recall_at_k': round(hits / len(questions), 4),
+            'mrr': round(float(np.mean(reciprocal_ranks)), 4),
+            'context_rate': round(with_context / len(questions), 4),
+            'latency_ms': latency,
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark RAG retrieval quality and latency")
+    parser.add_argument("--dsn", default=os.environ.get("RAG_BENCHMARK_DSN"),
+                        help="Postgres DSN with pgvector (default: $RAG_BENCHMARK_DSN)")
+    parser.add_argument("--schema", default="rag_benchmark", help="Schema to (re)create for the benchmark")
+    parser.add_argument("--dataset", help="Labelled dataset JSON (default: built-in synthetic set)")
+    parser.add_argument("--documents", type=int, default=6, help="Documents in the built-in synthetic set")
+    parser.add_argument("--topic-terms", type=int, default=0,
+                        help="Terms each synthetic document draws from, giving documents distinct topics "
+                             "(default: the whole vocabulary)")
+    parser.add_argument("--embedder", choices=["fake", "openai"], default="fake",
+                        help="Embeddings: deterministic offline fake, or the OpenAI API")
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[400, 800],
+                        help="Parent window sizes (max tokens per context chunk) to compare")
+    parser.add_argument("--child-sizes", type=int, nargs="+", default=[75, 150, 300],
+                        help="Child chunk sizes (max tokens per searched chunk) to compare")
+    parser.add_argument("--index-types", nargs="+", choices=["none", "ivfflat", "hnsw"],
+                        default=["none", "ivfflat", "hnsw"], help="Embedding index types to compare")
+    parser.add_argument("--modes", nargs="+", choices=["vector", "hybrid"], default=["vector", "hybrid"],
+                        help="Search modes to compare")
+    parser.add_argument("--route-top-files", type=int, nargs="+", default=[0, 1],
+                        help="Files each search is routed to (0 searches every file)")
+    parser.add_argument("--top-k", type=int, nargs="+", default=[2, 4, 8], help="top_k values to compare")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.0, 0.3, 0.5, 0.6, 0.7],
+                        help="Similarity thresholds to compare")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed passes over the question set")
+    parser.add_argument("--output", default="retrieval_benchmark.json", help="Where to write the JSON report")
+    parser.add_argument("--verbose", action="store_true", help="Show the app's info and warning logs")
+    args = parser.parse_args()
+
+    if not args.dsn:
+        parser.error("--dsn (or RAG_BENCHMARK_DSN) is required")
+
+    if args.dataset:
+        dataset = load_dataset(args.dataset)
+    else:
+        dataset = synthetic_dataset(documents=args.documents, topic_terms=args.topic_terms)
+    dsn = make_dsn(args.dsn, options=f"-c search_path={args.schema},public")
+    secrets = {
+        "DB_CONNECTION": dsn,
+        "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "sk-benchmark"),
+    }
+
+    with patch('streamlit.secrets', secrets):
+        from app.db.database_connection import get_file_centroids, initialize_db
+        from app.rag.rag_handler import RAGHandler
+        from process_pdf import PDFEmbeddingProcessor
+
+        if not args.verbose:
+            # Every search logs; only errors are interesting while timing
+            logging.disable(logging.WARNING)
+
+        processor = PDFEmbeddingProcessor()
+        handler = RAGHandler()
+        if args.embedder == "openai":
+            embed = openai_embedder(handler.client, handler.embedding_model)
+        else:
+            def embed(texts: List[str]) -> List[List[float]]:
+                return [fake_embedding(text) for text in texts]
+
+        questions = dataset['questions']
+        question_embeddings = embed([item['question'] for item in questions])
+
+        print("🔧 Retrieval Benchmark")
+        print("=" * 50)
+        print(f"Documents: {len(dataset['documents'])}, questions: {len(questions)}, embedder: {args.embedder}")
+
+        results = []
+        for chunk_size in args.chunk_sizes:
+            for child_size in args.child_sizes:
+                reset_schema(args.dsn, args.schema)
+                initialize_db()
+                processor.initialize_rag_table()
+                processor.max_tokens = chunk_size
+                processor.child_max_tokens = child_size
+                parent_count, chunk_count = load_corpus(processor, dataset['documents'], embed)
+                print(f"\nChunk size {chunk_size}, child size {child_size}: "
+                      f"{parent_count} parents, {chunk_count} child chunks")
+                # Routing uses the centroids of this corpus
+                handler.relevance_gate.load_centroids((chunk_size, child_size), get_file_centroids())
+
+                for index_type in args.index_types:
+                    build_index(dsn, index_type, chunk_count)
+                    for mode in args.modes:
+                        for route_top_files in args.route_top_files:
+                            for top_k in args.top_k:
+                                for result in evaluate(handler, questions, question_embeddings, mode, top_k,
+                                                       args.thresholds, args.repeat, route_top_files):
+                                    result.update({'chunk_size': chunk_size, 'child_size': child_size,
+                                                   'parents': parent_count, 'chunks': chunk_count,
+                                                   'index_type': index_type, 'mode': mode})
+                                    results.append(result)
+                                    latency = result['latency_ms']
+                                    print(f"  {index_type:>7} {mode:>6} "
+                                          f"files={result['searched_file_fraction']:<6.1%} k={top_k:<2} "
+                                          f"t={result['similarity_threshold']:<4} "
+                                          f"recall={result['recall_at_k']:.3f} mrr={result['mrr']:.3f} "
+                                          f"fill={result['fill_rate']:.2f} "
+                                          f"p50={latency['p50']:.1f}ms p95={latency['p95']:.1f}ms "
+                                          f"p99={latency['p99']:.1f}ms")
+
+    report = {
+        'generated_at': datetime.now(timezone.utc).isoformat(),
+        'dataset': {
+            'source': args.dataset or 'synthetic',
+            'documents': len(dataset['documents']),
+            'questions': len(questions),
+            'embedder': args.embedder,
+        },
+        'settings': {'repeat': args.repeat, 'mmr_oversample': handler.mmr_oversample},
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+    best = max(results, key=lambda r: (r['recall_at_k'], r['mrr'], -r['latency_ms']['p95']))
+    print(f"\nBest: chunk_size={best['chunk_size']} child_size={best['child_size']} "
+          f"index={best['index_type']} mode={best['mode']} route_top_files={best['route_top_files']} "
+          f"top_k={best['top_k']} threshold={best['similarity_threshold']} "
+          f"(recall@k {best['recall_at_k']:.3f}, MRR {best['mrr']:.3f})")
+    print(f"📄 Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the RAG topic router
+Compares the old per-call keyword list scan with the compiled lexicon regex
+"""
+
+import argparse
+import random
+import string
+import timeit
+
+from app.rag.topic_router import DEFAULT_TOPIC_KEYWORDS, TopicRouter, get_topic_router, normalize_keywords
+
+SAMPLE_PROMPTS = [
+    "What is market failure?",
+    "Explain supply and demand with an example",
+    "How does government intervention work in healthcare?",
+    "Why do negative externalities lead to overproduction?",
+    "What is the weather today?",
+    "How do I cook pasta?",
+    "Can you check the syntax of my Python code?",
+    "Tell me about the history of the Roman empire and its decline over several centuries",
+    "Summarise the key arguments for and against a sugar tax in about three paragraphs",
+    "What's the difference between a monopoly and an oligopoly?",
+]
+
+
+def legacy_is_economics_related(query: str) -> bool:
+    """The original implementation: rebuild the list and substring-scan on every call"""
+    economics_keywords = [
+        'market', 'supply', 'demand', 'price', 'cost', 'revenue', 'profit',
+        'competition', 'monopoly', 'oligopoly', 'consumer', 'producer',
+        'economics', 'economic', 'economy', 'gdp', 'inflation', 'government',
+        'intervention', 'regulation', 'externality', 'externalities', 'public goods',
+        'market failure', 'efficiency', 'equity', 'welfare', 'subsidy',
+        'tax', 'taxation', 'elasticity', 'surplus', 'deadweight loss',
+        'fiscal', 'monetary', 'policy', 'trade', 'international'
+    ]
+
+    query_lower = query.lower()
+    return any(keyword in query_lower for keyword in economics_keywords)
+
+
+def synthetic_lexicon(size: int) -> list:
+    """Default lexicon padded with random words, to see how each approach scales"""
+    rng = random.Random(size)
+    extra = ["".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 10)))
+             for _ in range(max(0, size - len(DEFAULT_TOPIC_KEYWORDS)))]
+    return list(DEFAULT_TOPIC_KEYWORDS) + extra
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the RAG topic router")
+    parser.add_argument("--prompts", type=int, default=10000, help="Number of prompts per run")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timed runs")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[40, 200, 1000],
+                        help="Lexicon sizes to compare")
+    args = parser.parse_args()
+
+    random.seed(0)
+    prompts = [random.choice(SAMPLE_PROMPTS) for _ in range(args.prompts)]
+
+    def best_time(func) -> float:
+        runs = timeit.repeat(lambda: [func(prompt) for prompt in prompts], number=1, repeat=args.repeat)
+        return min(runs) / args.prompts * 1e6
+
+    print("🔧 Topic Router Benchmark")
+    print("=" * 50)
+    print(f"Prompts per run: {args.prompts} (best of {args.repeat})")
+
+    # The original hard-coded implementation
+    legacy = best_time(legacy_is_economics_related)
+    router = get_topic_router(normalize_keywords(DEFAULT_TOPIC_KEYWORDS))
+    compiled = best_time(router.is_related)
+    print(f"\nDefault lexicon ({len(DEFAULT_TOPIC_KEYWORDS)} keywords):")
+    print(f"  Legacy keyword scan: {legacy:.2f} µs/prompt")
+    print(f"  Compiled lexicon:    {compiled:.2f} µs/prompt")
+
+    # Admin-edited lexicons can be much larger than the default
+    print("\nScaling with lexicon size (µs/prompt):")
+    print(f"  {'keywords':>8}  {'substring scan':>14}  {'compiled':>8}")
+    for size in args.sizes:
+        lexicon = synthetic_lexicon(size)
+        plain = [keyword.rstrip("*") for keyword in lexicon]
+        scan = best_time(lambda text, plain=plain: any(keyword in text.lower() for keyword in plain))
+        compiled = best_time(TopicRouter(lexicon).is_related)
+        print(f"  {size:>8}  {scan:>14.2f}  {compiled:>8.2f}")
+
+    print("\nFalse positives removed by word boundaries:")
+    for prompt in SAMPLE_PROMPTS:
+        if legacy_is_economics_related(prompt) and not router.is_related(prompt):
+            print(f"  '{prompt}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Benchmark for upload memory use
+Measures peak Python memory while validating, hashing and extracting an uploaded PDF, comparing
+the original flow (read the upload, then parse once for each validation and again for extraction)
+with the app's flow: one ParsedPdf validated, hashed and streamed through stream_chunks() and
+split into child chunks, as ingest_chunks() receives them (embedding and database writes excluded).
+Uploads are extracted in this process whatever PDF_EXTRACT_WORKERS is, so tracemalloc sees all of it.
+Uploads are synthetic scanned-style PDFs with one image per page
+"""
+
+import argparse
+import gc
+import hashlib
+import io
+import logging
+import os
+import time
+import tracemalloc
+from unittest.mock import patch
+
+import PyPDF2
+
+from app.rag.pdf_extraction import ParsedPdf
+
+
+class FakeUpload(io.BytesIO):
+    """Stands in for Streamlit's UploadedFile, which is a BytesIO with a name and size"""
+
+    def __init__(self, data: bytes, name: str):
+        super().__init__(data)
+        self.name = name
+        self.size = len(data)
+
+
+def synthetic_pdf(size_mb: float, pages: int) -> bytes:
+    """PDF with a line of text and an uncompressed image filling each page, about size_mb in total"""
+    image_bytes = max(1, int(size_mb * 1024 * 1024 / pages))
+    side = max(1, int((image_bytes / 3) ** 0.5))
+    image = os.urandom(side * side * 3)
+    image_object = (f"<< /Type /XObject /Subtype /Image /Width {side} /Height {side} "
+                    f"/ColorSpace /DeviceRGB /BitsPerComponent 8 /Length {len(image)} >>\nstream\n").encode()
+    image_object += image + b"\nendstream"
+
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>",
+               ("<< /Type /Pages /Kids [%s] /Count %d >>"
+                % (" ".join(f"{4 + 3 * i} 0 R" for i in range(pages)), pages)).encode(),
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    for i in range(pages):
+        stream = f"q 500 0 0 500 50 200 cm /Im1 Do Q BT /F1 12 Tf 50 750 Td (Page {i + 1} about market prices.) Tj ET"
+        objects.append((f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                        f"/Resources << /Font << /F1 3 0 R >> /XObject << /Im1 {6 + 3 * i} 0 R >> >> "
+                        f"/Contents {5 + 3 * i} 0 R >>").encode())
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream".encode())
+        objects.append(image_object)
+
+    parts, offsets, length = [b"%PDF-1.4\n"], [], 9
+    for number, body in enumerate(objects, 1):
+        offsets.append(length)
+        obj = b"%d 0 obj\n" % number + body + b"\nendobj\n"
+        parts.append(obj)
+        length += len(obj)
+    parts.append(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+    parts.append("".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode())
+    parts.append(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{length}\n%%EOF\n".encode())
+    return b"".join(parts)
+
+
+def legacy_flow(upload: FakeUpload):
+    """The original path: size preview, read(), two validation parses and a third parse to extract"""
+    len(upload.getvalue())  # Sidebar size preview
+    file_content = upload.read()
+    for _ in range(2):  # process_uploaded_files() and process_uploaded_file() both validated
+        reader = PyPDF2.PdfReader(io.BytesIO(file_content))
+        len(reader.pages), reader.is_encrypted
+    hashlib.sha256(file_content).hexdigest()
+    reader = PyPDF2.PdfReader(io.BytesIO(file_content))
+    text = "".join(f"\n\n--- Page {n} ---\n" + page.extract_text() for n, page in enumerate(reader.pages, 1))
+    return text
+
+
+def parsed_flow(upload: FakeUpload, processor):
+    """The current path: one ParsedPdf validated, hashed and streamed into parent and child chunks"""
+    upload.size  # Sidebar size preview
+    document = ParsedPdf(upload.getvalue())
+    validation = processor.validate_uploaded_file(document, upload.name)
+    if not validation['valid']:
+        raise ValueError(validation['error'])
+    document.sha256
+    children = sum(len(processor.split_children(parent)) for parent in processor.stream_chunks(document))
+    document.close()
+    return children
+
+
+def measure(flow, data: bytes, *args) -> tuple:
+    """(peak MB allocated above the upload itself, seconds)"""
+    upload = FakeUpload(data, "upload.pdf")
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    flow(upload, *args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024 / 1024, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark peak memory of PDF upload processing")
+    parser.add_argument("--size-mb", type=float, nargs="+", default=[10, 25, 45],
+                        help="Upload sizes in MB (uploads over 50 MB are rejected)")
+    parser.add_argument("--pages", type=int, default=100, help="Pages per synthetic upload")
+    parser.add_argument("--extract-workers", type=int, default=4,
+                        help="PDF_EXTRACT_WORKERS for the app's flow (uploads are still extracted in-process)")
+    args = parser.parse_args()
+
+    secrets = {
+        "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "sk-benchmark"),  # No API calls are made
+        "PDF_EXTRACT_WORKERS": args.extract_workers,
+        "EMBEDDING_CACHE_PATH": "",
+    }
+    with patch('streamlit.secrets', secrets):
+        from process_pdf import PDFEmbeddingProcessor
+        processor = PDFEmbeddingProcessor()
+    logging.disable(logging.INFO)  # stream_chunks() logs every upload
+
+    print("📄 Upload Memory Benchmark")
+    print("=" * 60)
+    print(f"{'size MB':>8}  {'legacy peak MB':>15}  {'s':>6}  {'app peak MB':>15}  {'s':>6}")
+    for size_mb in args.size_mb:
+        data = synthetic_pdf(size_mb, args.pages)
+        legacy_peak, legacy_time = measure(legacy_flow, data)
+        parsed_peak, parsed_time = measure(parsed_flow, data, processor)
+        print(f"{len(data) / 1024 / 1024:>8.1f}  {legacy_peak:>15.1f}  {legacy_time:>6.2f}  "
+              f"{parsed_peak:>15.1f}  {parsed_time:>6.2f}")
+
+    print("\nPeak is memory allocated during processing, not counting the upload's own buffer.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Shared test fakes
+A byte-level stand-in for tiktoken, Streamlit secrets that let the app modules load offline,
+a writer for minimal text PDFs, and a scratch database schema for tests that need Postgres
+"""
+
+import os
+from unittest.mock import patch
+
+import psycopg2
+import psycopg2.extensions
+import pytest
+
+
+class ByteEncoding:
+    """One token per UTF-8 byte, with the tiktoken methods the app uses"""
+
+    def encode(self, text, **kwargs):
+        return list(text.encode("utf-8"))
+
+    def decode_tokens_bytes(self, tokens):
+        return [bytes([token]) for token in tokens]
+
+
+def write_pdf(pages):
+    """Minimal PDF with one line of Helvetica text per page"""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>",
+               "<< /Type /Pages /Kids [%s] /Count %d >>" % (" ".join(f"{4 + 2 * i} 0 R" for i in range(len(pages))),
+                                                          len(pages)),
+               "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    for i, text in enumerate(pages):
+        stream = f"BT /F1 12 Tf 50 750 Td ({text}) Tj ET"
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>")
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+
+    pdf, offsets = b"%PDF-1.4\n", []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    pdf += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    pdf += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return pdf
+
+
+@pytest.fixture
+def make_pdf():
+    """Builds a PDF from a list of page texts"""
+    return write_pdf
+
+
+@pytest.fixture
+def offline_secrets():
+    """
+    Patched Streamlit secrets (add keys to the returned dict) and a byte-level tiktoken,
+    so the app modules import and construct without secrets.toml or tokenizer downloads
+    """
+    secrets = {"OPENAI_API_KEY": "test", "EMBEDDING_CACHE_PATH": ""}
+    with patch("streamlit.secrets", secrets), patch("tiktoken.get_encoding", lambda name: ByteEncoding()):
+        yield secrets
+
+
+@pytest.fixture
+def handler(offline_secrets):
+    """RAG handler with default settings"""
+    from app.rag.rag_handler import RAGHandler
+    return RAGHandler()
+
+
+@pytest.fixture
+def processor(offline_secrets):
+    """PDF processor without an embedding cache"""
+    from process_pdf import PDFEmbeddingProcessor
+    return PDFEmbeddingProcessor()
+
+
+@pytest.fixture
+def database(offline_secrets):
+    """
+    Scratch schema with the app's tables, and the modules pointed at it, dropped afterwards
+    Needs a Postgres with pgvector at TEST_DB_CONNECTION (mark tests using it to skip without one)
+    """
+    base_dsn = os.environ["TEST_DB_CONNECTION"]
+    schema = "rag_test"
+    dsn = psycopg2.extensions.make_dsn(base_dsn, options=f"-c search_path={schema},public")
+    admin = psycopg2.connect(base_dsn)
+    admin.autocommit = True
+    with admin.cursor() as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema};")
+
+    offline_secrets.update(DB_CONNECTION=dsn, PDF_EXTRACT_WORKERS=1)
+    from app.db import database_connection
+    database_connection._pool = None
+    database_connection.initialize_db()
+    yield dsn
+    if database_connection._pool is not None:
+        database_connection._pool.closeall()
+        database_connection._pool = None
+
+    with admin.cursor() as cur:
+        cur.execute(f"DROP SCHEMA {schema} CASCADE;")
+    admin.close()
@@ -10,6 +10,7 @@ from sidebar import setup_sidebar
 from app.db.database_connection import get_app_description, get_app_title, initialize_db, update_app_description
 from app.instructions.instructions_handler import get_latest_instructions
 from app.rag.rag_handler import rag_handler
+from app.rag.answer_cache import answer_cache, instructions_version
 import uuid
 
 app_title = get_app_title()
@@ -93,9 +94,46 @@ if prompt := st.chat_input("What is up?"):
     st.session_state.messages.append(
         {"role": "user", "content": prompt})
 
+    # Semantic answer cache: near-duplicate first-turn questions under the same
+    # instructions and materials are answered from the cache without calling the model
+    use_rag = st.session_state.get("use_rag", True)
+    query_embedding = None
+    cached_answer = None
+    cache_version = instructions_version(custom_instructions)
+    cache_file_ids = []
+    is_first_turn = len(st.session_state.messages) == 1
+    if answer_cache.enabled and is_first_turn:
+        try:
+            query_embedding = rag_handler.get_query_embedding(prompt)
+            cache_file_ids = rag_handler.get_active_file_ids() if use_rag else []
+            cached_answer = answer_cache.lookup(query_embedding, cache_version, cache_file_ids)
+        except Exception as e:
+            logging.error(f"Semantic cache lookup failed: {e}")
+            query_embedding = None
+
+    # Start retrieval straight away so it overlaps rendering and history assembly
+    retrieval = None
+    if use_rag and cached_answer is None:
+        # Search all available materials (no user filtering for regular users)
+        retrieval = rag_handler.start_retrieval(prompt, top_k=4, similarity_threshold=0.6,
+                                                query_embedding=query_embedding)
+
     with st.chat_message("user"):
         st.markdown(prompt)
 
+    if cached_answer is not None:
+        with st.chat_message("assistant"):
+            message_placeholder = st.empty()
+            full_response = ""
+            for piece in answer_cache.stream(cached_answer):
+                full_response += piece
+                message_placeholder.markdown(full_response + "▌")
+            insert_chat_log(prompt, full_response, st.session_state["conversation_id"], st.session_state.get("user_name"))
+            message_placeholder.markdown(full_response)
+
+        st.session_state.messages.append(
+            {"role": "assistant", "content": full_response})
+        st.stop()
 
     # Prepend custom instructions and RAG context to the conversation context for processing
     conversation_context = []
@@ -105,34 +143,39 @@ if prompt := st.chat_input("What is up?"):
         conversation_context.append(
             {"role": "system", "content": custom_instructions})
     
+    # Assemble the chat history while retrieval is still running
+    history_messages = [
+        {"role": m["role"], "content": m["content"]}
+        for m in st.session_state.messages
+    ]
+
     # Add RAG context if enabled and relevant
     rag_context = ""
-    if st.session_state.get("use_rag", True):
+    # Answers given without the context a finished search would have added are not cached
+    retrieval_complete = retrieval is None
+    if retrieval is not None:
         try:
-            # Check if query might benefit from economics context
-            if rag_handler.is_economics_related(prompt):
-                with st.spinner("🔍 Searching course materials..."):
-                    # Search all available materials (no user filtering for regular users)
-                    rag_context = rag_handler.retrieve_context(prompt, top_k=4, similarity_threshold=0.6)
-                    
-                if rag_context:
-                    st.info("📚 Found relevant content from your Economics materials")
-                    conversation_context.append(
-                        {"role": "system", "content": rag_context})
-                else:
-                    st.info("🔍 Searched course materials but found no highly relevant content")
+            with st.spinner("🔍 Searching course materials..."):
+                searched, rag_context, timed_out = rag_handler.wait_for_retrieval(retrieval)
+            retrieval_complete = not timed_out
+
+            if rag_context:
+                st.info("📚 Found relevant content from your course materials")
+                conversation_context.append(
+                    {"role": "system", "content": rag_context})
+            elif timed_out:
+                st.info("⏱️ Course material search took too long, answering without it")
+            elif searched:
+                st.info("🔍 Searched course materials but found no highly relevant content")
         except Exception as e:
             logging.error(f"RAG retrieval failed: {e}")
             st.warning("⚠️ Could not search course materials, proceeding without context")
-    else:
-        # RAG is disabled - check if this was an economics question
-        if rag_handler.is_economics_related(prompt):
+    elif not use_rag:
+        # RAG is disabled - check if this was a course-related question
+        if rag_handler.is_topic_related(prompt):
             st.info("📚 Course material search is currently disabled by your educator")
 
-    conversation_context += [
-        {"role": m["role"], "content": m["content"]}
-        for m in st.session_state.messages
-    ]
+    conversation_context += history_messages
 
     with st.chat_message("assistant"):
         message_placeholder = st.empty()
@@ -147,6 +190,9 @@ if prompt := st.chat_input("What is up?"):
         insert_chat_log(prompt, full_response, st.session_state["conversation_id"], st.session_state.get("user_name"))
         message_placeholder.markdown(full_response)
 
+    if answer_cache.enabled and is_first_turn and query_embedding is not None and retrieval_complete:
+        answer_cache.store(query_embedding, cache_version, cache_file_ids, full_response)
+
     # Append the assistant's response to the messages for display
     st.session_state.messages.append(
         {"role": "assistant", "content": full_response})
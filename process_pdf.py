@@ -9,104 +9,251 @@ import logging
 import time
 import sys
 import argparse
-import glob
+import fnmatch
 import gc
-import io
-from typing import List, Tuple, Optional
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterable, Iterator, List, Tuple, Optional, Union
 import hashlib
 
-import PyPDF2
 import tiktoken
-from openai import OpenAI
+from psycopg2.extras import execute_values
+from openai import BadRequestError, OpenAI, RateLimitError
 import streamlit as st
-from app.db.database_connection import connect_to_db, insert_ingested_file, update_ingested_file_status
+from app.rag.rate_limiter import RateLimiter, retry_after_seconds
+from app.rag.embedding_cache import EmbeddingCache
+from app.rag.chunking import iter_chunks
+from app.rag.pdf_extraction import ParsedPdf, iter_text as iter_pdf_text
+from app.db.database_connection import connect_to_db, get_pool, pooled_connection, insert_ingested_file, update_ingested_file_status, complete_ingested_file
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Page markers inserted into the extracted text, one per PDF page
+PAGE_MARKER = re.compile(r"--- Page (\d+) ---")
+
+
+def page_range(text: str, current_page: Optional[int]) -> Tuple[Optional[int], Optional[int]]:
+    """
+    First and last page of a piece of extracted text, given the page the previous piece ended on
+    Returns (None, None) for text without page markers that does not follow one
+    """
+    markers = list(PAGE_MARKER.finditer(text))
+    if not markers:
+        return current_page, current_page
+    first = current_page
+    if first is None or not text[:markers[0].start()].strip():
+        first = int(markers[0].group(1))
+    return first, int(markers[-1].group(1))
+
+
+def find_pdf_files(directory_path: str, recursive: bool = False, include: Optional[List[str]] = None) -> List[str]:
+    """
+    PDF files in a directory (and its subdirectories when recursive), sorted by path
+    include is a list of glob patterns matched against each file's path relative to the
+    directory or its file name; a file is kept if any pattern matches (default: every PDF)
+    """
+    pdf_files = []
+    for root, dirs, files in os.walk(directory_path):
+        dirs.sort()
+        for name in files:
+            if not name.lower().endswith('.pdf'):
+                continue
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, directory_path).replace(os.sep, '/')
+            if include and not any(fnmatch.fnmatch(relative, pattern) or fnmatch.fnmatch(name, pattern)
+                                   for pattern in include):
+                continue
+            pdf_files.append(path)
+        if not recursive:
+            break
+    return sorted(pdf_files)
+
 class PDFEmbeddingProcessor:
-    def __init__(self):
-        self.client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+    def __init__(self, embedding_cache_path: Optional[str] = None):
+        # Retries are done here, so rate-limit waits are shared through the rate limiter
+        self.client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"], max_retries=0)
         self.encoding = tiktoken.get_encoding("cl100k_base")
-        self.max_tokens = 800
+        self.extract_workers = int(st.secrets.get("PDF_EXTRACT_WORKERS", min(4, os.cpu_count() or 1)))  # Page extraction processes
+        self.max_tokens = 800  # Parent window size, returned as context
+        self.chunk_overlap_tokens = 0  # Tokens each parent window repeats from the end of the previous one
+        self.child_max_tokens = 150  # Child chunk size, embedded and searched
         self.model = "text-embedding-ada-002"
+        self.embedding_batch_size = 512  # Inputs per embeddings request (API limit 2048)
+        self.embedding_batch_tokens = 100000  # Tokens per embeddings request (API limit 300k)
+        self.embedding_workers = int(st.secrets.get("EMBEDDING_WORKERS", 4))  # Batches in flight at once
+        # Child tokens buffered before a streaming flush (embed and write); bounds ingestion memory
+        # independently of the API batch limits above
+        self.ingest_flush_tokens = int(st.secrets.get("INGEST_FLUSH_TOKENS", 20000))
+        # Embedding requests in flight across every file ingested concurrently
+        self.request_slots = threading.BoundedSemaphore(self.embedding_workers)
+        # Shared requests/tokens per minute budget for the account's embedding quota
+        self.rate_limiter = RateLimiter(requests_per_minute=int(st.secrets.get("EMBEDDING_RPM", 3000)),
+                                        tokens_per_minute=int(st.secrets.get("EMBEDDING_TPM", 1000000)))
+        # Local (model, content hash) -> embedding store checked before any API call; kept in memory
+        # unless EMBEDDING_CACHE_PATH names a file ("" disables)
+        if embedding_cache_path is None:
+            embedding_cache_path = st.secrets.get("EMBEDDING_CACHE_PATH", ":memory:")
+        self.embedding_cache = self.open_embedding_cache(embedding_cache_path)
 
         # Security limits
         self.max_file_size = 50 * 1024 * 1024  # 50MB limit
         self.max_pages = 1000  # Maximum pages to process
+        self.rag_table_initialized = False
         
-    def extract_text_from_pdf(self, pdf_path: str) -> str:
-        """Extract text from PDF file"""
-        logger.info(f"Extracting text from PDF: {pdf_path}")
-        
-        with open(pdf_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            text = ""
-            
-            for page_num, page in enumerate(pdf_reader.pages):
-                try:
-                    page_text = page.extract_text()
-                    text += f"\n\n--- Page {page_num + 1} ---\n"
-                    text += page_text
-                except Exception as e:
-                    logger.warning(f"Failed to extract text from page {page_num + 1}: {e}")
-                    continue
-                    
-        logger.info(f"Successfully extracted text from {len(pdf_reader.pages)} pages")
-        return text.strip()
-    
-    def chunk_text(self, text: str) -> List[str]:
-        """Split text into chunks of max_tokens using tiktoken"""
-        logger.info("Chunking text into smaller pieces...")
-        
-        # Tokenize the entire text
-        tokens = self.encoding.encode(text)
-        
-        chunks = []
-        current_chunk_tokens = []
-        
-        # Split into sentences first for better chunking
-        sentences = text.split('. ')
-        current_tokens = 0
-        current_text = ""
-        
-        for sentence in sentences:
-            sentence_tokens = len(self.encoding.encode(sentence))
-            
-            if current_tokens + sentence_tokens > self.max_tokens and current_text:
-                # Save current chunk and start new one
-                chunks.append(current_text.strip())
-                current_text = sentence + ". "
-                current_tokens = sentence_tokens
-            else:
-                current_text += sentence + ". "
-                current_tokens += sentence_tokens
-        
-        # Add the last chunk
-        if current_text.strip():
-            chunks.append(current_text.strip())
-        
-        logger.info(f"Created {len(chunks)} chunks")
-        return chunks
-    
-    def get_embedding_with_retry(self, text: str, max_retries: int = 3) -> List[float]:
-        """Get embedding with retry logic"""
+    def stream_chunks(self, source: Union[str, ParsedPdf]) -> Iterator[str]:
+        """
+        Parent windows of a PDF (a path or a parsed upload), chunked as its pages are extracted
+        Chunks span page boundaries; only the pages and text not yet chunked are held
+        """
+        logger.info(f"Streaming text from PDF: {source if isinstance(source, str) else 'uploaded file'}")
+        pages = iter_pdf_text(source, workers=self.extract_workers)
+        return iter_chunks(pages, self.encoding, self.max_tokens, overlap_tokens=self.chunk_overlap_tokens)
+
+    def create_embeddings(self, inputs, token_count: int, max_retries: int = 3):
+        """
+        One embeddings request within the rate limiter's RPM/TPM budget, with retries
+        A 429 pauses every worker for its Retry-After time (exponential backoff without one);
+        other failures back off exponentially, and invalid inputs are not retried
+        """
         for attempt in range(max_retries):
+            self.rate_limiter.acquire(token_count)
             try:
-                response = self.client.embeddings.create(
-                    model=self.model,
-                    input=text
-                )
-                return response.data[0].embedding
-                
+                with self.request_slots:
+                    return self.client.embeddings.create(model=self.model, input=inputs)
+            except BadRequestError:
+                raise
             except Exception as e:
                 logger.warning(f"Embedding attempt {attempt + 1} failed: {e}")
-                if attempt < max_retries - 1:
-                    time.sleep(2 ** attempt)  # Exponential backoff
+                if attempt == max_retries - 1:
+                    raise
+                if isinstance(e, RateLimitError):
+                    delay = retry_after_seconds(e)
+                    self.rate_limiter.pause(delay if delay is not None else 2 ** attempt)
                 else:
-                    raise e
-    
+                    time.sleep(2 ** attempt)  # Exponential backoff
+
+    def get_embedding_with_retry(self, text: str, max_retries: int = 3) -> List[float]:
+        """Get embedding with retry logic, from the local embedding cache when it has it"""
+        content_hash = self.create_content_hash(text)
+        cached = self.get_cached_embeddings([content_hash])
+        if content_hash in cached:
+            return cached[content_hash]
+
+        response = self.create_embeddings(text, self.count_tokens(text), max_retries=max_retries)
+        embedding = response.data[0].embedding
+        self.cache_embeddings([(content_hash, embedding)])
+        return embedding
+
+    @staticmethod
+    def open_embedding_cache(path: Optional[str]) -> Optional[EmbeddingCache]:
+        """Open the local embedding cache, or None when disabled or unavailable"""
+        if not path:
+            return None
+        try:
+            return EmbeddingCache(path)
+        except sqlite3.Error as e:
+            logger.warning(f"Embedding cache {path} unavailable, embedding without it: {e}")
+            return None
+
+    def close(self):
+        """Close the embedding cache"""
+        if self.embedding_cache is not None:
+            self.embedding_cache.close()
+            self.embedding_cache = None
+
+    def get_cached_embeddings(self, content_hashes: List[str]) -> dict:
+        """{content_hash: embedding} for this model from the local cache (empty if disabled or failing)"""
+        if self.embedding_cache is None or not content_hashes:
+            return {}
+        try:
+            return self.embedding_cache.get_many(self.model, content_hashes)
+        except sqlite3.Error as e:
+            logger.warning(f"Embedding cache lookup failed: {e}")
+            return {}
+
+    def cache_embeddings(self, items: List[Tuple[str, List[float]]]):
+        """Write (content_hash, embedding) pairs through to the local cache"""
+        if self.embedding_cache is None or not items:
+            return
+        try:
+            self.embedding_cache.put_many(self.model, items)
+        except sqlite3.Error as e:
+            logger.warning(f"Embedding cache write failed: {e}")
+
+    def embedding_batches(self, token_counts: List[int]) -> List[Tuple[int, int]]:
+        """Split inputs into consecutive (start, end) batches bounded by input count and total tokens"""
+        batches = []
+        start, tokens = 0, 0
+        for i, token_count in enumerate(token_counts):
+            if i > start and (i - start >= self.embedding_batch_size
+                              or tokens + token_count > self.embedding_batch_tokens):
+                batches.append((start, i))
+                start, tokens = i, 0
+            tokens += token_count
+        if start < len(token_counts):
+            batches.append((start, len(token_counts)))
+        return batches
+
+    def get_embeddings_batch(self, texts: List[str], max_retries: int = 3,
+                             token_counts: Optional[List[int]] = None) -> List[Optional[List[float]]]:
+        """
+        Embed texts with one request per token-bounded batch, up to embedding_workers batches in flight
+        Texts in the local embedding cache are not sent, and new embeddings are written through to it.
+        A batch that still fails after retries is embedded item by item, so one bad input only loses
+        itself; returns one embedding per text, None where it could not be embedded
+        """
+        embeddings: List[Optional[List[float]]] = [None] * len(texts)
+        hashes = [self.create_content_hash(text) for text in texts]
+        cached = self.get_cached_embeddings(hashes)
+        missing = [i for i, content_hash in enumerate(hashes) if content_hash not in cached]
+        for i, content_hash in enumerate(hashes):
+            embeddings[i] = cached.get(content_hash)
+        if cached:
+            logger.info(f"Embedding cache: {len(texts) - len(missing)} of {len(texts)} chunks cached")
+
+        if token_counts is None:
+            token_counts = [self.count_tokens(texts[i]) for i in missing]
+        else:
+            token_counts = [token_counts[i] for i in missing]
+        batches = self.embedding_batches(token_counts)
+
+        def embed(batch: Tuple[int, int]):
+            start, end = batch
+            indexes = missing[start:end]
+            try:
+                response = self.create_embeddings([texts[i] for i in indexes], sum(token_counts[start:end]),
+                                                  max_retries=max_retries)
+                for item in response.data:
+                    embeddings[indexes[item.index]] = item.embedding
+                self.cache_embeddings([(hashes[i], embeddings[i]) for i in indexes if embeddings[i] is not None])
+            except Exception as e:
+                logger.warning(f"Embedding batch failed ({end - start} inputs), embedding one by one: {e}")
+                for i in indexes:
+                    try:
+                        embeddings[i] = self.get_embedding_with_retry(texts[i], max_retries=1)
+                    except Exception as e:
+                        logger.error(f"Failed to embed input {i + 1}: {e}")
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.embedding_workers, len(batches))),
+                                thread_name_prefix="embedding") as executor:
+            for done, _ in enumerate(executor.map(embed, batches), 1):
+                logger.info(f"Embedded batch {done}/{len(batches)}")
+        return embeddings
+
+    def embedding_report(self) -> str:
+        """One-line embedding throughput summary from the rate limiter and the local cache"""
+        report = self.rate_limiter.report()
+        summary = (f"{report['requests']} requests, {report['tokens']} tokens in {report['elapsed_seconds']:.1f}s "
+                   f"({report['requests_per_minute']:.0f} RPM, {report['tokens_per_minute']:.0f} TPM), "
+                   f"{report['rate_limited']} rate-limited, {report['throttled_seconds']:.1f}s throttled")
+        if self.embedding_cache is not None:
+            summary += f", {self.embedding_cache.hits} cache hits"
+        return summary
+
     def create_content_hash(self, content: str) -> str:
         """Create hash of content to prevent duplicates"""
         return hashlib.md5(content.encode()).hexdigest()
@@ -119,8 +266,11 @@ class PDFEmbeddingProcessor:
                 hash_sha256.update(chunk)
         return hash_sha256.hexdigest()
 
-    def validate_uploaded_file(self, file_content: bytes, filename: str) -> dict:
-        """Validate uploaded file for security and format compliance"""
+    def validate_uploaded_file(self, file_content: Union[bytes, ParsedPdf], filename: str) -> dict:
+        """
+        Validate uploaded file for security and format compliance
+        Pass a ParsedPdf to keep its parse for hashing and extraction
+        """
         validation_result = {
             'valid': False,
             'error': None,
@@ -128,8 +278,10 @@ class PDFEmbeddingProcessor:
         }
 
         try:
+            document = file_content if isinstance(file_content, ParsedPdf) else ParsedPdf(file_content)
+
             # Check file size
-            file_size = len(file_content)
+            file_size = document.size
             if file_size > self.max_file_size:
                 validation_result['error'] = f"File too large ({file_size / 1024 / 1024:.1f}MB). Maximum allowed: {self.max_file_size / 1024 / 1024}MB"
                 return validation_result
@@ -144,16 +296,15 @@ class PDFEmbeddingProcessor:
                 return validation_result
 
             # Validate PDF format by trying to read it
-            pdf_reader = PyPDF2.PdfReader(io.BytesIO(file_content))
+            page_count = document.pages
 
             # Check page count
-            page_count = len(pdf_reader.pages)
             if page_count > self.max_pages:
                 validation_result['error'] = f"PDF has too many pages ({page_count}). Maximum allowed: {self.max_pages}"
                 return validation_result
 
             # Check if PDF is encrypted
-            if pdf_reader.is_encrypted:
+            if document.is_encrypted:
                 validation_result['error'] = "Encrypted PDFs are not supported for security reasons"
                 return validation_result
 
@@ -171,53 +322,28 @@ class PDFEmbeddingProcessor:
             validation_result['error'] = f"Invalid PDF file: {str(e)}"
             return validation_result
 
-    def extract_text_from_memory(self, file_content: bytes, filename: str) -> str:
-        """Extract text from PDF in memory without saving to disk"""
-        logger.info(f"Extracting text from uploaded file: {filename}")
-
-        try:
-            # Create PDF reader from memory buffer
-            pdf_reader = PyPDF2.PdfReader(io.BytesIO(file_content))
-            text = ""
-
-            for page_num, page in enumerate(pdf_reader.pages):
-                try:
-                    page_text = page.extract_text()
-                    text += f"\n\n--- Page {page_num + 1} ---\n"
-                    text += page_text
-                except Exception as e:
-                    logger.warning(f"Failed to extract text from page {page_num + 1}: {e}")
-                    continue
-
-            logger.info(f"Successfully extracted text from {len(pdf_reader.pages)} pages")
-            return text.strip()
-
-        except Exception as e:
-            logger.error(f"Failed to extract text from {filename}: {e}")
-            raise Exception(f"Text extraction failed: {str(e)}")
-
-    def create_file_hash_from_content(self, file_content: bytes) -> str:
-        """Create hash from file content in memory"""
-        return hashlib.sha256(file_content).hexdigest()
-
-    def process_uploaded_file(self, file_content: bytes, filename: str) -> tuple[int, int]:
+    def process_uploaded_file(self, file_content: Union[bytes, ParsedPdf], filename: str,
+                              validation: Optional[dict] = None) -> tuple[int, int]:
         """
         Securely process uploaded PDF from memory
+        Pass the ParsedPdf and the result of validate_uploaded_file() to skip validating again
         Returns (successful_chunks, failed_chunks)
         """
+        document = file_content if isinstance(file_content, ParsedPdf) else ParsedPdf(file_content)
+        file_content = None
         try:
             # Security validation
-            validation = self.validate_uploaded_file(file_content, filename)
+            if validation is None:
+                validation = self.validate_uploaded_file(document, filename)
+                # Log warnings
+                for warning in validation['warnings']:
+                    logger.warning(warning)
             if not validation['valid']:
                 raise Exception(validation['error'])
 
-            # Log warnings
-            for warning in validation['warnings']:
-                logger.warning(warning)
-
             # Get file info for tracking
-            file_size = len(file_content)
-            file_hash = self.create_file_hash_from_content(file_content)
+            file_size = document.size
+            file_hash = document.sha256
 
             logger.info(f"Processing uploaded file: {filename} ({file_size} bytes)")
 
@@ -232,54 +358,13 @@ class PDFEmbeddingProcessor:
                 raise Exception("Database error: could not track file ingestion")
 
             try:
-                # Initialize database
-                self.initialize_rag_table()
-
-                # Extract text from memory
-                text = self.extract_text_from_memory(file_content, filename)
+                # Initialize database (once: the migrations lock rag_chunks against concurrent ingestion)
+                if not self.rag_table_initialized:
+                    self.initialize_rag_table()
 
-                # Immediately clear file content from memory for security
-                file_content = None
-                gc.collect()
-
-                # Chunk text
-                chunks = self.chunk_text(text)
-
-                # Clear original text for security
-                text = None
-                gc.collect()
-
-                logger.info(f"Processing {len(chunks)} chunks...")
-
-                successful_chunks = 0
-                failed_chunks = 0
-
-                for i, chunk in enumerate(chunks):
-                    try:
-                        # Get embedding
-                        embedding = self.get_embedding_with_retry(chunk)
-
-                        # Store in database
-                        self.store_chunk_embedding(chunk, embedding, file_id)
-
-                        successful_chunks += 1
-
-                        # Rate limiting
-                        time.sleep(0.1)
-
-                    except Exception as e:
-                        logger.error(f"Failed to process chunk {i + 1}: {e}")
-                        failed_chunks += 1
-                        continue
-
-                # Update file status
-                if failed_chunks == 0:
-                    update_ingested_file_status(file_id, 'completed', chunks_count=successful_chunks)
-                    logger.info(f"Processing complete! All {successful_chunks} chunks processed successfully")
-                else:
-                    error_msg = f"Partial failure: {failed_chunks} chunks failed"
-                    update_ingested_file_status(file_id, 'completed', chunks_count=successful_chunks, error_message=error_msg)
-                    logger.warning(f"Processing complete with warnings! Success: {successful_chunks}, Failed: {failed_chunks}")
+                # Pages are extracted from memory, chunked, embedded and written as they stream;
+                # the chunks and the completed status are committed together
+                successful_chunks, failed_chunks = self.ingest_chunks(self.stream_chunks(document), file_id, filename)
 
                 return successful_chunks, failed_chunks
 
@@ -291,7 +376,7 @@ class PDFEmbeddingProcessor:
 
         finally:
             # Ensure cleanup
-            file_content = None
+            document.close()
             gc.collect()
 
     def is_already_processed_by_hash(self, file_hash: str) -> bool:
@@ -327,15 +412,33 @@ class PDFEmbeddingProcessor:
                 # Enable pgvector extension
                 cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
                 
-                # Create the RAG table
+                # Parent windows returned as context; their text is assembled from their child chunks
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS rag_parents (
+                        id SERIAL PRIMARY KEY,
+                        file_id INTEGER REFERENCES ingested_files(id) ON DELETE CASCADE,
+                        parent_index INTEGER NOT NULL,
+                        token_count INTEGER,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    );
+                """)
+
+                # Create the RAG table (child chunks, embedded and searched)
                 cur.execute("""
                     CREATE TABLE IF NOT EXISTS rag_chunks (
                         id SERIAL PRIMARY KEY,
                         content TEXT NOT NULL,
                         embedding VECTOR(1536),
-                        content_hash VARCHAR(32) UNIQUE,
+                        content_hash VARCHAR(32),
+                        token_count INTEGER,
                         file_id INTEGER REFERENCES ingested_files(id) ON DELETE CASCADE,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                        parent_id INTEGER REFERENCES rag_parents(id) ON DELETE CASCADE,
+                        child_index INTEGER,
+                        file_name TEXT,
+                        page_start INTEGER,
+                        page_end INTEGER,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        content_tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('english', content)) STORED
                     );
                 """)
 
@@ -352,13 +455,130 @@ class PDFEmbeddingProcessor:
                     END $$;
                 """)
                 
-                # Create index for similarity search
+                # Add token_count column if it doesn't exist (for existing databases)
+                cur.execute("""
+                    DO $$
+                    BEGIN
+                        BEGIN
+                            ALTER TABLE rag_chunks ADD COLUMN token_count INTEGER;
+                        EXCEPTION
+                            WHEN duplicate_column THEN
+                            -- Column already exists, do nothing
+                        END;
+                    END $$;
+                """)
+
+                # Add full-text search column if it doesn't exist (for existing databases)
+                cur.execute("""
+                    DO $$
+                    BEGIN
+                        BEGIN
+                            ALTER TABLE rag_chunks ADD COLUMN content_tsv TSVECTOR
+                                GENERATED ALWAYS AS (to_tsvector('english', content)) STORED;
+                        EXCEPTION
+                            WHEN duplicate_column THEN
+                            -- Column already exists, do nothing
+                        END;
+                    END $$;
+                """)
+
+                # Add parent columns if they don't exist (for existing databases)
+                cur.execute("""
+                    DO $$
+                    BEGIN
+                        BEGIN
+                            ALTER TABLE rag_chunks
+                                ADD COLUMN parent_id INTEGER REFERENCES rag_parents(id) ON DELETE CASCADE,
+                                ADD COLUMN child_index INTEGER;
+                        EXCEPTION
+                            WHEN duplicate_column THEN
+                            -- Columns already exist, do nothing
+                        END;
+                    END $$;
+                """)
+
+                # Add source metadata columns if they don't exist (for existing databases);
+                # file names are denormalized so citations need no join
+                cur.execute("""
+                    DO $$
+                    BEGIN
+                        BEGIN
+                            ALTER TABLE rag_chunks
+                                ADD COLUMN file_name TEXT,
+                                ADD COLUMN page_start INTEGER,
+                                ADD COLUMN page_end INTEGER;
+                            UPDATE rag_chunks c SET file_name = f.file_name
+                            FROM ingested_files f WHERE c.file_id = f.id;
+                        EXCEPTION
+                            WHEN duplicate_column THEN
+                            -- Columns already exist, do nothing
+                        END;
+                    END $$;
+                """)
+
+                # Page-range restrictions filter on file and pages
+                cur.execute("""
+                    CREATE INDEX IF NOT EXISTS rag_chunks_file_pages_idx
+                    ON rag_chunks (file_id, page_start, page_end);
+                """)
+
+                # Standalone chunks are unique per file rather than globally, so deleting one file
+                # never removes text another file shares; child chunks are unique by position in
+                # their parent, so repeated text never leaves a gap in a parent window
+                cur.execute("ALTER TABLE rag_chunks DROP CONSTRAINT IF EXISTS rag_chunks_content_hash_key;")
+                cur.execute("""
+                    CREATE UNIQUE INDEX IF NOT EXISTS rag_chunks_file_content_hash_idx
+                    ON rag_chunks (file_id, content_hash) WHERE parent_id IS NULL;
+                """)
+                cur.execute("""
+                    CREATE UNIQUE INDEX IF NOT EXISTS rag_chunks_parent_child_idx
+                    ON rag_chunks (parent_id, child_index);
+                """)
+
+                # Ingestion looks up already-embedded text by hash across all files
                 cur.execute("""
-                    CREATE INDEX IF NOT EXISTS rag_chunks_embedding_idx 
-                    ON rag_chunks USING ivfflat (embedding vector_cosine_ops);
+                    CREATE INDEX IF NOT EXISTS rag_chunks_content_hash_idx
+                    ON rag_chunks (content_hash);
+                """)
+
+                # Create HNSW index for similarity search. IVFFlat indexes were created here on an
+                # empty table, so their lists were never trained and searches missed most chunks
+                cur.execute("""
+                    DO $$
+                    BEGIN
+                        IF EXISTS (SELECT 1 FROM pg_indexes
+                                   WHERE schemaname = current_schema() AND indexname = 'rag_chunks_embedding_idx'
+                                     AND indexdef LIKE '%ivfflat%') THEN
+                            DROP INDEX rag_chunks_embedding_idx;
+                        END IF;
+                        BEGIN
+                            CREATE INDEX IF NOT EXISTS rag_chunks_embedding_idx
+                            ON rag_chunks USING hnsw (embedding vector_cosine_ops);
+                        EXCEPTION
+                            WHEN undefined_object THEN
+                            -- pgvector < 0.5.0 has no HNSW, exact scans are used instead
+                        END;
+                    END $$;
+                """)
+
+                # The corpus generation is bumped from ingested_files (see initialize_db); a statement
+                # trigger here held a row lock for a whole ingestion transaction, serializing writers
+                cur.execute("DROP TRIGGER IF EXISTS rag_chunks_corpus_generation ON rag_chunks;")
+
+                # Create index for restricting searches to routed or selected files
+                cur.execute("""
+                    CREATE INDEX IF NOT EXISTS rag_chunks_file_id_idx
+                    ON rag_chunks (file_id);
+                """)
+
+                # Create index for full-text (lexical) search
+                cur.execute("""
+                    CREATE INDEX IF NOT EXISTS rag_chunks_content_tsv_idx
+                    ON rag_chunks USING GIN (content_tsv);
                 """)
                 
                 conn.commit()
+                self.rag_table_initialized = True
                 logger.info("RAG table initialized successfully")
                 
         except Exception as e:
@@ -367,50 +587,180 @@ class PDFEmbeddingProcessor:
         finally:
             conn.close()
     
-    def chunk_exists(self, content_hash: str) -> bool:
-        """Check if a chunk already exists in the database"""
-        conn = connect_to_db()
-        if conn is None:
-            return False
-            
-        try:
-            with conn.cursor() as cur:
-                cur.execute("SELECT id FROM rag_chunks WHERE content_hash = %s", (content_hash,))
-                return cur.fetchone() is not None
-        except Exception as e:
-            logger.error(f"Error checking chunk existence: {e}")
-            return False
-        finally:
-            conn.close()
-    
-    def store_chunk_embedding(self, content: str, embedding: List[float], file_id: int):
-        """Store chunk and embedding in database"""
-        content_hash = self.create_content_hash(content)
+    def count_tokens(self, text: str) -> int:
+        """Count tokens in text"""
+        return len(self.encoding.encode(text))
 
-        # Skip if already exists
-        if self.chunk_exists(content_hash):
-            logger.debug("Chunk already exists, skipping...")
-            return
-
-        conn = connect_to_db()
-        if conn is None:
-            raise Exception("Failed to connect to database")
+    def split_children(self, parent_text: str) -> List[str]:
+        """
+        Split a parent window into child chunks of up to child_max_tokens at sentence boundaries
+        Children are contiguous pieces of the parent, so joining them gives back the parent text
+        """
+        # Sentences keep their trailing whitespace; overlong sentences are split between words
+        pieces = []
+        for sentence in re.findall(r'.*?(?:[.!?]\s+|$)', parent_text, flags=re.DOTALL):
+            if not sentence:
+                continue
+            if len(self.encoding.encode(sentence)) <= self.child_max_tokens:
+                pieces.append(sentence)
+            else:
+                pieces.extend(re.findall(r'\S+\s*|\s+', sentence))
+
+        children = []
+        current, current_tokens = "", 0
+        for piece in pieces:
+            piece_tokens = len(self.encoding.encode(piece))
+            if current and current_tokens + piece_tokens > self.child_max_tokens:
+                children.append(current)
+                current, current_tokens = "", 0
+            current += piece
+            current_tokens += piece_tokens
+
+        if current.strip():
+            children.append(current)
+        elif children:
+            children[-1] += current
+        return children
+
+    def write_parent_chunks(self, cur, file_id: int, file_name: Optional[str],
+                            parents: List[Tuple[int, List[str], List[int], List[List[float]], Optional[int]]]) -> int:
+        """
+        Bulk-insert parent windows and their child chunks with execute_values (no commit)
+        parents are (parent index, children, child token counts, child embeddings, start page) tuples;
+        children carry the file name and the pages they span (start_page is the page the previous
+        chunk ended on). Returns the number of children written
+        """
+        if not parents:
+            return 0
+
+        rows = execute_values(cur, """
+            INSERT INTO rag_parents (file_id, parent_index, token_count) VALUES %s
+            RETURNING parent_index, id
+        """, [(file_id, parent_index, sum(token_counts)) for parent_index, _, token_counts, _, _ in parents],
+            fetch=True)
+        parent_ids = dict(rows)
+
+        child_rows = []
+        for parent_index, children, token_counts, embeddings, start_page in parents:
+            for child_index, (child, token_count, embedding) in enumerate(zip(children, token_counts, embeddings)):
+                first, start_page = page_range(child, start_page)
+                child_rows.append((child, embedding, self.create_content_hash(child), file_id, token_count,
+                                   parent_ids[parent_index], child_index, file_name, first, start_page))
+        execute_values(cur, """
+            INSERT INTO rag_chunks (content, embedding, content_hash, file_id, token_count,
+                                    parent_id, child_index, file_name, page_start, page_end)
+            VALUES %s
+        """, child_rows, template="(%s, %s::vector, %s, %s, %s, %s, %s, %s, %s, %s)")
+        return len(child_rows)
+
+    def find_stored_embeddings(self, conn, content_hashes) -> dict:
+        """
+        Embeddings already stored for any of the given content hashes, in one = ANY(%s) query
+        Returns {content_hash: embedding}, with embeddings in pgvector text form (compact, and
+        written back with a ::vector cast)
+        """
+        if not content_hashes:
+            return {}
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT DISTINCT ON (content_hash) content_hash, embedding::text
+                FROM rag_chunks
+                WHERE content_hash = ANY(%s) AND embedding IS NOT NULL
+            """, (list(content_hashes),))
+            return dict(cur.fetchall())
+
+    def store_parent_chunks(self, conn, chunks: Iterable[str], file_id: int,
+                            file_name: Optional[str] = None) -> Tuple[int, int]:
+        """
+        Embed a file's parent windows and write them on conn as they arrive, leaving the commit to the caller
+        chunks may be a generator: parents are buffered only until their children reach
+        ingest_flush_tokens, then embedded and bulk-written, so memory is bounded by that threshold
+        rather than the file. Text already stored (in any file, or an earlier batch of this one) reuses its
+        embedding and text repeated within a batch is embedded once, so only new text is sent to
+        the API. A parent fails only if one of its own children could not be embedded.
+        Returns (successful, failed) parents
+        """
+        successful_chunks = 0
+        failed_chunks = 0
+        reused_chunks = 0
+        unembeddable = set()
+        pending = []  # (parent index, children, child token counts, child hashes, start page)
+        pending_tokens = 0
+
+        def flush():
+            nonlocal successful_chunks, failed_chunks, reused_chunks, pending_tokens
+            # Batches already written on conn are visible here, uncommitted, like any stored text
+            hashes = {content_hash for *_, child_hashes, _ in pending for content_hash in child_hashes}
+            known = self.find_stored_embeddings(conn, hashes - unembeddable)
+            reused_chunks += len(known)
+
+            queued = {}  # content hash -> (text, token count) to embed
+            for _, children, token_counts, child_hashes, _ in pending:
+                for child, token_count, content_hash in zip(children, token_counts, child_hashes):
+                    if content_hash not in known and content_hash not in unembeddable:
+                        queued.setdefault(content_hash, (child, token_count))
+            if queued:
+                embeddings = self.get_embeddings_batch([text for text, _ in queued.values()],
+                                                       token_counts=[count for _, count in queued.values()])
+                for content_hash, embedding in zip(queued, embeddings):
+                    if embedding is None:
+                        unembeddable.add(content_hash)
+                    else:
+                        known[content_hash] = embedding
+
+            embedded = []
+            for i, children, token_counts, child_hashes, start_page in pending:
+                if any(content_hash not in known for content_hash in child_hashes):
+                    logger.error(f"Failed to process chunk {i + 1}: some child chunks could not be embedded")
+                    failed_chunks += 1
+                else:
+                    embedded.append((i, children, token_counts, [known[h] for h in child_hashes], start_page))
 
-        try:
+            # Store the chunks' children, linked to them as their parents
             with conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO rag_chunks (content, embedding, content_hash, file_id)
-                    VALUES (%s, %s, %s, %s)
-                    ON CONFLICT (content_hash) DO NOTHING
-                """, (content, embedding, content_hash, file_id))
-                conn.commit()
+                self.write_parent_chunks(cur, file_id, file_name, embedded)
+            successful_chunks += len(embedded)
+            logger.info(f"{file_name or f'File {file_id}'}: {successful_chunks} chunks stored, {failed_chunks} failed")
+            pending.clear()
+            pending_tokens = 0
+
+        page = None
+        for i, chunk in enumerate(chunks):
+            start_page, page = page, page_range(chunk, page)[1]
+            children = self.split_children(chunk)
+            token_counts = [self.count_tokens(child) for child in children]
+            pending.append((i, children, token_counts, [self.create_content_hash(child) for child in children],
+                            start_page))
+            pending_tokens += sum(token_counts)
+            if pending_tokens >= self.ingest_flush_tokens:
+                flush()
+        if pending:
+            flush()
+
+        logger.info(f"Reused stored embeddings for {reused_chunks} chunks")
+        return successful_chunks, failed_chunks
+
+    def ingest_chunks(self, chunks: Iterable[str], file_id: int, file_name: str) -> Tuple[int, int]:
+        """
+        Embed and store a file's chunks and mark the file completed in one transaction
+        on a pooled connection, so a file is searchable all at once or not at all
+        chunks may be a generator (see stream_chunks()); returns (successful, failed) chunks
+        """
+        with pooled_connection() as conn:
+            successful_chunks, failed_chunks = self.store_parent_chunks(conn, chunks, file_id, file_name=file_name)
+            logger.info(f"Embedding throughput: {self.embedding_report()}")
+
+            # Centroid (for routing searches) and chunk statistics are stored with the status
+            if failed_chunks == 0:
+                complete_ingested_file(conn, file_id, successful_chunks)
+                logger.info(f"Processing complete! All {successful_chunks} chunks processed successfully")
+            else:
+                error_msg = f"Partial failure: {failed_chunks} chunks failed"
+                complete_ingested_file(conn, file_id, successful_chunks, error_message=error_msg)
+                logger.warning(f"Processing complete with warnings! Success: {successful_chunks}, Failed: {failed_chunks}")
+
+        return successful_chunks, failed_chunks
 
-        except Exception as e:
-            logger.error(f"Failed to store chunk: {e}")
-            raise
-        finally:
-            conn.close()
-    
     def process_pdf(self, pdf_path: str):
         """Main processing function"""
         if not os.path.exists(pdf_path):
@@ -431,46 +781,13 @@ class PDFEmbeddingProcessor:
             raise Exception("Database error: could not track file ingestion")
 
         try:
-            # Initialize database
-            self.initialize_rag_table()
-
-            # Extract and chunk text
-            text = self.extract_text_from_pdf(pdf_path)
-            chunks = self.chunk_text(text)
-
-            logger.info(f"Processing {len(chunks)} chunks...")
-
-            successful_chunks = 0
-            failed_chunks = 0
-
-            for i, chunk in enumerate(chunks):
-                try:
-                    logger.info(f"Processing chunk {i + 1}/{len(chunks)}")
-
-                    # Get embedding
-                    embedding = self.get_embedding_with_retry(chunk)
-
-                    # Store in database
-                    self.store_chunk_embedding(chunk, embedding, file_id)
-
-                    successful_chunks += 1
-
-                    # Rate limiting - be respectful to OpenAI API
-                    time.sleep(0.1)
-
-                except Exception as e:
-                    logger.error(f"Failed to process chunk {i + 1}: {e}")
-                    failed_chunks += 1
-                    continue
+            # Initialize database (once: the migrations lock rag_chunks against concurrent ingestion)
+            if not self.rag_table_initialized:
+                self.initialize_rag_table()
 
-            # Update file status to completed
-            if failed_chunks == 0:
-                update_ingested_file_status(file_id, 'completed', chunks_count=successful_chunks)
-                logger.info(f"Processing complete! All {successful_chunks} chunks processed successfully")
-            else:
-                error_msg = f"Partial failure: {failed_chunks} chunks failed"
-                update_ingested_file_status(file_id, 'completed', chunks_count=successful_chunks, error_message=error_msg)
-                logger.warning(f"Processing complete with warnings! Success: {successful_chunks}, Failed: {failed_chunks}")
+            # Pages are extracted, chunked, embedded in batched requests and written as they stream;
+            # the chunks and the completed status are committed together
+            successful_chunks, failed_chunks = self.ingest_chunks(self.stream_chunks(pdf_path), file_id, file_name)
 
             return successful_chunks, failed_chunks
 
@@ -501,20 +818,30 @@ class PDFEmbeddingProcessor:
         finally:
             conn.close()
 
-    def process_directory(self, directory_path: str, force_reprocess: bool = False):
-        """Process all PDF files in a directory"""
+    def process_directory(self, directory_path: str, force_reprocess: bool = False, jobs: int = 1,
+                          recursive: bool = False, include: Optional[List[str]] = None):
+        """
+        Process the PDF files in a directory, up to jobs files at once
+        Files share this processor's rate limiter, embedding request slots and embedding cache,
+        so concurrency never exceeds the account's quota; each file is committed on its own
+        """
         if not os.path.isdir(directory_path):
             raise ValueError(f"Directory not found: {directory_path}")
 
         # Find all PDF files
-        pdf_pattern = os.path.join(directory_path, "*.pdf")
-        pdf_files = glob.glob(pdf_pattern)
+        pdf_files = find_pdf_files(directory_path, recursive=recursive, include=include)
 
         if not pdf_files:
             print(f"⚠️  No PDF files found in {directory_path}")
             return
 
-        print(f"📁 Found {len(pdf_files)} PDF file(s) in {directory_path}")
+        # Each file in flight holds one pooled connection for its transaction
+        pool_size = get_pool().maxconn
+        if jobs > pool_size:
+            print(f"⚠️  Limiting to {pool_size} concurrent files (DB_POOL_SIZE)")
+        jobs = max(1, min(jobs, pool_size, len(pdf_files)))
+
+        print(f"📁 Found {len(pdf_files)} PDF file(s) in {directory_path}, processing {jobs} at a time")
 
         # Initialize database once
         self.initialize_rag_table()
@@ -523,30 +850,58 @@ class PDFEmbeddingProcessor:
         total_failed = 0
         processed_count = 0
         skipped_count = 0
-
-        for i, pdf_path in enumerate(pdf_files, 1):
-            file_name = os.path.basename(pdf_path)
-            print(f"\n{'='*60}")
-            print(f"Processing file {i}/{len(pdf_files)}: {file_name}")
-            print(f"{'='*60}")
-
+        failed_count = 0
+        seen_hashes = set()  # Identical files in the run are ingested once
+        lock = threading.Lock()
+        started = time.monotonic()
+
+        def progress(message: str):
+            # One whole line per event, however the files' threads interleave
+            with lock:
+                print(message, flush=True)
+
+        def process_file(i: int, pdf_path: str):
+            file_name = os.path.relpath(pdf_path, directory_path)
+            file_hash = self.create_file_hash(pdf_path)
+            with lock:
+                duplicate = file_hash in seen_hashes
+                seen_hashes.add(file_hash)
+            if duplicate:
+                progress(f"⏭️  [{i}/{len(pdf_files)}] Skipping {file_name} (same content as another file)")
+                return None
+            # Skip if already processed and not forcing reprocess
+            if not force_reprocess and self.is_already_processed_by_hash(file_hash):
+                progress(f"⏭️  [{i}/{len(pdf_files)}] Skipping {file_name} (already processed)")
+                return None
+
+            progress(f"▶️  [{i}/{len(pdf_files)}] Processing {file_name}")
+            file_started = time.monotonic()
             try:
-                # Skip if already processed and not forcing reprocess
-                if not force_reprocess and self.is_already_processed(pdf_path):
-                    print(f"⏭️  Skipping {file_name} (already processed)")
-                    skipped_count += 1
-                    continue
-
                 successful, failed = self.process_pdf(pdf_path)
-                total_successful += successful
-                total_failed += failed
-                processed_count += 1
-
-                print(f"✅ {file_name}: {successful} chunks processed, {failed} failed")
-
             except Exception as e:
-                print(f"❌ Failed to process {file_name}: {e}")
-                total_failed += 1
+                progress(f"❌ [{i}/{len(pdf_files)}] Failed to process {file_name}: {e}")
+                raise
+            elapsed = time.monotonic() - file_started
+            progress(f"✅ [{i}/{len(pdf_files)}] {file_name}: {successful} chunks processed, {failed} failed "
+                     f"in {elapsed:.1f}s ({successful / elapsed if elapsed else 0:.1f} chunks/s)")
+            return successful, failed
+
+        with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="ingest") as executor:
+            futures = [executor.submit(process_file, i, pdf_path) for i, pdf_path in enumerate(pdf_files, 1)]
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception:
+                    failed_count += 1  # Reported by process_file
+                    continue
+                if result is None:
+                    skipped_count += 1
+                else:
+                    total_successful += result[0]
+                    total_failed += result[1]
+                    processed_count += 1
+
+        elapsed = time.monotonic() - started
 
         # Final summary
         print(f"\n{'='*60}")
@@ -554,13 +909,17 @@ class PDFEmbeddingProcessor:
         print(f"{'='*60}")
         print(f"Files processed: {processed_count}")
         print(f"Files skipped: {skipped_count}")
+        print(f"Files failed: {failed_count}")
         print(f"Total chunks successful: {total_successful}")
         print(f"Total chunks failed: {total_failed}")
+        print(f"Elapsed: {elapsed:.1f}s ({processed_count / elapsed * 60 if elapsed else 0:.1f} files/min, "
+              f"{total_successful / elapsed * 60 if elapsed else 0:.0f} chunks/min)")
 
         if total_successful > 0:
             print(f"🎉 Successfully processed {total_successful} chunks across {processed_count} files!")
         if total_failed > 0:
             print(f"⚠️  {total_failed} chunks failed processing")
+        print(f"⚡ Embedding throughput: {self.embedding_report()}")
 
 
 def main():
@@ -574,13 +933,47 @@ def main():
                        help="Treat path as a single file (default: auto-detect)")
     parser.add_argument("--dir", action="store_true",
                        help="Treat path as a directory (default: auto-detect)")
+    parser.add_argument("--jobs", "-j", type=int,
+                       help="Files processed at once in a directory (default: INGEST_JOBS or 4, at most DB_POOL_SIZE)")
+    parser.add_argument("--recursive", "-r", action="store_true",
+                       help="Include PDFs in subdirectories")
+    parser.add_argument("--include", action="append", metavar="PATTERN",
+                       help="Only process PDFs whose relative path or name matches this glob (repeatable)")
+    parser.add_argument("--workers", type=int,
+                       help="Embedding requests in flight at once, across all files (default: EMBEDDING_WORKERS or 4)")
+    parser.add_argument("--rpm", type=int,
+                       help="Embedding requests per minute limit, 0 for none (default: EMBEDDING_RPM or 3000)")
+    parser.add_argument("--tpm", type=int,
+                       help="Embedding tokens per minute limit, 0 for none (default: EMBEDDING_TPM or 1000000)")
+    parser.add_argument("--extract-workers", type=int,
+                       help="Processes extracting PDF pages in parallel (default: PDF_EXTRACT_WORKERS or up to 4)")
+    parser.add_argument("--chunk-overlap", type=int,
+                       help="Tokens each chunk repeats from the end of the previous one (default: 0)")
+    parser.add_argument("--embedding-cache", metavar="PATH",
+                       help="Local embedding cache file, '' to disable (default: EMBEDDING_CACHE_PATH or .embedding_cache.sqlite3)")
 
     args = parser.parse_args()
 
     # Default to current directory if no path provided
     target_path = args.path or "."
 
-    processor = PDFEmbeddingProcessor()
+    # Unlike the app, the command line keeps its cache in a file by default, so re-ingesting a
+    # corpus (after a database reset or with --force) costs no API calls
+    embedding_cache_path = args.embedding_cache
+    if embedding_cache_path is None:
+        embedding_cache_path = st.secrets.get("EMBEDDING_CACHE_PATH", ".embedding_cache.sqlite3")
+    processor = PDFEmbeddingProcessor(embedding_cache_path=embedding_cache_path)
+    if args.workers is not None:
+        processor.embedding_workers = max(1, args.workers)
+        processor.request_slots = threading.BoundedSemaphore(processor.embedding_workers)
+    if args.extract_workers is not None:
+        processor.extract_workers = max(1, args.extract_workers)
+    if args.chunk_overlap is not None:
+        processor.chunk_overlap_tokens = max(0, args.chunk_overlap)
+    if args.rpm is not None or args.tpm is not None:
+        processor.rate_limiter = RateLimiter(
+            requests_per_minute=args.rpm if args.rpm is not None else processor.rate_limiter.requests_per_minute,
+            tokens_per_minute=args.tpm if args.tpm is not None else processor.rate_limiter.tokens_per_minute)
 
     try:
         # Auto-detect if not explicitly specified
@@ -601,11 +994,14 @@ def main():
             successful, failed = processor.process_pdf(target_path)
             print(f"✅ Processing completed!")
             print(f"📊 Chunks: {successful} successful, {failed} failed")
+            print(f"⚡ Embedding throughput: {processor.embedding_report()}")
 
         else:
             # Process directory
             print(f"📁 Processing directory: {target_path}")
-            processor.process_directory(target_path, force_reprocess=args.force)
+            jobs = args.jobs if args.jobs is not None else int(st.secrets.get("INGEST_JOBS", 4))
+            processor.process_directory(target_path, force_reprocess=args.force, jobs=jobs,
+                                        recursive=args.recursive, include=args.include)
 
     except KeyboardInterrupt:
         print("\n⏹️  Processing interrupted by user")
@@ -614,6 +1010,8 @@ def main():
         logger.error(f"Processing failed: {e}")
         print(f"❌ Processing failed: {e}")
         sys.exit(1)
+    finally:
+        processor.close()
 
 
 if __name__ == "__main__":
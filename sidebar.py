@@ -2,8 +2,9 @@ import streamlit as st
 import time
 from app.chatlog.chatlog_handler import compile_summaries, delete_all_chatlogs, export_chat_logs_to_csv, drop_chatlog_table, fetch_and_batch_chatlogs, generate_summary_for_each_group
 from app.instructions.instructions_handler import get_latest_instructions, update_instructions
-from app.db.database_connection import  drop_instructions_table, get_app_description, update_app_description, get_app_title, update_app_title
+from app.db.database_connection import  drop_instructions_table, get_app_description, update_app_description, get_app_title, update_app_title, update_topic_keywords
 from app.rag.rag_handler import rag_handler
+from app.rag.answer_cache import answer_cache, instructions_version
 custominstructions_area_height = 300
 app_title = get_app_title()
 app_description = get_app_description()
@@ -71,6 +72,8 @@ def setup_sidebar():
 
                 if st.button("Save Instructions"):
                     update_instructions(custom_instructions)
+                    # Answers cached under the previous instructions are no longer valid
+                    answer_cache.invalidate(instructions_version(st.session_state['existing_instructions']))
                     st.success("Instructions updated successfully")
                     st.rerun()
 
@@ -96,7 +99,7 @@ def setup_sidebar():
                 st.session_state["use_rag"] = st.checkbox(
                     "Enable course material search for all users",
                     value=st.session_state.get("use_rag", True),
-                    help="When enabled, the chatbot will search through Economics materials for relevant context when students ask economics-related questions"
+                    help="When enabled, the chatbot will search through course materials for relevant context when students ask questions matching the topic keywords"
                 )
 
                 if not st.session_state.get("use_rag", True):
@@ -104,6 +107,24 @@ def setup_sidebar():
 
                 st.divider()
 
+                # Topic keywords that trigger a course material search
+                st.write("**Topic Keywords:**")
+                topic_keywords = st.text_area(
+                    "One keyword or phrase per line",
+                    value="\n".join(rag_handler.get_topic_keywords()),
+                    height=150,
+                    key="topic_keywords",
+                    help="Whole words only (plurals ending in s/es included). End a keyword with * to match any word starting with it, e.g. econom*"
+                )
+                if st.button("Save topic keywords", key="save_topic_keywords"):
+                    keywords = [line.strip() for line in topic_keywords.splitlines() if line.strip()]
+                    if update_topic_keywords(keywords):
+                        st.success("Topic keywords updated successfully")
+                    else:
+                        st.error("Failed to update topic keywords")
+
+                st.divider()
+
                 # Show detailed RAG statistics
                 try:
                     stats = rag_handler.get_rag_stats()
@@ -120,6 +141,25 @@ def setup_sidebar():
                 except Exception as e:
                     st.error(f"RAG system error: {e}")
 
+                # Retrieval latency budget metrics
+                retrieval_metrics = rag_handler.get_retrieval_metrics()
+                if retrieval_metrics['started'] > 0:
+                    st.write("**Retrieval Latency:**")
+                    st.write(f"- Budget: {retrieval_metrics['deadline_seconds']:.1f}s")
+                    st.write(f"- Over budget: {retrieval_metrics['timeout_rate']:.1%} ({retrieval_metrics['timed_out']} of {retrieval_metrics['completed'] + retrieval_metrics['timed_out']})")
+                    if retrieval_metrics['p50_ms'] is not None:
+                        st.write(f"- Latency p50/p95: {retrieval_metrics['p50_ms']:.0f} / {retrieval_metrics['p95_ms']:.0f} ms")
+
+                # Semantic answer cache metrics
+                cache_stats = answer_cache.get_stats()
+                if cache_stats['enabled']:
+                    st.write("**Answer Cache:**")
+                    st.write(f"- Cached answers: {cache_stats['entries']}")
+                    st.write(f"- Hit rate: {cache_stats['hit_rate']:.1%} ({cache_stats['hits']} hits, {cache_stats['misses']} misses)")
+                    if st.button("🧹 Clear answer cache", key="clear_answer_cache"):
+                        removed = answer_cache.invalidate()
+                        st.success(f"Cleared {removed} cached answers")
+
                 st.divider()
 
                 # Ingested Files Management
@@ -147,6 +187,29 @@ def setup_sidebar():
                                 if file_info['error_message']:
                                     st.caption(f"⚠️ {file_info['error_message']}")
 
+                                if file_info['status'] == 'completed':
+                                    page_start, page_end = file_info['search_page_start'], file_info['search_page_end']
+                                    current_range = "" if page_start is None and page_end is None else \
+                                        f"{page_start or ''}-{page_end or ''}"
+                                    page_range = st.text_input(
+                                        "Pages searched",
+                                        value=current_range,
+                                        key=f"pages_{file_info['id']}",
+                                        placeholder="All pages, or e.g. 45-120",
+                                        help="Only chunks from these pages are searched. Leave blank to search the whole file"
+                                    )
+                                    try:
+                                        new_range = rag_handler.parse_page_range(page_range)
+                                    except ValueError:
+                                        st.error("Enter a page range such as 45-120, or leave blank for all pages")
+                                    else:
+                                        # Compare parsed ranges so input like " 45 - 120" is not saved on every rerun
+                                        if new_range != (page_start, page_end):
+                                            if rag_handler.set_file_page_range(file_info['id'], *new_range):
+                                                st.success("Page range updated")
+                                            else:
+                                                st.error("Failed to update page range")
+
                             with col2:
                                 if file_info['status'] == 'failed':
                                     if st.button("🔄", key=f"retry_{file_info['id']}", help="Retry processing"):
@@ -201,7 +264,7 @@ def setup_sidebar():
                     st.write(f"**📁 Selected Files ({len(uploaded_files)}):**")
                     total_size = 0
                     for file in uploaded_files:
-                        file_size = len(file.getvalue())
+                        file_size = file.size
                         total_size += file_size
                         size_str = rag_handler.format_file_size(file_size)
                         st.write(f"- {file.name} ({size_str})")
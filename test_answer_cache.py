@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Tests for the semantic answer cache
+Questions are hand-made three-dimensional embeddings, so no embedding calls are made
+"""
+
+from unittest.mock import patch
+
+# Mock streamlit secrets for testing
+mock_secrets = {
+    "OPENAI_API_KEY": "test-key-placeholder"
+}
+
+with patch('streamlit.secrets', mock_secrets):
+    from app.rag.answer_cache import SemanticAnswerCache, instructions_version
+
+QUESTION = [1.0, 0.0, 0.0]
+PARAPHRASE = [0.99, 0.05, 0.0]
+UNRELATED = [0.0, 1.0, 0.0]
+
+
+def test_near_duplicate_hit():
+    """A paraphrase under the same instructions and files is served from the cache"""
+    cache = SemanticAnswerCache(enabled=True, max_distance=0.05)
+    version = instructions_version("Be a helpful economics tutor")
+
+    cache.store(QUESTION, version, [2, 1], "Supply meets demand.")
+
+    assert cache.lookup(PARAPHRASE, version, [1, 2]) == "Supply meets demand."
+    assert cache.lookup(UNRELATED, version, [1, 2]) is None
+
+    stats = cache.get_stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['hit_rate'] == 0.5
+
+
+def test_scoped_by_instructions_and_files():
+    """Answers never leak across instructions versions or file selections"""
+    cache = SemanticAnswerCache(enabled=True)
+    old_version = instructions_version("old")
+    new_version = instructions_version("new")
+
+    cache.store(QUESTION, old_version, [1], "Old answer")
+
+    assert cache.lookup(QUESTION, new_version, [1]) is None
+    assert cache.lookup(QUESTION, old_version, [1, 3]) is None
+
+    assert cache.invalidate(old_version) == 1
+    assert cache.lookup(QUESTION, old_version, [1]) is None
+
+
+def test_ttl_expiry():
+    """Entries older than the TTL are not served"""
+    cache = SemanticAnswerCache(enabled=True, ttl_seconds=60)
+    version = instructions_version("")
+
+    with patch('app.rag.answer_cache.time.time', return_value=1000.0):
+        cache.store(QUESTION, version, [], "Stale answer")
+    with patch('app.rag.answer_cache.time.time', return_value=1100.0):
+        assert cache.lookup(QUESTION, version, []) is None
+
+    assert cache.get_stats()['entries'] == 0
+
+
+def test_stream_reassembles_answer():
+    """Streaming a cached answer yields the original text"""
+    answer = "Deadweight loss is the lost surplus."
+    assert "".join(SemanticAnswerCache.stream(answer, delay=0)) == answer
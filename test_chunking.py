@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Tests for the token-offset chunker
+Uses a one-token-per-character encoding, so it runs without downloading tiktoken data
+"""
+
+import re
+
+import pytest
+
+from app.rag.chunking import chunk_text, iter_chunks
+
+
+class CharEncoding:
+    """One token per character, with tiktoken's encode/decode_tokens_bytes interface"""
+
+    def encode(self, text):
+        return [ord(char) for char in text]
+
+    def decode_tokens_bytes(self, tokens):
+        return [chr(token).encode("utf-8") for token in tokens]
+
+
+class WordEncoding:
+    """BPE-like: each word is one token that carries its leading space (" The"), as in cl100k"""
+
+    def __init__(self):
+        self.vocab = {}
+
+    def encode(self, text):
+        return [self.vocab.setdefault(piece, len(self.vocab)) for piece in re.findall(r" ?\w+| ?[^\w\s]|\s+", text)]
+
+    def decode_tokens_bytes(self, tokens):
+        pieces = {token: piece for piece, token in self.vocab.items()}
+        return [pieces[token].encode("utf-8") for token in tokens]
+
+
+ENCODING = CharEncoding()
+
+
+def test_chunks_end_at_sentence_boundaries():
+    """Chunks are cut after the last sentence that fits"""
+    text = "One two three. Four five six. Seven eight nine."
+    assert chunk_text(text, ENCODING, max_tokens=32) == ["One two three. Four five six.", "Seven eight nine."]
+
+
+def test_boundaries_with_leading_space_tokens():
+    """The space before a sentence belongs to its first word's token, which starts the next chunk"""
+    text = "The cat sat on the mat. Another sentence goes here. And a third one."
+    chunks = chunk_text(text, WordEncoding(), max_tokens=8)
+
+    assert chunks == ["The cat sat on the mat.", "Another sentence goes here.", "And a third one."]
+    assert list(iter_chunks([text[:30], text[30:]], WordEncoding(), max_tokens=8, buffer_chars=20)) == chunks
+
+
+def test_token_cap_holds_for_overlong_sentences():
+    """A sentence longer than the cap is cut at the cap instead of producing an oversized chunk"""
+    text = "x" * 95 + ". Short."
+    chunks = chunk_text(text, ENCODING, max_tokens=40)
+
+    assert all(len(chunk) <= 40 for chunk in chunks)
+    assert "".join(chunks).replace(" ", "") == text.replace(" ", "")
+
+
+def test_overlap_starts_at_a_sentence():
+    """The next chunk repeats the sentence that falls inside the overlap window"""
+    text = "Alpha beta gamma. Delta epsilon. Zeta eta theta iota."
+    chunks = chunk_text(text, ENCODING, max_tokens=34, overlap_tokens=16)
+
+    assert chunks[0] == "Alpha beta gamma. Delta epsilon."
+    assert chunks[1].startswith("Delta epsilon.")
+    assert all(len(chunk) <= 34 for chunk in chunks)
+
+
+def test_whole_text_covered_without_overlap():
+    """Without overlap every character ends up in exactly one chunk"""
+    text = " ".join(f"Sentence number {i} is here." for i in range(200))
+    chunks = chunk_text(text, ENCODING, max_tokens=100)
+
+    assert " ".join(chunks) == text
+    assert all(len(chunk) <= 100 for chunk in chunks)
+
+
+def test_multibyte_text():
+    """Offsets are in bytes, so non-ASCII text is sliced without corruption"""
+    text = "Élasticité du prix. Surplus du consommateur. Équilibre du marché."
+    chunks = chunk_text(text, ENCODING, max_tokens=30)
+
+    assert chunks == ["Élasticité du prix.", "Surplus du consommateur.", "Équilibre du marché."]
+
+
+def test_streamed_pieces_chunk_like_the_joined_text():
+    """Chunks span piece boundaries and match chunking the whole text, with and without overlap"""
+    text = "".join(f"\n\n--- Page {page} ---\n" + " ".join(f"Sentence {page}.{i} is here." for i in range(30))
+                   for page in range(1, 6))
+    pieces = [text[i:i + 97] for i in range(0, len(text), 97)]
+
+    for overlap in (0, 20):
+        expected = chunk_text(text, ENCODING, max_tokens=120, overlap_tokens=overlap)
+        assert list(iter_chunks(pieces, ENCODING, max_tokens=120, overlap_tokens=overlap,
+                                buffer_chars=300)) == expected
+
+
+def test_streaming_yields_before_the_input_ends():
+    """Chunks are produced while pieces are still arriving"""
+    consumed = []
+
+    def pieces():
+        for i in range(100):
+            consumed.append(i)
+            yield f"Sentence number {i} is here. "
+
+    chunks = iter_chunks(pieces(), ENCODING, max_tokens=100, buffer_chars=200)
+    next(chunks)
+    assert len(consumed) < 20
+
+
+def test_empty_and_invalid_inputs():
+    assert chunk_text("", ENCODING, max_tokens=10) == []
+    assert list(iter_chunks([], ENCODING, max_tokens=10)) == []
+    with pytest.raises(ValueError):
+        chunk_text("text", ENCODING, max_tokens=0)
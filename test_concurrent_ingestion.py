@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Tests that concurrently ingested files really overlap in the database
+Needs a Postgres with pgvector: set TEST_DB_CONNECTION to its DSN (skipped otherwise)
+"""
+
+import os
+import threading
+from unittest.mock import patch
+
+import psycopg2
+import pytest
+
+pytestmark = pytest.mark.skipif(not os.environ.get("TEST_DB_CONNECTION"), reason="TEST_DB_CONNECTION is not set")
+
+
+class BarrierEmbeddings:
+    """Embeddings API whose requests only complete when two arrive together (one per file)"""
+
+    def __init__(self):
+        self.barrier = threading.Barrier(2, timeout=10)
+
+    def create(self, model, input):
+        self.barrier.wait()
+        inputs = [input] if isinstance(input, str) else input
+        data = [type("Item", (), {"index": i, "embedding": [float(len(text) % 7 + 1)] + [0.0] * 1535})()
+                for i, text in enumerate(inputs)]
+        return type("Response", (), {"data": data})()
+
+
+def test_uncommitted_chunks_do_not_block_other_files(database):
+    """A file's open ingestion transaction must not hold locks other files' writes wait on"""
+    import process_pdf
+    process_pdf.PDFEmbeddingProcessor().initialize_rag_table()
+    from app.db.database_connection import insert_ingested_file
+
+    first = psycopg2.connect(database)
+    second = psycopg2.connect(database)
+    try:
+        with first.cursor() as cur:
+            cur.execute("INSERT INTO rag_chunks (content, content_hash, file_id) VALUES ('a', 'a', %s)",
+                        (insert_ingested_file("a.pdf", "a.pdf", 1, "hash-a"),))
+        with second.cursor() as cur:
+            cur.execute("SET lock_timeout = '2s'")
+            cur.execute("""
+                INSERT INTO ingested_files (file_name, file_path, file_size, file_hash, status)
+                VALUES ('b.pdf', 'b.pdf', 1, 'hash-b', 'processing') RETURNING id
+            """)
+            cur.execute("INSERT INTO rag_chunks (content, content_hash, file_id) VALUES ('b', 'b', %s)",
+                        (cur.fetchone()[0],))
+        second.commit()
+    finally:
+        first.close()
+        second.close()
+
+
+def test_directory_files_are_ingested_at_the_same_time(database, make_pdf, tmp_path, capsys):
+    """Every embedding request waits for one from the other file, so only overlapping ingestion completes"""
+    text = " ".join(f"Sentence {i} about supply." for i in range(60))
+    for name, letter in (("first.pdf", "s"), ("second.pdf", "d")):
+        # Same lengths (so the same number of requests per file), different content
+        (tmp_path / name).write_bytes(make_pdf([text.replace("s", letter)] * 4))
+
+    import process_pdf
+    with patch.object(process_pdf, "OpenAI", lambda **kwargs: type("Client", (), {})()):
+        processor = process_pdf.PDFEmbeddingProcessor()
+    processor.client.embeddings = BarrierEmbeddings()
+    processor.embedding_workers = 1  # Requests within a file are sequential...
+    processor.request_slots = threading.BoundedSemaphore(2)  # ...but both files may have one in flight
+    processor.ingest_flush_tokens = 1000  # Several flushes (and chunk inserts) per file
+
+    processor.process_directory(str(tmp_path), jobs=2)
+
+    output = capsys.readouterr().out
+    assert "Files processed: 2" in output
+    assert "Total chunks failed: 0" in output
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Tests for extractive context compression
+Packs short hand-written chunks, with their token counts given, into small budgets
+"""
+
+from app.rag.context_compression import GAP_MARKER, compress_chunks, split_sentences
+
+CHUNK = {
+    'content': ("Markets allocate resources through prices. Deadweight loss is the surplus lost when "
+                "a tax drives a wedge between prices. Firms hire labour in the short run. "
+                "The size of the deadweight loss depends on elasticity."),
+    'similarity': 0.8,
+    'token_count': 48,
+}
+OTHER = {
+    'content': "Monopolies restrict output. Cartels are unstable.",
+    'similarity': 0.6,
+    'token_count': 10,
+}
+
+
+def test_split_sentences():
+    """Sentences split on terminal punctuation and paragraph breaks"""
+    assert split_sentences("One. Two?\n\nThree!  ") == ["One.", "Two?", "Three!"]
+
+
+def test_keeps_most_relevant_sentences_in_order():
+    """Only query-relevant sentences fit a tight budget, kept in reading order with gaps marked"""
+    compressed = compress_chunks("What is deadweight loss?", [CHUNK, OTHER], token_budget=35)
+
+    assert len(compressed) == 1
+    content = compressed[0]['content']
+    assert content.startswith("Deadweight loss is the surplus lost")
+    assert GAP_MARKER + "The size of the deadweight loss" in content
+    assert "Firms hire labour" not in content
+    assert compressed[0]['token_count'] <= 35
+    assert compressed[0]['similarity'] == 0.8
+
+
+def test_neighbours_fill_remaining_budget():
+    """Sentences next to a match are kept for context, unrelated chunks are not"""
+    compressed = compress_chunks("deadweight loss", [CHUNK, OTHER], token_budget=1000)
+
+    assert [chunk['content'] for chunk in compressed] == [CHUNK['content']]
+
+
+def test_falls_back_to_similarity_without_matches():
+    """Paraphrased queries with no shared terms still get the most similar chunk's sentences"""
+    compressed = compress_chunks("collusion", [OTHER, CHUNK], token_budget=12)
+
+    assert [chunk['content'] for chunk in compressed] == ["Markets allocate resources through prices."]
+
+
+def test_empty_inputs():
+    """No chunks or no budget gives no context"""
+    assert compress_chunks("tax", [], token_budget=100) == []
+    assert compress_chunks("tax", [CHUNK], token_budget=0) == []
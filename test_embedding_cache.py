@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+Tests for the local SQLite embedding cache
+Each test writes its own SQLite file under pytest's tmp_path
+"""
+
+from app.rag.embedding_cache import EmbeddingCache
+
+
+def test_round_trip_keyed_by_model(tmp_path):
+    """Embeddings come back (as float32) only for the model they were stored under"""
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite3"))
+    cache.put_many("ada", [("h1", [0.5, -0.25]), ("h2", [1.0, 0.0])])
+
+    assert cache.get_many("ada", ["h1", "h2", "h3"]) == {"h1": [0.5, -0.25], "h2": [1.0, 0.0]}
+    assert cache.get_many("other", ["h1"]) == {}
+    assert (cache.hits, cache.misses) == (2, 2)
+    assert cache.count() == 2
+
+
+def test_persists_and_replaces(tmp_path):
+    """Entries survive reopening the file, and storing a hash again replaces its embedding"""
+    path = str(tmp_path / "cache.sqlite3")
+    cache = EmbeddingCache(path)
+    cache.put_many("ada", [("h1", [0.5])])
+    cache.put_many("ada", [("h1", [0.75])])
+    cache.close()
+
+    reopened = EmbeddingCache(path)
+    assert reopened.get_many("ada", ["h1"]) == {"h1": [0.75]}
+    assert reopened.count("ada") == 1
+
+
+def test_large_lookups_are_batched(tmp_path):
+    """Lookups beyond SQLite's parameter limit still find every entry"""
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite3"))
+    items = [(f"h{i}", [float(i)]) for i in range(1200)]
+    cache.put_many("ada", items)
+
+    found = cache.get_many("ada", [content_hash for content_hash, _ in items])
+    assert len(found) == 1200
+    assert found["h1199"] == [1199.0]
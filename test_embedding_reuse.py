@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Tests that ingestion reuses embeddings already stored in the database
+Needs a Postgres with pgvector: set TEST_DB_CONNECTION to its DSN (skipped otherwise)
+"""
+
+import os
+from unittest.mock import patch
+
+import psycopg2
+import pytest
+
+pytestmark = pytest.mark.skipif(not os.environ.get("TEST_DB_CONNECTION"), reason="TEST_DB_CONNECTION is not set")
+
+
+class RecordingEmbeddings:
+    """Embeddings API that records every input it is sent"""
+
+    def __init__(self):
+        self.inputs = []
+
+    def create(self, model, input):
+        inputs = [input] if isinstance(input, str) else input
+        self.inputs.extend(inputs)
+        data = [type("Item", (), {"index": i, "embedding": [float(len(text) % 7 + 1)] + [0.0] * 1535})()
+                for i, text in enumerate(inputs)]
+        return type("Response", (), {"data": data})()
+
+
+@pytest.fixture
+def processor(database):
+    """Processor on the scratch schema with a recording embeddings API and no local cache"""
+    import process_pdf
+    with patch.object(process_pdf, "OpenAI", lambda **kwargs: type("Client", (), {})()):
+        processor = process_pdf.PDFEmbeddingProcessor()
+    processor.client.embeddings = RecordingEmbeddings()
+    processor.child_max_tokens = 60
+    processor.initialize_rag_table()
+    return processor
+
+
+def ingest(processor, name, chunks):
+    from app.db.database_connection import insert_ingested_file
+    file_id = insert_ingested_file(name, name, 1, f"hash-{name}")
+    return file_id, processor.ingest_chunks(iter(chunks), file_id, name)
+
+
+def test_same_text_is_not_embedded_again(processor, database):
+    """A second file with the same text is stored from the first file's embeddings, without API calls"""
+    chunks = [" ".join(f"Sentence {i} of part {part} about supply." for i in range(8)) for part in range(3)]
+    first_id, first = ingest(processor, "first.pdf", chunks)
+    sent = list(processor.client.embeddings.inputs)
+
+    second_id, second = ingest(processor, "second.pdf", chunks)
+
+    assert first == second == (3, 0)
+    assert sent and processor.client.embeddings.inputs == sent
+    with psycopg2.connect(database) as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT file_id, array_agg(embedding::text ORDER BY parent_id, child_index)
+            FROM rag_chunks GROUP BY file_id
+        """)
+        embeddings = dict(cur.fetchall())
+    assert embeddings[first_id] == embeddings[second_id]
+
+
+def test_text_repeated_within_a_file_is_embedded_once(processor):
+    """Identical children are sent once, even within one flush"""
+    repeated = "The same sentence about demand. " * 3
+    ingest(processor, "repeated.pdf", [repeated, repeated, "A different sentence about prices."])
+
+    inputs = processor.client.embeddings.inputs
+    assert len(inputs) == len(set(inputs))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Tests for page-range PDF text extraction
+Builds small text PDFs in memory, so no sample files are needed
+"""
+
+import hashlib
+
+import PyPDF2
+import pytest
+
+from app.rag import pdf_extraction
+from app.rag.pdf_extraction import ParsedPdf, extract_text, iter_text, page_ranges
+
+
+@pytest.fixture
+def pdf(make_pdf):
+    """Six pages with one sentence each"""
+    return make_pdf([f"Page {n} text about market prices." for n in range(1, 7)])
+
+
+def test_page_ranges_cover_every_page_in_order():
+    """Ranges are contiguous, in order, and never more than pages"""
+    assert page_ranges(10, workers=2) == [(0, 2), (2, 4), (4, 6), (6, 8), (8, 10)]
+    assert page_ranges(3, workers=4) == [(0, 1), (1, 2), (2, 3)]
+    assert page_ranges(1000, workers=4)[-1][1] == 1000
+
+
+def test_serial_extraction_adds_page_markers(pdf):
+    """Each page is preceded by its marker"""
+    text, pages = extract_text(pdf)
+
+    assert pages == 6
+    assert text.startswith("--- Page 1 ---\nPage 1 text")
+    assert text.index("--- Page 2 ---") < text.index("Page 2 text") < text.index("--- Page 3 ---")
+
+
+def test_iter_text_streams_pages_in_order(pdf):
+    """Pages are yielded one at a time, marker first, and join to the extracted text"""
+    pieces = list(iter_text(pdf))
+
+    assert pieces[0] == "--- Page 1 ---\n"
+    assert pieces[1].startswith("Page 1 text")
+    assert "".join(pieces).strip() == extract_text(pdf)[0]
+
+
+def test_parallel_extraction_matches_serial(pdf, tmp_path):
+    """Worker processes give exactly the serial result, from a path or a document read from one"""
+    path = tmp_path / "doc.pdf"
+    path.write_bytes(pdf)
+    serial, _ = extract_text(pdf, workers=1)
+
+    assert extract_text(str(path), workers=2, min_parallel_pages=1) == (serial, 6)
+    assert extract_text(ParsedPdf.from_path(str(path)), workers=2, min_parallel_pages=1) == (serial, 6)
+    streamed = iter_text(str(path), workers=2, min_parallel_pages=1, max_range_pages=2)
+    assert "".join(streamed) == "".join(iter_text(pdf))
+
+
+def test_in_memory_documents_are_extracted_serially(pdf, monkeypatch):
+    """Uploads are never copied into worker processes, whatever the worker count"""
+    def no_pool(*args, **kwargs):
+        raise AssertionError("started a worker pool for an in-memory document")
+
+    monkeypatch.setattr(pdf_extraction, "ProcessPoolExecutor", no_pool)
+    serial, _ = extract_text(pdf, workers=1)
+
+    assert extract_text(pdf, workers=4, min_parallel_pages=1) == (serial, 6)
+    assert extract_text(ParsedPdf(pdf), workers=4, min_parallel_pages=1) == (serial, 6)
+
+
+def test_parsed_pdf_parses_once(pdf, monkeypatch):
+    """Validation properties, hashing and serial extraction share one reader"""
+    readers = []
+
+    class CountingReader(PyPDF2.PdfReader):
+        def __init__(self, *args, **kwargs):
+            readers.append(self)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(pdf_extraction.PyPDF2, "PdfReader", CountingReader)
+    document = ParsedPdf(pdf)
+    assert document.size == len(pdf)
+    assert not readers  # Size checks don't parse
+
+    assert (document.pages, document.is_encrypted) == (6, False)
+    assert document.sha256 == hashlib.sha256(pdf).hexdigest()
+    assert extract_text(document) == extract_text(pdf)
+    assert len(readers) == 2  # One for the document, one for the plain bytes
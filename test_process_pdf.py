@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Tests for the PDF processor's chunk bookkeeping
+Page tracking, child splitting and embedding batches, with the processor counting one token per byte
+"""
+
+import pytest
+
+from process_pdf import page_range
+
+
+@pytest.fixture
+def processor(processor):
+    """Processor with small children, so short test texts split into several"""
+    processor.child_max_tokens = 60
+    return processor
+
+
+def test_page_range_from_markers():
+    """A piece spans from its first page marker to its last"""
+    assert page_range("--- Page 3 ---\nSupply\n\n--- Page 4 ---\nDemand", None) == (3, 4)
+    assert page_range("--- Page 12 ---\nPrices", 11) == (12, 12)
+
+
+def test_page_range_continues_previous_page():
+    """Text before the first marker belongs to the page the previous piece ended on"""
+    assert page_range("rest of page 3\n\n--- Page 4 ---\nDemand", 3) == (3, 4)
+    assert page_range("middle of page 3", 3) == (3, 3)
+
+
+def test_page_range_without_pages():
+    """Text without markers and nothing before it has no pages"""
+    assert page_range("No page markers here", None) == (None, None)
+
+
+def test_split_children_rejoin_to_parent(processor):
+    """Children are contiguous pieces of the parent, cut at sentence boundaries"""
+    parent = " ".join(f"Sentence {i} is about supply and demand." for i in range(12)) + "\n\nA closing line"
+
+    children = processor.split_children(parent)
+
+    assert "".join(children) == parent
+    assert len(children) > 1
+    assert all(len(child.encode()) <= processor.child_max_tokens for child in children)
+    assert all(child.rstrip().endswith(".") for child in children[:-1])
+
+
+def test_split_children_splits_long_sentences_between_words(processor):
+    """A sentence over the child size is split at word boundaries, keeping all whitespace"""
+    parent = "Markets " * 30 + "clear.  Short one."
+
+    children = processor.split_children(parent)
+
+    assert "".join(children) == parent
+    assert all(len(child.encode()) <= processor.child_max_tokens for child in children)
+
+
+def test_split_children_attaches_trailing_whitespace(processor):
+    """Whitespace after the last sentence joins the last child instead of becoming one"""
+    parent = "Prices rise.   \n"
+
+    assert processor.split_children(parent) == [parent]
+    assert processor.split_children("   ") == []
+
+
+def test_embedding_batches_split_at_the_token_limit(processor):
+    """A batch closes before the input that would take it over embedding_batch_tokens"""
+    processor.embedding_batch_tokens = 100
+
+    assert processor.embedding_batches([40, 40, 40, 60, 30]) == [(0, 2), (2, 4), (4, 5)]
+    assert processor.embedding_batches([50, 50, 50]) == [(0, 2), (2, 3)]
+    assert processor.embedding_batches([]) == []
+
+
+def test_embedding_batches_oversized_item_goes_alone(processor):
+    """An input over the token limit still gets a batch, on its own"""
+    processor.embedding_batch_tokens = 100
+
+    assert processor.embedding_batches([30, 250, 30]) == [(0, 1), (1, 2), (2, 3)]
+    assert processor.embedding_batches([250]) == [(0, 1)]
+
+
+def test_embedding_batches_cap_the_input_count(processor):
+    """No batch holds more than embedding_batch_size inputs, however few tokens they have"""
+    processor.embedding_batch_size = 3
+
+    assert processor.embedding_batches([1] * 7) == [(0, 3), (3, 6), (6, 7)]
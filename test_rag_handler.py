@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+Tests for the RAG handler's query-side helpers
+Search rows come from a fake cursor and chunks carry hand-made embeddings
+"""
+
+import threading
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+
+def make_chunk(content, similarity=0.9, embedding=None, **metadata):
+    return {'content': content, 'similarity': similarity, 'token_count': len(content.encode()),
+            'embedding': embedding, **metadata}
+
+
+def test_parse_page_range(handler):
+    """Closed, open-ended, single-page and blank ranges, with stray spaces and en dashes"""
+    assert handler.parse_page_range("45-120") == (45, 120)
+    assert handler.parse_page_range(" 45 – 120 ") == (45, 120)
+    assert handler.parse_page_range("45-") == (45, None)
+    assert handler.parse_page_range("-120") == (None, 120)
+    assert handler.parse_page_range("7") == (7, 7)
+    assert handler.parse_page_range("  ") == (None, None)
+
+
+@pytest.mark.parametrize("text", ["abc", "0-5", "12-3", "1-2-3"])
+def test_parse_page_range_rejects_invalid_ranges(handler, text):
+    """Anything that is not a range of positive page numbers raises ValueError"""
+    with pytest.raises(ValueError):
+        handler.parse_page_range(text)
+
+
+def test_chunk_filter_without_restrictions(handler):
+    """No files and no page ranges match every chunk"""
+    assert handler._chunk_filter(None, None) == ("TRUE", {})
+    assert handler._chunk_filter([], {}) == ("TRUE", {})
+
+
+def test_chunk_filter_page_ranges(handler):
+    """Ranged files are limited to overlapping chunks; other files and chunks without a file are unaffected"""
+    clause, params = handler._chunk_filter([1, 2], {2: (45, 120), 3: (None, 9)})
+
+    assert clause.startswith("file_id = ANY(%(file_ids)s) AND (file_id IS NULL OR NOT file_id = ANY(")
+    assert "page_end >= %(range_start_0)s AND page_start <= %(range_end_0)s" in clause
+    # File 3 is not searched, so its range adds nothing
+    assert params == {'file_ids': [1, 2], 'ranged_file_ids': [2],
+                      'range_file_0': 2, 'range_start_0': 45, 'range_end_0': 120}
+
+
+def test_chunk_filter_open_ended_ranges(handler):
+    """An open end adds no bound on that side"""
+    clause, params = handler._chunk_filter(None, {4: (None, 9), 5: (30, None)})
+
+    assert "(file_id = %(range_file_0)s AND page_start <= %(range_end_0)s)" in clause
+    assert "(file_id = %(range_file_1)s AND page_end >= %(range_start_1)s)" in clause
+    assert "range_start_0" not in params and "range_end_1" not in params
+    assert params['ranged_file_ids'] == [4, 5]
+
+
+def test_context_within_limit_is_not_compressed(handler):
+    """By default compression only kicks in for context that would overflow max_context_tokens"""
+    sentences = " ".join(f"Sentence {i} is about something other than the question." for i in range(20))
+    chunks = [make_chunk(sentences), make_chunk(sentences.upper())]
+
+    assert handler.compressed_context_tokens == handler.max_context_tokens
+    assert handler.compress_context_chunks("supply and demand", chunks, handler.max_context_tokens) is chunks
+
+    overflowing = chunks * 3
+    compressed = handler.compress_context_chunks("supply and demand", overflowing, handler.max_context_tokens)
+    assert sum(chunk['token_count'] for chunk in compressed) < sum(chunk['token_count'] for chunk in overflowing)
+
+
+def test_citations_are_not_tokenized_per_chunk(handler, monkeypatch):
+    """A file name is tokenized once, however many of its chunks are cited; the estimate never undercounts"""
+    encoded = []
+    encode = handler.encoding.encode
+    monkeypatch.setattr(handler.encoding, "encode", lambda text, **kwargs: encoded.append(text) or encode(text))
+    chunks = [make_chunk(f"Chunk {i}.", file_name="microeconomics.pdf", page_start=i, page_end=i + 1)
+              for i in range(1, 4)]
+
+    handler.build_context(chunks, similarity_threshold=0.0)
+    handler.build_context(chunks, similarity_threshold=0.0)
+
+    assert encoded.count("microeconomics.pdf") == 1
+    assert not any("pp." in text for text in encoded)
+    citation = handler.format_citation(chunks[0]) + "; "
+    assert handler.citation_tokens(chunks[0], citation) >= len(encode(citation))
+
+
+class ParentCursor:
+    """Cursor returning assembled parent windows for the parent query in _expand_to_parents"""
+
+    def __init__(self, parents):
+        self.parents = parents
+        self.executed = []
+
+    def execute(self, sql, params):
+        self.executed.append((sql, params))
+
+    def fetchall(self):
+        ids = self.executed[-1][1]['parent_ids']
+        return [(parent_id, *self.parents[parent_id]) for parent_id in ids if parent_id in self.parents]
+
+
+def child_row(query_index, similarity, chunk_id, parent_id, content="child", score=None):
+    return (query_index, content, similarity, 10, [similarity], chunk_id, parent_id, "econ.pdf", 3, 3, score)
+
+
+def test_children_are_grouped_into_parents(handler):
+    """Each parent appears once, in the rank of its first child, with its text assembled from its children"""
+    rows = [child_row(1, 0.80, 11, 1), child_row(1, 0.70, 21, 2), child_row(1, 0.75, 12, 1),
+            child_row(1, 0.60, 31, None, "legacy chunk"), child_row(2, 0.50, 22, 2)]
+    cursor = ParentCursor({1: ("Parent one.", 40, 3, 4), 2: ("Parent two.", 30, 5, 5)})
+
+    first, second = handler._expand_to_parents(cursor, rows, 2, limit=5)
+
+    assert [chunk['parent_id'] for chunk in first] == [1, 2, None]
+    assert first[0]['content'] == "Parent one." and first[0]['token_count'] == 40
+    assert (first[0]['page_start'], first[0]['page_end']) == (3, 4)
+    assert first[2]['content'] == "legacy chunk"
+    assert [chunk['content'] for chunk in second] == ["Parent two."]
+    assert len(cursor.executed) == 1
+
+
+def test_parent_takes_its_most_similar_child(handler):
+    """Hybrid rows are in fused order, so a later child of the same parent can be more similar"""
+    rows = [child_row(1, 0.55, 11, 1), child_row(1, 0.70, 21, 2), child_row(1, 0.90, 12, 1)]
+
+    chunks = handler._expand_to_parents(ParentCursor({}), rows, 1, limit=5)[0]
+
+    assert [chunk['parent_id'] for chunk in chunks] == [1, 2]
+    assert chunks[0]['similarity'] == 0.90 and chunks[0]['embedding'] == [0.90]
+
+
+def test_parent_takes_its_first_childs_fused_score(handler):
+    """Hybrid rows carry their fused score, which the parent keeps from its highest-ranked child"""
+    rows = [child_row(1, 0.55, 11, 1, score=0.032), child_row(1, 0.70, 21, 2, score=0.030),
+            child_row(1, 0.90, 12, 1, score=0.016)]
+
+    chunks = handler._expand_to_parents(ParentCursor({}), rows, 1, limit=5)[0]
+
+    assert [chunk['score'] for chunk in chunks] == [0.032, 0.030]
+
+
+def test_parents_are_limited_per_query(handler):
+    """Children of parents beyond the limit are ignored"""
+    rows = [child_row(1, 0.9, 11, 1), child_row(1, 0.8, 21, 2), child_row(1, 0.7, 31, 3)]
+
+    chunks = handler._expand_to_parents(ParentCursor({}), rows, 1, limit=2)[0]
+
+    assert [chunk['parent_id'] for chunk in chunks] == [1, 2]
+
+
+def test_near_duplicates_are_dropped(handler):
+    """A chunk almost identical to a more relevant one is left out"""
+    original = make_chunk("Supply rises.", 0.90, [1.0, 0.0, 0.0])
+    duplicate = make_chunk("Supply rises!", 0.89, [0.999, 0.04, 0.0])
+    other = make_chunk("Demand falls.", 0.80, [0.0, 1.0, 0.0])
+
+    assert handler.select_diverse_chunks([duplicate, other, original]) == [original, other]
+
+
+def test_ordering_trades_relevance_against_novelty(handler):
+    """A less relevant but novel chunk can come before a relevant one similar to what is already selected"""
+    best = make_chunk("Taxes.", 0.90, [1.0, 0.0, 0.0])
+    similar = make_chunk("Tax incidence.", 0.85, [0.9, 0.43589, 0.0])  # Cosine 0.9 to best
+    novel = make_chunk("Subsidies.", 0.80, [0.0, 0.0, 1.0])
+
+    assert handler.select_diverse_chunks([best, similar, novel]) == [best, novel, similar]
+
+    handler.mmr_lambda = 1.0  # Relevance only
+    assert handler.select_diverse_chunks([best, similar, novel]) == [best, similar, novel]
+
+
+def test_fused_score_is_the_relevance_of_hybrid_candidates(handler):
+    """Hybrid candidates are ranked by their fused score, even where cosine similarity orders them differently"""
+    lexical = make_chunk("Elasticity of demand.", 0.78, [1.0, 0.0, 0.0], score=0.032)
+    semantic = make_chunk("How buyers respond to prices.", 0.86, [0.0, 1.0, 0.0], score=0.016)
+
+    assert handler.select_diverse_chunks([semantic, lexical]) == [lexical, semantic]
+    assert handler.select_diverse_chunks([semantic, lexical], max_chunks=1) == [lexical]
+
+    vector_only = [dict(chunk, score=None) for chunk in (semantic, lexical)]
+    assert handler.select_diverse_chunks(vector_only) == vector_only
+
+
+def test_max_chunks_is_respected(handler):
+    """At most max_chunks are returned, with or without embeddings"""
+    chunks = [make_chunk(f"Chunk {i}.", 0.9 - i / 10, [float(i == j) for j in range(5)]) for i in range(5)]
+
+    assert handler.select_diverse_chunks(chunks, max_chunks=2) == chunks[:2]
+    assert handler.select_diverse_chunks(chunks, max_chunks=0) == []
+    assert len(handler.select_diverse_chunks(chunks, max_chunks=10)) == 5
+
+    without_embeddings = [dict(chunk, embedding=None) for chunk in chunks]
+    assert handler.select_diverse_chunks(without_embeddings, max_chunks=3) == without_embeddings[:3]
+
+
+class SessionState(dict):
+    """Attribute access over a dict, like st.session_state"""
+    __getattr__ = dict.__getitem__
+    __setattr__ = dict.__setitem__
+
+
+def test_retrieval_worker_opens_its_own_connections(handler, offline_secrets):
+    """A background retrieval outlives a timed-out wait, so it must not use (or close) the session connection"""
+    from app.db import database_connection
+
+    offline_secrets["DB_CONNECTION"] = "postgresql://test"
+    session = SessionState(db_connection=MagicMock())
+    handler.check_relevance = lambda query, query_embedding, user_name: (True, [1.0])
+    handler.retrieve_context = lambda query, **kwargs: database_connection.get_connection()
+
+    with patch("streamlit.session_state", session), patch.object(database_connection.psycopg2, "connect") as connect:
+        searched, conn, timed_out = handler.wait_for_retrieval(handler.start_retrieval("supply"), 5)
+
+        assert searched and not timed_out
+        assert conn is connect.return_value
+        assert database_connection.get_connection() is session.db_connection
+    session.db_connection.close.assert_not_called()
+
+
+def test_context_cache_key(handler, monkeypatch):
+    """Keyed on generation, query embedding, file scope (in any order) and settings; no key without a generation"""
+    monkeypatch.setattr("app.rag.rag_handler.get_corpus_generation", lambda: 7)
+    key = handler._context_cache_key([1.0, 0.0], [3, 1], 5, 0.7)
+
+    assert key[0] == 7
+    assert key == handler._context_cache_key([1.0, 0.0], [1, 3], 5, 0.7)
+    assert key != handler._context_cache_key([0.0, 1.0], [1, 3], 5, 0.7)
+    assert key != handler._context_cache_key([1.0, 0.0], None, 5, 0.7)
+    assert key != handler._context_cache_key([1.0, 0.0], [1, 3], 4, 0.7)
+
+    monkeypatch.setattr("app.rag.rag_handler.get_corpus_generation", lambda: None)
+    assert handler._context_cache_key([1.0, 0.0], [1, 3], 5, 0.7) is None
+
+
+def test_corpus_change_invalidates_cached_context(handler, monkeypatch):
+    """A repeated query is served from the cache until the corpus generation changes"""
+    generation = [1]
+    searches = []
+    monkeypatch.setattr("app.rag.rag_handler.get_corpus_generation", lambda: generation[0])
+    monkeypatch.setattr("app.rag.rag_handler.get_file_page_ranges", lambda: {})
+    monkeypatch.setattr(handler, "_refresh_relevance_gate", lambda: None)
+    monkeypatch.setattr(handler, "hybrid_search",
+                        lambda *args, **kwargs: searches.append(args) or [make_chunk(f"Search {len(searches)}.")])
+
+    first = handler.retrieve_context("supply", query_embedding=[1.0, 0.0])
+    assert handler.retrieve_context("supply", query_embedding=[1.0, 0.0]) == first
+    assert len(searches) == 1
+
+    generation[0] = 2
+    assert handler.retrieve_context("supply", query_embedding=[1.0, 0.0]) != first
+    assert len(searches) == 2
+
+
+def test_gate_scores_are_written_in_the_background(handler, monkeypatch):
+    """Retrieval returns without waiting for the gate score write, and scores queued meanwhile are batched"""
+    writing, release, writes = threading.Event(), threading.Event(), []
+
+    def slow_write(rows):
+        writes.append(rows)
+        writing.set()
+        release.wait(5)
+
+    monkeypatch.setattr("app.rag.rag_handler.log_relevance_gate_scores", slow_write)
+    monkeypatch.setattr("app.rag.rag_handler.get_corpus_generation", lambda: None)
+    monkeypatch.setattr("app.rag.rag_handler.get_file_page_ranges", lambda: {})
+    monkeypatch.setattr(handler, "_refresh_relevance_gate", lambda: None)
+    monkeypatch.setattr(handler.relevance_gate, "best_similarity", lambda query_embedding, file_ids: 0.8)
+    monkeypatch.setattr(handler, "hybrid_search", lambda *args, **kwargs: [make_chunk("Supply rises.", 0.75)])
+
+    assert handler.retrieve_context("supply", query_embedding=[1.0]) is not None
+    assert writing.wait(5)
+    handler.retrieve_context("demand", query_embedding=[0.5])
+    handler.retrieve_context("prices", query_embedding=[0.2])
+    release.set()
+    handler._gate_log_executor.submit(lambda: None).result(5)
+
+    assert writes == [[(0.8, 0.75, True, 1.0)], [(0.8, 0.75, True, 1.0)] * 2]
+
+
+def test_uploads_share_one_in_memory_processor(handler, offline_secrets, tmp_path, monkeypatch):
+    """Every upload reuses one processor, whose embedding cache is in memory and closed with the handler"""
+    del offline_secrets["EMBEDDING_CACHE_PATH"]
+    monkeypatch.chdir(tmp_path)
+    processor = handler.get_upload_processor()
+
+    assert processor.embedding_cache.path == ":memory:"
+    assert handler.process_uploaded_files([])['total_files'] == 0
+    assert handler.get_upload_processor() is processor
+    assert not list(tmp_path.iterdir())
+
+    handler.close()
+    assert processor.embedding_cache is None
+
+
+def test_batched_retrieval_keeps_query_order(handler, monkeypatch):
+    """Each query gets its own context in input order, with cache hits and searched queries interleaved"""
+    searched = []
+
+    def hybrid_search_many(queries, query_embeddings, **kwargs):
+        searched.append(list(queries))
+        return [[make_chunk(f"About {query}.")] for query in queries]
+
+    monkeypatch.setattr(handler, "get_query_embeddings",
+                        lambda queries: [[float(ord(query[0])), 1.0] for query in queries])
+    monkeypatch.setattr("app.rag.rag_handler.get_corpus_generation", lambda: 1)
+    monkeypatch.setattr("app.rag.rag_handler.get_file_page_ranges", lambda: {})
+    monkeypatch.setattr(handler, "_refresh_relevance_gate", lambda: None)
+    monkeypatch.setattr(handler, "hybrid_search_many", hybrid_search_many)
+
+    queries = ["alpha", "beta", "gamma"]
+    handler.retrieve_context_many(["beta"], similarity_threshold=0.0)
+    contexts = handler.retrieve_context_many(queries, similarity_threshold=0.0)
+
+    assert searched == [["beta"], ["alpha", "gamma"]]
+    for query, context in zip(queries, contexts):
+        assert [other for other in queries if f"About {other}." in context] == [query]
+
+
+def test_batched_rows_are_grouped_by_query(handler):
+    """Rows are assigned to their own query by index, whatever order they arrive in"""
+    rows = [child_row(2, 0.9, 21, None, "second"), child_row(1, 0.8, 11, None, "first"),
+            child_row(3, 0.7, 31, None, "third"), child_row(1, 0.6, 12, None, "first again")]
+
+    first, second, third = handler._expand_to_parents(ParentCursor({}), rows, 3, limit=5)
+
+    assert [chunk['content'] for chunk in first] == ["first", "first again"]
+    assert [chunk['content'] for chunk in second] == ["second"]
+    assert [chunk['content'] for chunk in third] == ["third"]
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Tests for the embedding RPM/TPM rate limiter
+Uses a fake clock, so nothing actually sleeps
+"""
+
+from types import SimpleNamespace
+
+from app.rag.rate_limiter import RateLimiter, retry_after_seconds
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+def make_limiter(rpm: int, tpm: int):
+    clock = FakeClock()
+    return RateLimiter(requests_per_minute=rpm, tokens_per_minute=tpm, clock=clock, sleep=clock.sleep), clock
+
+
+def test_burst_within_limits_does_not_wait():
+    """Requests that fit both buckets go straight through"""
+    limiter, clock = make_limiter(rpm=60, tpm=10000)
+
+    assert [limiter.acquire(1000) for _ in range(5)] == [0.0] * 5
+    assert clock.now == 0.0
+
+
+def test_request_limit_waits_for_refill():
+    """Once the request bucket is empty, the next request waits for one request's worth of refill"""
+    limiter, clock = make_limiter(rpm=60, tpm=0)
+    for _ in range(60):
+        limiter.acquire(1)
+
+    assert limiter.acquire(1) == 1.0
+    assert clock.now == 1.0
+
+
+def test_token_limit_waits_for_refill():
+    """Token-heavy requests are held until enough tokens per minute have refilled"""
+    limiter, clock = make_limiter(rpm=0, tpm=6000)
+    limiter.acquire(6000)
+
+    assert limiter.acquire(3000) == 30.0
+    # Requests larger than the whole bucket wait for a full bucket rather than forever
+    assert limiter.acquire(10000) == 60.0
+
+
+def test_pause_holds_every_caller():
+    """A 429 with Retry-After pauses the next request and is counted in the report"""
+    limiter, clock = make_limiter(rpm=60, tpm=10000)
+    limiter.pause(5)
+
+    assert limiter.acquire(10) == 5.0
+    report = limiter.report()
+    assert report['requests'] == 1
+    assert report['tokens'] == 10
+    assert report['rate_limited'] == 1
+    assert report['throttled_seconds'] == 5.0
+
+
+def test_retry_after_headers():
+    """Retry-After-Ms is preferred over Retry-After, and errors without headers give None"""
+    def error(headers):
+        return Exception() if headers is None else SimpleNamespace(response=SimpleNamespace(headers=headers))
+
+    assert retry_after_seconds(error({"retry-after-ms": "1500", "retry-after": "2"})) == 1.5
+    assert retry_after_seconds(error({"retry-after": "2"})) == 2.0
+    assert retry_after_seconds(error({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"})) is None
+    assert retry_after_seconds(error(None)) is None
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Tests for the centroid relevance gate
+Centroids and queries are small hand-made vectors, so expected scores can be read off
+"""
+
+import numpy as np
+
+from app.rag.relevance_gate import CentroidRelevanceGate
+
+
+def make_gate(**kwargs) -> CentroidRelevanceGate:
+    """Gate over three files whose centroids point along the first three axes"""
+    gate = CentroidRelevanceGate(**kwargs)
+    gate.load_centroids(1, [(10, 5, [1.0, 0.0, 0.0, 0.0]),
+                            (20, 5, [0.0, 2.0, 0.0, 0.0]),
+                            (30, 10, [0.0, 0.0, 3.0, 0.0])])
+    return gate
+
+
+def test_learn_threshold_needs_enough_positive_searches():
+    """The gate stays open until min_samples searches that found context are logged"""
+    gate = make_gate(min_samples=10)
+    scores = [(0.5, True)] * 9 + [(0.1, False)] * 100
+
+    assert gate.learn_threshold(scores) is None
+    assert not gate.is_calibrated()
+    assert gate.allows(0.0)
+
+
+def test_learn_threshold_uses_a_low_percentile_of_positives():
+    """Negatives are ignored and the threshold sits a margin below the percentile"""
+    gate = make_gate(min_samples=10, percentile=10.0, margin=0.01)
+    scores = [(score, True) for score in np.linspace(0.5, 0.95, 10)] + [(0.05, False)] * 50
+
+    threshold = gate.learn_threshold(scores)
+
+    assert threshold == gate.threshold
+    assert abs(threshold - (0.5 - 0.01)) < 1e-6
+    assert gate.is_calibrated()
+    assert gate.allows(0.6) and not gate.allows(0.4)
+    assert gate.allows(None)
+
+
+def test_sampled_scores_keep_the_threshold_from_creeping_up():
+    """Weighted samples below the threshold stand for the gated-out prompts they were drawn from"""
+    gate = make_gate(min_samples=10, percentile=5.0, margin=0.0, explore_rate=0.05)
+    above = [(0.8, True)] * 95
+    sampled = [(0.3, True, 1 / 0.05)]
+
+    assert abs(gate.learn_threshold(above + [(0.3, True)]) - 0.8) < 1e-6
+    assert abs(gate.learn_threshold(above + sampled) - 0.3) < 1e-6
+
+
+def test_sample_weight():
+    """Only searches the threshold would have skipped are weighted up"""
+    gate = make_gate(min_samples=1, margin=0.0, explore_rate=0.1)
+    gate.learn_threshold([(0.5, True)])
+
+    assert gate.sample_weight(0.7) == 1.0
+    assert gate.sample_weight(0.2) == 10.0
+    gate.explore_rate = 0.0
+    assert gate.sample_weight(0.2) == 1.0
+    assert not gate.explore()
+
+
+def test_best_similarity_includes_corpus_centroid():
+    """The whole-corpus centroid counts when no file scope is given"""
+    gate = make_gate()
+    query = [1.0, 1.0, 1.0, 0.0]
+
+    assert abs(gate.best_similarity([0.0, 0.0, 5.0, 0.0]) - 1.0) < 1e-6
+    assert gate.best_similarity(query) > gate.best_similarity(query, file_ids=[10, 20, 30])
+    assert gate.best_similarity([0.0, 0.0, 0.0, 1.0], file_ids=[10]) == 0.0
+    assert gate.best_similarity([0.0] * 4) is None
+
+
+def test_top_files():
+    """Files are ranked by centroid similarity, within the given scope"""
+    gate = make_gate()
+
+    assert gate.top_files([0.1, 0.9, 0.5, 0.0], 2) == [20, 30]
+    assert gate.top_files([0.1, 0.9, 0.5, 0.0], 1, file_ids=[10, 30]) == [30]
+
+
+def test_top_files_cannot_narrow():
+    """No routing when the scope already fits, nothing is loaded or unfiled chunks rank high"""
+    gate = make_gate()
+
+    assert gate.top_files([1.0, 0.0, 0.0, 0.0], 3) is None
+    assert gate.top_files([1.0, 0.0, 0.0, 0.0], 1, file_ids=[99]) is None
+    assert CentroidRelevanceGate().top_files([1.0, 0.0, 0.0, 0.0], 1) is None
+
+    gate.load_centroids(2, [(None, 5, [1.0, 0.0]), (10, 5, [0.0, 1.0]), (20, 5, [0.5, 0.5])])
+    assert gate.top_files([1.0, 0.0], 1) is None
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Tests for the compiled topic router
+Keyword lists are passed in directly rather than loaded from the database
+"""
+
+from app.rag.topic_router import DEFAULT_TOPIC_KEYWORDS, TopicRouter, get_topic_router, normalize_keywords
+
+
+def test_default_lexicon():
+    """Economics questions route to RAG, unrelated ones do not"""
+    router = TopicRouter(DEFAULT_TOPIC_KEYWORDS)
+
+    for query in ["What is market failure?", "Explain supply and demand",
+                  "How does government intervention work?", "What are externalities?",
+                  "Discuss monopoly pricing", "Why do taxes cause deadweight  loss?"]:
+        assert router.is_related(query), query
+
+    for query in ["What is the weather today?", "How do I cook pasta?",
+                  "Tell me about history", "What is machine learning?"]:
+        assert not router.is_related(query), query
+
+
+def test_word_boundaries():
+    """Keywords no longer match inside other words"""
+    router = TopicRouter(["tax", "trade"])
+
+    assert not router.is_related("Check the syntax of this code")
+    assert not router.is_related("He is a tradesman")
+    assert router.is_related("TAX policy")
+    assert router.is_related("Taxes and trades")
+
+
+def test_prefix_keywords_and_phrases():
+    """A trailing * matches word prefixes and phrases allow any whitespace"""
+    router = TopicRouter(["subsid*", "public goods"])
+
+    assert router.is_related("Are subsidies efficient?")
+    assert router.is_related("Street lights are public\ngoods")
+    assert not router.is_related("The public library")
+    assert router.matched_keywords("Subsidised public goods") == ["Subsidised", "public goods"]
+
+
+def test_empty_lexicon_matches_nothing():
+    """A deployment may clear the lexicon entirely"""
+    assert not TopicRouter([]).is_related("market")
+    assert normalize_keywords(["  Market ", "market", "", "*"]) == ("market",)
+
+
+def test_router_is_compiled_once():
+    """Routers are cached per distinct lexicon"""
+    keywords = normalize_keywords(["gdp"])
+    assert get_topic_router(keywords) is get_topic_router(keywords)